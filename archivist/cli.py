@@ -19,11 +19,33 @@
 #
 
 from archivist.model import *
-import archivist.ui
+import archivist.profile
+import archivist.git
 import argparse
+import sys
+
+class ConsoleProgress(archivist.util.ProgressMonitor):
+    """
+    Prints progress on stdout and errors on stderr
+    """
+
+    structured = True
+
+    def on_error(self, message):
+        sys.stderr.write(message)
+        sys.stderr.flush()
+
+    def on_progress(self, message):
+        sys.stdout.write(message)
+        sys.stdout.flush()
+
+    def on_transfer(self, transfer):
+        # only completed transfers, the output is often logged
+        if transfer.finished is not None:
+            self.on_progress(str(transfer) + "\n")
 
 def get_archive(args):
-    return Archive(args.archive_path)
+    return Archive(args.archive_path, args.lock_timeout)
 
 def archive_init(args):
     get_archive(args).init()
@@ -39,8 +61,12 @@ def archive_add_cabinet(args):
     type_args = {}
     for arg in cabinet_types[type_name].creation_args:
         type_args[arg] = vars(args)[type_name + "." + arg]
+
+    transfer_args = {}
+    for arg in cabinet_types[type_name].transfer_args:
+        transfer_args[arg] = vars(args)["transfer." + arg]
      
-    archive.add_cabinet(args.cabinet_name, type_name, type_args)
+    archive.add_cabinet(args.cabinet_name, type_name, type_args, transfer_args)
 
 def create_archive_subparser(subparsers):
 
@@ -63,17 +89,40 @@ def create_archive_subparser(subparsers):
         type_parser = add_type_subparser.add_parser(type_name)
         for arg in cabinet_types[type_name].creation_args:
             type_parser.add_argument("--" + type_name + "." + arg, required=True)
+        for arg in cabinet_types[type_name].transfer_args:
+            type_parser.add_argument("--transfer." + arg, 
+                                     help="transfer setting (default: %s)" % 
+                                        (cabinet_types[type_name].default_transfer_settings[arg] or "none"))
 
     add_parser.set_defaults(func=archive_add_cabinet)
 
+def add_persistent_remotes_argument(parser):
+    group = parser.add_mutually_exclusive_group()
+    group.add_argument("--persistent-remotes", dest="persistent_remotes", 
+                        action="store_true", default=None,
+                        help="keep the remotes of the clones after the sync")
+    group.add_argument("--no-persistent-remotes", dest="persistent_remotes", 
+                        action="store_false", 
+                        help="remove the remotes of the clones after the sync")
+
+def add_topology_arguments(parser):
+    parser.add_argument("--topology", choices=TOPOLOGIES, default="hub",
+                        help="hub: sync through the clone in the cheapest cabinet, "
+                             "direct: sync through the folder")
+    parser.add_argument("--dry-run", action="store_true", 
+                        help="show the sync plan without executing it")
+
 def get_cabinet(args):
-    archive = Archive(args.archive_path)
+    archive = get_archive(args)
     cabinet = archive.get_cabinet(args.cabinet_name)
 
     if cabinet is None:
         print("Cabinet not found")
         exit(1)
 
+    if vars(args).get("rescan"):
+        cabinet.update_index(rescan=True)
+
     return cabinet
     
 
@@ -92,10 +141,34 @@ def cabinet_create_folder(args):
     cabinet.create_folder(args.folder_name, type_name, type_args)
 
 def cabinet_sync_folders(args):
-    get_cabinet(args).sync()
+    cabinet = get_cabinet(args)
+
+    if args.dry_run:
+        plans = {}
+
+        for folder in cabinet.folders:
+            if folder.group_uuid not in plans:
+                plans[folder.group_uuid] = folder.plan_sync(args.topology)
+
+        for plan in plans.values():
+            print(plan)
+
+        return
+
+    try:
+        cabinet.sync(ConsoleProgress(), jobs=args.jobs, 
+                        clone_jobs=args.clone_jobs, 
+                        persistent_remotes=args.persistent_remotes, 
+                        topology=args.topology)
+    except FolderOperationError:
+        exit(1)
 
 def cabinet_snapshot_folders(args):
-    get_cabinet(args).snapshot()
+    try:
+        get_cabinet(args).snapshot(ConsoleProgress(), jobs=args.jobs, 
+                                        force=args.force)
+    except FolderOperationError:
+        exit(1)
 
 def cabinet_mount(args):
     get_cabinet(args).mount()
@@ -114,6 +187,7 @@ def create_cabinet_subparser(subparsers):
     # ls-folders
 
     parser = cabinet_subparsers.add_parser('ls-folders', help="List folders in the cabinet")
+    parser.add_argument("--rescan", action="store_true", help="walk the whole cabinet to find the folders")
     parser.set_defaults(func=cabinet_ls_folders)
 
     # create-folder
@@ -126,8 +200,12 @@ def create_cabinet_subparser(subparsers):
 
     for type_name in folder_types:
         type_parser = subparser.add_parser(type_name)
-        for arg in folder_types[type_name].creation_args:
-            type_parser.add_argument("--" + type_name + "." + arg, required=True)
+        folder_type = folder_types[type_name]
+        for arg in folder_type.creation_args:
+            type_parser.add_argument("--" + type_name + "." + arg, 
+                                     required=arg not in folder_type.creation_defaults,
+                                     default=folder_type.creation_defaults.get(arg),
+                                     choices=folder_type.creation_choices.get(arg))
 
     parser.set_defaults(func=cabinet_create_folder )
 
@@ -144,15 +222,23 @@ def create_cabinet_subparser(subparsers):
     # sync-folders
 
     parser = cabinet_subparsers.add_parser('sync-folders', help="Sync all folders in the cabinet")
+    parser.add_argument("--rescan", action="store_true", help="walk the whole cabinet to find the folders")
+    parser.add_argument("--jobs", type=int, default=1, help="number of folders processed concurrently")
+    parser.add_argument("--clone-jobs", type=int, default=1, help="number of clones of a folder processed concurrently")
+    add_persistent_remotes_argument(parser)
+    add_topology_arguments(parser)
     parser.set_defaults(func=cabinet_sync_folders)
 
     # snapshot-folders
 
     parser = cabinet_subparsers.add_parser('snapshot-folders', help="Snapshot all folders in the cabinet")
+    parser.add_argument("--force", action="store_true", help="commit also folders without changes")
+    parser.add_argument("--rescan", action="store_true", help="walk the whole cabinet to find the folders")
+    parser.add_argument("--jobs", type=int, default=1, help="number of folders processed concurrently")
     parser.set_defaults(func=cabinet_snapshot_folders)
 
 def get_folder(args):
-    archive = Archive(args.archive_path)
+    archive = get_archive(args)
 
     cabinet_name, folder_name = args.folder_name.split(os.sep, 1)
 
@@ -171,10 +257,21 @@ def get_folder(args):
     return folder
 
 def folder_sync(args):
-    get_folder(args).sync()
+    folder = get_folder(args)
+
+    if args.rescan:
+        folder.cabinet.archive.update_groups_index()
+
+    if args.dry_run:
+        sys.stdout.write(str(folder.plan_sync(args.topology)))
+        return
+
+    folder.sync(ConsoleProgress(), jobs=args.jobs, 
+                persistent_remotes=args.persistent_remotes, 
+                topology=args.topology)
 
 def folder_snapshot(args):
-    get_folder(args).snapshot()
+    get_folder(args).snapshot(force=args.force)
 
 def folder_mount(args):
     get_folder(args).mount()
@@ -185,11 +282,44 @@ def folder_unmount(args):
 def folder_clone(args):
     folder = get_folder(args)
 
-    archive = Archive(args.archive_path)
+    archive = get_archive(args)
     dest_cabinet_name, dest_folder_name = args.destination.split(os.sep, 1)
     dest_cabinet = archive.get_cabinet(dest_cabinet_name)
 
-    folder.clone(dest_cabinet, dest_folder_name)
+    preferred_content = args.wanted
+
+    if args.partial and preferred_content is None:
+        preferred_content = "present"
+
+    folder.clone(dest_cabinet, dest_folder_name, shared=args.shared, 
+                 storage_mode=args.storage_mode, preferred_content=preferred_content)
+
+def folder_wanted(args):
+    folder = get_folder(args)
+
+    if args.expression is None:
+        print(folder.preferred_content or "anything")
+    else:
+        folder.set_preferred_content(args.expression, ConsoleProgress())
+
+def folder_large_blobs(args):
+    folder = get_folder(args)
+
+    threshold = None
+
+    if args.threshold is not None:
+        threshold = archivist.util.parse_size(args.threshold)
+
+    blobs = folder.find_large_blobs(threshold)
+
+    for path, size in blobs:
+        print("%10s  %s" % (archivist.util.format_size(size), path))
+
+    if args.migrate:
+        folder.migrate_large_blobs([ path for path, size in blobs ], ConsoleProgress())
+
+def folder_get(args):
+    get_folder(args).get(args.paths, ConsoleProgress())
 
 def folder_access_path(args):
     print(get_folder(args).access_path)
@@ -215,16 +345,53 @@ def create_folder_subparser(subparsers):
     # clone
     parser = folder_subparsers.add_parser('clone', help="Clone the folders")
     parser.add_argument('destination', help="Where the clone should be created (cabinet/path/to/folder)")
+    parser.add_argument('--shared', action="store_true", 
+                        help="share the git objects with the folder if on the same file system "
+                             "(the clone breaks if they are removed from the folder)")
+    parser.add_argument('--storage-mode', choices=STORAGE_MODES, 
+                        help="storage mode of the clone (default: the one of the folder)")
+    parser.add_argument('--partial', action="store_true", 
+                        help="get the content only on demand (see 'folder get')")
+    parser.add_argument('--wanted', metavar="EXPRESSION", 
+                        help="get only the content matching the git-annex preferred content "
+                             "expression (e.g. \"largerthan=100mb or include=Photos/*\")")
     parser.set_defaults(func=folder_clone)
 
+    # wanted
+
+    parser = folder_subparsers.add_parser('wanted', help="Show or set the content the folder gets")
+    parser.add_argument('expression', nargs="?", 
+                        help="git-annex preferred content expression, \"anything\" gets all the content")
+    parser.set_defaults(func=folder_wanted)
+
+    # get
+
+    parser = folder_subparsers.add_parser('get', help="Get content from the clones")
+    parser.add_argument('paths', nargs="+", help="files or directories (relative to the folder)")
+    parser.set_defaults(func=folder_get)
+
+    # large-blobs
+
+    parser = folder_subparsers.add_parser('large-blobs', help="List the files stored in git that the largefiles rules put in the annex")
+    parser.add_argument('--threshold', metavar="SIZE", 
+                        help="list the files stored in git larger than SIZE instead")
+    parser.add_argument('--migrate', action="store_true", 
+                        help="move the files to the annex (only the ones matching the largefiles rules)")
+    parser.set_defaults(func=folder_large_blobs)
+
     # sync
 
     parser = folder_subparsers.add_parser('sync', help="Sync all folders in the folder")
+    parser.add_argument("--rescan", action="store_true", help="search all the cabinets for the clones")
+    parser.add_argument("--jobs", type=int, default=1, help="number of clones processed concurrently")
+    add_persistent_remotes_argument(parser)
+    add_topology_arguments(parser)
     parser.set_defaults(func=folder_sync)
 
     # snapshot
 
     parser = folder_subparsers.add_parser('snapshot', help="Snapshot all folders in the folder")
+    parser.add_argument("--force", action="store_true", help="commit also if nothing changed")
     parser.set_defaults(func=folder_snapshot)
 
     # access_path
@@ -233,8 +400,68 @@ def create_folder_subparser(subparsers):
     parser.set_defaults(func=folder_access_path)
 
 def start_ui(args):
+    # the GUI stack is imported only when needed, it is slow to load and 
+    # may not be available on headless machines
+    import archivist.ui
+
     archivist.ui.main()
 
+def get_daemon_client(args):
+    import archivist.daemon
+
+    return archivist.daemon.Client(get_archive(args))
+
+def daemon_run(args):
+    import archivist.daemon
+
+    archivist.daemon.Daemon(get_archive(args)).run()
+
+def daemon_stop(args):
+    get_daemon_client(args).stop()
+
+def daemon_status(args):
+    for job in get_daemon_client(args).status():
+        print("%(id)5d %(state)-8s %(priority)3d %(action)-8s %(target)s" % job)
+
+def daemon_submit(args):
+    client = get_daemon_client(args)
+
+    job = client.submit(args.action, args.target, args.priority, 
+                        wait=not args.no_wait, progress=ConsoleProgress())
+
+    if args.no_wait:
+        print(job['id'])
+
+def daemon_cancel(args):
+    get_daemon_client(args).cancel(args.job)
+
+def create_daemon_subparser(subparsers):
+    daemon_parser = subparsers.add_parser('daemon', help="background daemon")
+
+    daemon_subparsers = daemon_parser.add_subparsers(help="daemon actions")
+
+    parser = daemon_subparsers.add_parser('run', help="Run the daemon in the foreground")
+    parser.set_defaults(func=daemon_run)
+
+    parser = daemon_subparsers.add_parser('stop', help="Stop the daemon")
+    parser.set_defaults(func=daemon_stop)
+
+    parser = daemon_subparsers.add_parser('status', help="List the jobs of the daemon")
+    parser.set_defaults(func=daemon_status)
+
+    parser = daemon_subparsers.add_parser('submit', help="Run an operation in the daemon")
+    parser.add_argument("action", choices=["sync", "snapshot"], help="operation to run")
+    parser.add_argument("target", help="cabinet or cabinet/folder")
+    parser.add_argument("--priority", type=int, default=10, 
+                        help="priority of the operation, lower values run first")
+    parser.add_argument("--no-wait", action="store_true", 
+                        help="return once the operation is queued")
+    parser.set_defaults(func=daemon_submit)
+
+    parser = daemon_subparsers.add_parser('cancel', help="Cancel an operation of the daemon")
+    parser.add_argument("job", type=int, help="id of the operation")
+    parser.set_defaults(func=daemon_cancel)
+
 def main():
     parser = argparse.ArgumentParser(description="Manage an archive")
 
@@ -243,6 +470,12 @@ def main():
 
     parser.add_argument("--archive_path", default=DEFAULT_ARCHIVE_PATH, 
                                     help="path to the archive")
+    parser.add_argument("--lock-timeout", type=float, metavar="SECONDS",
+                        help="maximum time to wait for folders and cabinets used by other operations")
+    parser.add_argument("--timeout", type=float, metavar="SECONDS",
+                        help="stop the operation if it runs longer than SECONDS")
+    parser.add_argument("--command-timeout", type=float, metavar="SECONDS",
+                        help="stop the operation if a command runs longer than SECONDS")
 
     ui_parser = subparsers.add_parser('gui', help="start ui")
     ui_parser.set_defaults(func=start_ui)
@@ -250,10 +483,32 @@ def main():
     create_archive_subparser(subparsers)
     create_cabinet_subparser(subparsers)
     create_folder_subparser(subparsers)
+    create_daemon_subparser(subparsers)
+
+    parser.add_argument("--profile", metavar="FILE",
+                        help="save a trace of the commands executed in FILE (Chrome trace format)")
 
     args = parser.parse_args()
 
-    args.func(args)
+    if args.profile:
+        archivist.profile.start()
+
+    token = None
+
+    if args.timeout is not None or args.command_timeout is not None:
+        token = archivist.util.CancellationToken(args.timeout, args.command_timeout)
+
+    try:
+        with archivist.util.cancellation(token):
+            args.func(args)
+    except archivist.util.OperationCancelled as e:
+        sys.stderr.write(str(e) + "\n")
+        sys.exit(1)
+    finally:
+        if args.profile:
+            # the git helpers are recorded when they exit
+            archivist.git.pool.close()
+            archivist.profile.stop(args.profile)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,638 @@
+#
+#   Copyright 2016 Lorenzo Keller
+#
+#   This file is part of archivist
+#
+#
+#   archivist is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation, either version 3 of the License, or
+#   (at your option) any later version.
+#
+#   archivist is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with archivist.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+
+"""
+A long running process that executes operations on the archive.
+
+The daemon keeps the archive model in memory, runs the scheduled snapshots
+and syncs and accepts requests from the CLI and the tray over a unix 
+socket. Requests and responses are JSON objects, one per line.
+
+Jobs run on a bounded number of worker threads, jobs that would touch the
+same folders (e.g. two syncs of folders of the same group) never run at 
+the same time and a job identical to one already waiting is not queued 
+twice.
+"""
+
+from archivist.model import *
+import archivist.git
+import archivist.util
+import socketserver
+import configparser
+import threading
+import socket
+import select
+import heapq
+import json
+import time
+import os
+
+ACTIONS = [ "sync", "snapshot" ]
+
+class Job():
+
+    def __init__(self, job_id, action, target, priority):
+        self.id = job_id
+        self.action = action
+        self.target = target
+        self.priority = priority
+        self.state = "queued"
+        self.message = None
+        self.group_uuid = None
+        self.submitted = time.time()
+        self.started = None
+        self.finished = None
+        self.subscribers = []
+        self.done = threading.Event()
+        self.token = archivist.util.CancellationToken()
+
+    @property
+    def cabinet_name(self):
+        return self.target.split(os.sep, 1)[0]
+
+    @property
+    def is_folder(self):
+        return os.sep in self.target
+
+    def conflicts(self, other):
+        """
+        Returns True if the two jobs may touch the same folders
+        """
+
+        if self.cabinet_name == other.cabinet_name and \
+                (not self.is_folder or not other.is_folder or self.target == other.target):
+            return True
+
+        # a folder sync touches all the clones of the folder
+        if self.group_uuid is not None and self.group_uuid == other.group_uuid:
+            return True
+
+        # a cabinet sync touches the clones of all its folders
+        return (self.action == "sync" and not self.is_folder) or \
+               (other.action == "sync" and not other.is_folder)
+
+    def to_dict(self):
+        return { 'id' : self.id, 'action' : self.action, 'target' : self.target, 
+                 'priority' : self.priority, 'state' : self.state, 
+                 'message' : self.message, 'submitted' : self.submitted, 
+                 'started' : self.started, 'finished' : self.finished }
+
+class _JobProgress(archivist.util.ProgressMonitor):
+    """
+    Forwards the progress of a job to the connections waiting for it
+    """
+
+    def __init__(self, job, lock):
+        self.job = job
+        self.lock = lock
+
+    def _send(self, message):
+        with self.lock:
+            subscribers = list(self.job.subscribers)
+
+        for subscriber in subscribers:
+            subscriber(message)
+
+    def on_error(self, message):
+        self._send({ 'error' : message })
+
+    def on_progress(self, message):
+        self._send({ 'progress' : message })
+
+class Scheduler():
+    """
+    Queues jobs by priority (lower values run first) and runs them on at 
+    most jobs worker threads
+    """
+
+    def __init__(self, archive, jobs=2, history=100):
+        self.archive = archive
+        self.jobs = jobs
+        self.history = history
+        self.lock = threading.Lock()
+        self.changed = threading.Condition(self.lock)
+        self.queue = []
+        self.running = []
+        self.finished = []
+        self.next_id = 1
+        self.stopped = False
+        self.workers = []
+
+        # the model is kept in memory between jobs: (stamp, object) by name
+        self.cabinets = {}
+        self.folders = {}
+
+    def start(self):
+        for i in range(self.jobs):
+            worker = threading.Thread(target=self._work, daemon=True)
+            worker.start()
+            self.workers.append(worker)
+
+    def stop(self, timeout=30):
+        """
+        Stops the workers: the waiting jobs are cancelled, the running jobs
+        are cancelled and have at most timeout seconds to clean up.
+        """
+
+        with self.lock:
+            self.stopped = True
+
+            for entry in self.queue:
+                self._abort(entry[2])
+
+            self.queue = []
+
+            for job in self.running:
+                job.token.cancel("Daemon stopped")
+
+            self.changed.notify_all()
+
+        deadline = time.monotonic() + timeout
+
+        for worker in self.workers:
+            worker.join(max(deadline - time.monotonic(), 0))
+
+        with self.lock:
+            # the jobs that didn't stop in time, their clients must not wait
+            for job in self.running:
+                self._abort(job)
+
+    def _abort(self, job):
+        job.state = "cancelled"
+        job.message = "Daemon stopped"
+        job.finished = time.time()
+        self.finished.insert(0, job)
+        job.done.set()
+
+    def submit(self, action, target, priority=10):
+        """
+        Queues a job and returns it, if the same job is already waiting the
+        waiting job is returned instead.
+        """
+
+        if action not in ACTIONS:
+            raise Exception("Unsupported action " + action)
+
+        group_uuid = None
+
+        if self.archive is not None and os.sep in target:
+            # conflicts between folders of the same group are detected 
+            # before the jobs run, an invalid target fails when it runs
+            try:
+                group_uuid = self._load(target).group_uuid
+            except Exception:
+                pass
+
+        with self.lock:
+            for entry in self.queue:
+                job = entry[2]
+
+                if job.action == action and job.target == target:
+                    return job
+
+            job = Job(self.next_id, action, target, priority)
+            job.group_uuid = group_uuid
+            self.next_id = self.next_id + 1
+
+            heapq.heappush(self.queue, (priority, job.id, job))
+            self.changed.notify_all()
+
+            return job
+
+    def cancel(self, job_id):
+        """
+        Cancels a job, a waiting job is removed from the queue and a running
+        job is stopped
+        """
+
+        with self.lock:
+            for entry in self.queue:
+                job = entry[2]
+
+                if job.id == job_id:
+                    self.queue.remove(entry)
+                    heapq.heapify(self.queue)
+
+                    job.state = "cancelled"
+                    job.finished = time.time()
+                    self.finished.insert(0, job)
+                    job.done.set()
+                    return
+
+            for job in self.running:
+                if job.id == job_id:
+                    job.token.cancel()
+                    return
+
+        raise Exception("Job not found")
+
+    @property
+    def status(self):
+        with self.lock:
+            jobs = [ entry[2] for entry in sorted(self.queue) ] + self.running + self.finished
+
+            return [ job.to_dict() for job in jobs ]
+
+    def _next_job(self):
+        # the highest priority job that doesn't conflict with running jobs
+        for entry in sorted(self.queue):
+            job = entry[2]
+
+            if not any(job.conflicts(running) for running in self.running):
+                self.queue.remove(entry)
+                heapq.heapify(self.queue)
+                return job
+
+        return None
+
+    def _work(self):
+        while True:
+            with self.lock:
+                # no job is taken from the queue once stopped
+                while True:
+                    if self.stopped:
+                        return
+
+                    job = self._next_job()
+
+                    if job is not None:
+                        break
+
+                    self.changed.wait()
+
+                job.state = "running"
+                job.started = time.time()
+                self.running.append(job)
+
+            self._run(job)
+
+            with self.lock:
+                self.running.remove(job)
+
+                # a job that didn't stop in time was already aborted
+                if job not in self.finished:
+                    self.finished.insert(0, job)
+
+                del self.finished[self.history:]
+                self.changed.notify_all()
+
+            job.done.set()
+
+    def _stamp(self, path):
+        try:
+            stat = os.stat(path)
+        except FileNotFoundError:
+            return None
+
+        return (stat.st_dev, stat.st_ino, stat.st_mtime_ns)
+
+    def _load(self, target):
+        """
+        Returns the cabinet or the folder target, they are loaded again only
+        if their configuration changed since they were last loaded
+        """
+
+        names = target.split(os.sep, 1)
+
+        stamp = self._stamp(os.path.join(self.archive.cabinets_path, names[0]))
+        entry = self.cabinets.get(names[0])
+
+        if entry is None or entry[0] != stamp:
+            entry = (stamp, self.archive.get_cabinet(names[0]))
+            self.cabinets[names[0]] = entry
+
+        cabinet = entry[1]
+
+        if cabinet is None:
+            raise Exception("Cabinet not found")
+
+        if len(names) == 1:
+            return cabinet
+
+        # the folders of a cabinet that was loaded again are loaded again
+        stamp = (cabinet, self._stamp(os.path.join(cabinet.access_path, names[1], 
+                                                   ".git", "archivist")))
+        entry = self.folders.get(target)
+
+        if entry is None or entry[0] != stamp:
+            entry = (stamp, cabinet.get_folder(names[1]))
+            self.folders[target] = entry
+
+        if entry[1] is None:
+            raise Exception("Folder not found")
+
+        return entry[1]
+
+    def _run(self, job):
+        progress = _JobProgress(job, self.lock)
+
+        try:
+            target = self._load(job.target)
+
+            if job.is_folder:
+                with self.lock:
+                    job.group_uuid = target.group_uuid
+
+            with archivist.util.cancellation(job.token):
+                getattr(target, job.action)(progress)
+
+            job.state = "success"
+        except archivist.util.OperationCancelled as e:
+            job.state = "cancelled"
+            job.message = str(e)
+            progress.on_error(str(e) + "\n")
+        except Exception as e:
+            job.state = "failure"
+            job.message = str(e)
+            progress.on_error(str(e) + "\n")
+        finally:
+            job.finished = time.time()
+
+class Schedule():
+    """
+    An operation executed periodically on a cabinet or a folder
+    """
+
+    def __init__(self, action, target, interval, priority):
+        self.action = action
+        self.target = target
+        self.interval = interval
+        self.priority = priority
+        self.next_run = time.monotonic()
+
+def load_schedules(path):
+    """
+    Loads the schedules from the daemon configuration file.
+
+    Each section named 'target <cabinet>' or 'target <cabinet>/<folder>' can 
+    contain a 'syncInterval' and a 'snapshotInterval' (in seconds) and a 
+    'priority'.
+    """
+
+    config = configparser.ConfigParser()
+    config.read(path)
+
+    schedules = []
+
+    for section in config.sections():
+        if not section.startswith("target "):
+            continue
+
+        target = section[len("target "):].strip()
+        priority = config.getint(section, "priority", fallback=10)
+
+        for action in ACTIONS:
+            interval = config.getint(section, action + "Interval", fallback=None)
+
+            if interval is not None:
+                schedules.append(Schedule(action, target, interval, priority))
+
+    return config, schedules
+
+class _RequestHandler(socketserver.StreamRequestHandler):
+
+    def _send(self, message):
+        try:
+            with self.send_lock:
+                self.wfile.write(json.dumps(message).encode("utf-8") + b"\n")
+                self.wfile.flush()
+        except OSError:
+            # the client went away
+            pass
+
+    def handle(self):
+        self.send_lock = threading.Lock()
+
+        for line in self.rfile:
+            try:
+                request = json.loads(line.decode("utf-8"))
+                self._handle_request(request)
+            except Exception as e:
+                self._send({ 'result' : 'failure', 'message' : str(e) })
+
+    def _handle_request(self, request):
+        daemon = self.server.daemon
+        command = request.get("command")
+
+        if command == "status":
+            self._send({ 'result' : 'success', 'jobs' : daemon.scheduler.status })
+        elif command == "cancel":
+            daemon.scheduler.cancel(request["job"])
+            self._send({ 'result' : 'success' })
+        elif command == "stop":
+            self._send({ 'result' : 'success' })
+            daemon.stop()
+        elif command == "submit":
+            scheduler = daemon.scheduler
+
+            job = scheduler.submit(request["action"], request["target"], 
+                                   request.get("priority", 10))
+
+            if not request.get("wait", True):
+                self._send({ 'result' : 'success', 'job' : job.to_dict() })
+                return
+
+            # the client needs the id to cancel the job
+            self._send({ 'queued' : job.to_dict() })
+
+            with scheduler.lock:
+                job.subscribers.append(self._send)
+
+            job.done.wait()
+
+            with scheduler.lock:
+                job.subscribers.remove(self._send)
+
+            self._send({ 'result' : job.state, 'message' : job.message, 
+                         'job' : job.to_dict() })
+        else:
+            raise Exception("Unknown command")
+
+class _Server(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+def get_socket_path(archive):
+    return os.path.join(archive.path, "daemon.sock")
+
+def get_config_path(archive):
+    return os.path.join(archive.path, "daemon")
+
+class Daemon():
+
+    def __init__(self, archive):
+        self.archive = archive
+
+        config, self.schedules = load_schedules(get_config_path(archive))
+
+        self.scheduler = Scheduler(archive, config.getint("daemon", "jobs", fallback=2))
+        self.stopped = threading.Event()
+        self.server = None
+
+    def _schedule(self):
+        while not self.stopped.wait(1):
+            now = time.monotonic()
+
+            for schedule in self.schedules:
+                if now < schedule.next_run:
+                    continue
+
+                schedule.next_run = now + schedule.interval
+
+                cabinet = self.archive.get_cabinet(schedule.target.split(os.sep, 1)[0])
+
+                # cabinets that are not accessible are skipped until the 
+                # next run
+                if cabinet is None or not cabinet.is_mounted:
+                    continue
+
+                self.scheduler.submit(schedule.action, schedule.target, schedule.priority)
+
+            archivist.git.pool.evict()
+
+    def run(self):
+        socket_path = get_socket_path(self.archive)
+
+        if Client(self.archive).is_running:
+            raise Exception("Daemon already running")
+
+        if os.path.exists(socket_path):
+            os.unlink(socket_path)
+
+        self.server = _Server(socket_path, _RequestHandler)
+        self.server.daemon = self
+
+        self.scheduler.start()
+
+        scheduler_thread = threading.Thread(target=self._schedule, daemon=True)
+        scheduler_thread.start()
+
+        try:
+            self.server.serve_forever()
+        finally:
+            self.stopped.set()
+            self.scheduler.stop()
+            self.server.server_close()
+            os.unlink(socket_path)
+
+    def stop(self):
+        self.stopped.set()
+
+        # shutdown() waits for serve_forever() to exit, it cannot be called
+        # from the thread handling the request
+        threading.Thread(target=self.server.shutdown).start()
+
+class Client():
+    """
+    Sends requests to a running daemon
+    """
+
+    def __init__(self, archive):
+        self.socket_path = get_socket_path(archive)
+
+    @property
+    def is_running(self):
+        try:
+            with self._connect():
+                return True
+        except OSError:
+            return False
+
+    def _connect(self):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+
+        try:
+            sock.connect(self.socket_path)
+        except OSError:
+            sock.close()
+            raise
+
+        return sock
+
+    def _request(self, request, progress=None):
+        token = archivist.util.current_token()
+        job = None
+
+        with self._connect() as sock:
+            sock.sendall(json.dumps(request).encode("utf-8") + b"\n")
+
+            # the job is cancelled in the daemon when the current 
+            # cancellation token is cancelled
+            buffer = b""
+
+            while True:
+                if token is not None:
+                    # checked before every read, a job that keeps sending
+                    # progress never lets select() time out
+                    if token.is_cancelled and job is not None:
+                        self.cancel(job['id'])
+                        job = None
+
+                    readable, _, _ = select.select([ sock ], [], [], 0.2)
+
+                    if not readable:
+                        continue
+
+                data = sock.recv(65536)
+
+                if not data:
+                    break
+
+                lines = (buffer + data).split(b"\n")
+                buffer = lines.pop()
+
+                for line in lines:
+                    response = json.loads(line.decode("utf-8"))
+
+                    if "queued" in response:
+                        job = response["queued"]
+                    elif "progress" in response:
+                        progress and progress.on_progress(response["progress"])
+                    elif "error" in response:
+                        progress and progress.on_error(response["error"])
+                    elif response["result"] == "cancelled":
+                        raise archivist.util.OperationCancelled(response.get("message") or 
+                                                                "Operation cancelled")
+                    elif response["result"] != "success":
+                        raise Exception(response.get("message") or "Job failed")
+                    else:
+                        return response
+
+        raise Exception("Connection with the daemon lost")
+
+    def submit(self, action, target, priority=10, wait=True, progress=None):
+        """
+        Submits a job to the daemon, if wait is True the function blocks 
+        until the job is completed and sends its progress to the monitor.
+        """
+
+        return self._request({ 'command' : 'submit', 'action' : action, 
+                               'target' : target, 'priority' : priority, 
+                               'wait' : wait }, progress)['job']
+
+    def status(self):
+        return self._request({ 'command' : 'status' })['jobs']
+
+    def cancel(self, job_id):
+        with archivist.util.cancellation(None):
+            self._request({ 'command' : 'cancel', 'job' : job_id })
+
+    def stop(self):
+        self._request({ 'command' : 'stop' })
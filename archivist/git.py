@@ -0,0 +1,262 @@
+#
+#   Copyright 2016 Lorenzo Keller
+#
+#   This file is part of archivist
+#
+#
+#   archivist is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation, either version 3 of the License, or
+#   (at your option) any later version.
+#
+#   archivist is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with archivist.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+
+import archivist.gitmeta
+import archivist.profile
+import archivist.util
+import subprocess
+import threading
+import atexit
+import struct
+import time
+import zlib
+import os
+
+class CatFile():
+    """
+    A long running 'git cat-file --batch' process.
+
+    Reading an object is a round-trip on the pipes of the process instead of
+    a new process. The reads are serialized, the object can be shared 
+    between threads.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.started = time.monotonic()
+        self.last_used = self.started
+        self.output_bytes = 0
+        self.popen = subprocess.Popen(['git', 'cat-file', '--batch'], cwd=path,
+                                        stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+
+    @property
+    def is_alive(self):
+        return self.popen.poll() is None
+
+    def read(self, rev):
+        """
+        Returns the content of an object or None if the object doesn't exist
+        """
+
+        with self.lock:
+            self.last_used = time.monotonic()
+
+            self.popen.stdin.write(rev.encode("utf-8") + b"\n")
+            self.popen.stdin.flush()
+
+            header = self.popen.stdout.readline()
+
+            if header == b"":
+                raise Exception("git cat-file exited unexpectedly")
+
+            fields = header.split()
+
+            if fields[-1] in (b"missing", b"ambiguous"):
+                return None
+
+            data = self.popen.stdout.read(int(fields[2]))
+            self.output_bytes = self.output_bytes + len(data)
+
+            # the content is followed by a new line
+            self.popen.stdout.read(1)
+
+            return data
+
+    def close(self):
+        with self.lock:
+            self.popen.stdin.close()
+            self.popen.stdout.close()
+            self.popen.wait()
+
+        archivist.profile.record_command(self.popen.args, self.path, self.started, 
+                                         time.monotonic(), self.popen.returncode, 
+                                         self.output_bytes)
+
+class HelperPool():
+    """
+    Keeps a CatFile helper for each repository and a cache of the 
+    configuration of each repository.
+
+    Helpers that were not used for more than idle_timeout seconds are closed
+    the next time the pool is used.
+    """
+
+    def __init__(self, idle_timeout=60):
+        self.idle_timeout = idle_timeout
+        self.lock = threading.Lock()
+        self.helpers = {}
+        self.configs = {}
+
+    def evict(self):
+        """
+        Closes the helpers that are idle since more than idle_timeout seconds
+        """
+
+        with self.lock:
+            now = time.monotonic()
+
+            for path, helper in list(self.helpers.items()):
+                if now - helper.last_used > self.idle_timeout:
+                    del self.helpers[path]
+                    helper.close()
+
+    def cat_file(self, path):
+        self.evict()
+
+        path = os.path.abspath(path)
+
+        with self.lock:
+            helper = self.helpers.get(path)
+
+            if helper is None or not helper.is_alive:
+                helper = CatFile(path)
+                self.helpers[path] = helper
+
+            return helper
+
+    def config(self, path):
+        """
+        Returns a dictionary with the configuration of a repository.
+
+        The configuration is read again only when the configuration file of
+        the repository is replaced (git always rewrites the whole file when 
+        changing it).
+        """
+
+        path = os.path.abspath(path)
+
+        try:
+            st = os.stat(os.path.join(path, ".git", "config"))
+            version = (st.st_ino, st.st_mtime_ns, st.st_size)
+        except OSError:
+            version = None
+
+        with self.lock:
+            cached = self.configs.get(path)
+
+        if version is not None and cached is not None and cached[0] == version:
+            return cached[1]
+
+        output = archivist.util.check_output(['git', 'config', '--local', '--list', '-z'], wd=path)
+
+        config = {}
+
+        for entry in output.decode("utf-8").split("\0"):
+            if entry == "":
+                continue
+
+            key, _, value = entry.partition("\n")
+            config[key] = value
+
+        if version is not None:
+            with self.lock:
+                self.configs[path] = (version, config)
+
+        return config
+
+    def close(self):
+        with self.lock:
+            for helper in self.helpers.values():
+                helper.close()
+
+            self.helpers = {}
+            self.configs = {}
+
+pool = HelperPool()
+
+atexit.register(pool.close)
+
+# errors of the in-process reader after which git is run instead, the 
+# repository may be unusual (see archivist.gitmeta) or its files corrupt or
+# changing while they are read
+_FALLBACK_ERRORS = (archivist.gitmeta.UnsupportedRepository, zlib.error, struct.error, 
+                    KeyError, IndexError, FileNotFoundError)
+
+def _normalize_key(key):
+    # section and variable names are case insensitive, subsections are not
+    section, _, rest = key.partition(".")
+    subsection, _, name = rest.rpartition(".")
+
+    if subsection == "":
+        return section.lower() + "." + name.lower()
+
+    return section.lower() + "." + subsection + "." + name.lower()
+
+def read_blob(path, rev):
+    """
+    Returns the content of the blob rev (e.g. 'branch:file') of the 
+    repository in path or None if it doesn't exist
+    """
+
+    try:
+        return archivist.gitmeta.Repository(path).read_blob(rev)
+    except _FALLBACK_ERRORS:
+        return pool.cat_file(path).read(rev)
+
+def resolve(path, name):
+    """
+    Returns the sha the ref name of the repository in path points to or 
+    None if it doesn't exist
+    """
+
+    try:
+        return archivist.gitmeta.Repository(path).resolve(name)
+    except _FALLBACK_ERRORS:
+        try:
+            output = archivist.util.check_output(['git', 'rev-parse', '-q', '--verify', name], wd=path)
+        except subprocess.CalledProcessError:
+            return None
+
+        return output.decode("utf-8").strip()
+
+def head(path):
+    """
+    Returns the name of the ref HEAD of the repository in path points to or
+    None if HEAD is detached
+    """
+
+    try:
+        return archivist.gitmeta.Repository(path).head
+    except _FALLBACK_ERRORS:
+        try:
+            output = archivist.util.check_output(['git', 'symbolic-ref', '-q', 'HEAD'], wd=path)
+        except subprocess.CalledProcessError:
+            return None
+
+        return output.decode("utf-8").strip()
+
+def get_config(path, key, default=None):
+    """
+    Returns the value of a configuration key of the repository in path
+    """
+    return get_config_all(path).get(_normalize_key(key), default)
+
+def get_config_all(path):
+    """
+    Returns a dictionary with all the configuration keys of the repository
+    in path (global and system configuration is not included)
+    """
+
+    try:
+        return archivist.gitmeta.Repository(path).config
+    except _FALLBACK_ERRORS:
+        return pool.config(path)
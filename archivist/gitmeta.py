@@ -0,0 +1,477 @@
+#
+#   Copyright 2016 Lorenzo Keller
+#
+#   This file is part of archivist
+#
+#
+#   archivist is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation, either version 3 of the License, or
+#   (at your option) any later version.
+#
+#   archivist is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with archivist.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+
+"""
+Read-only access to the metadata of a git repository without running git.
+
+Only the common cases are handled (sha1 repositories, loose and packed 
+refs, loose objects, version 2 pack indexes, plain configuration files). 
+When something unusual is found UnsupportedRepository is raised and the 
+caller is expected to fall back to running git.
+"""
+
+import binascii
+import struct
+import zlib
+import os
+
+class UnsupportedRepository(Exception):
+    pass
+
+OBJ_COMMIT = 1
+OBJ_TREE = 2
+OBJ_BLOB = 3
+OBJ_TAG = 4
+OBJ_OFS_DELTA = 6
+OBJ_REF_DELTA = 7
+
+_TYPE_NAMES = { b"commit" : OBJ_COMMIT, b"tree" : OBJ_TREE, 
+                b"blob" : OBJ_BLOB, b"tag" : OBJ_TAG }
+
+def _parse_config_value(value):
+    result = ""
+    quoted = False
+    i = 0
+
+    while i < len(value):
+        c = value[i]
+
+        if c == '"':
+            quoted = not quoted
+        elif c == "\\":
+            i = i + 1
+
+            if i >= len(value):
+                raise UnsupportedRepository("Continuation lines not supported")
+
+            result = result + { "n" : "\n", "t" : "\t", "b" : "\b" }.get(value[i], value[i])
+        elif c in "#;" and not quoted:
+            break
+        else:
+            result = result + c
+
+        i = i + 1
+
+    if quoted:
+        raise UnsupportedRepository("Unterminated quote in configuration")
+
+    return result.strip()
+
+def parse_config(text):
+    """
+    Parses the contents of a git configuration file.
+
+    Returns a dictionary with the same keys and values 'git config --list' 
+    would output (for multi valued keys the last value is kept).
+    """
+
+    config = {}
+    section = None
+
+    for line in text.splitlines():
+        line = line.strip()
+
+        if line == "" or line[0] in "#;":
+            continue
+
+        if line[0] == "[":
+            end = line.find("]")
+
+            if end < 0:
+                raise UnsupportedRepository("Invalid section header")
+
+            header = line[1:end]
+
+            if '"' in header:
+                name, _, subsection = header.partition(" ")
+                subsection = subsection.strip()
+
+                if not (subsection.startswith('"') and subsection.endswith('"')):
+                    raise UnsupportedRepository("Invalid subsection")
+
+                section = name.lower() + "." + subsection[1:-1].replace('\\"', '"').replace("\\\\", "\\")
+            else:
+                # old style [section.subsection] headers
+                section = header.lower()
+
+            if section in ("include", "includeif") or section.startswith("includeif."):
+                raise UnsupportedRepository("Configuration includes not supported")
+
+            line = line[end+1:].strip()
+
+            if line == "" or line[0] in "#;":
+                continue
+
+        if section is None:
+            raise UnsupportedRepository("Configuration key outside of section")
+
+        name, eq, value = line.partition("=")
+
+        config[section + "." + name.strip().lower()] = _parse_config_value(value) if eq else "true"
+
+    return config
+
+def _apply_delta(base, delta):
+
+    def read_size(pos):
+        size = 0
+        shift = 0
+
+        while True:
+            c = delta[pos]
+            pos = pos + 1
+            size = size | ((c & 0x7f) << shift)
+            shift = shift + 7
+
+            if not c & 0x80:
+                return size, pos
+
+    source_size, pos = read_size(0)
+    target_size, pos = read_size(pos)
+
+    if source_size != len(base):
+        raise UnsupportedRepository("Invalid delta base")
+
+    result = bytearray()
+
+    while pos < len(delta):
+        op = delta[pos]
+        pos = pos + 1
+
+        if op & 0x80:
+            offset = 0
+            size = 0
+
+            for i in range(4):
+                if op & (1 << i):
+                    offset = offset | (delta[pos] << (8 * i))
+                    pos = pos + 1
+
+            for i in range(3):
+                if op & (0x10 << i):
+                    size = size | (delta[pos] << (8 * i))
+                    pos = pos + 1
+
+            if size == 0:
+                size = 0x10000
+
+            result += base[offset:offset+size]
+        elif op:
+            result += delta[pos:pos+op]
+            pos = pos + op
+        else:
+            raise UnsupportedRepository("Invalid delta instruction")
+
+    if len(result) != target_size:
+        raise UnsupportedRepository("Invalid delta result")
+
+    return bytes(result)
+
+class _Pack():
+
+    def __init__(self, idx_path):
+        self.idx_path = idx_path
+        self.pack_path = idx_path[:-len(".idx")] + ".pack"
+
+    def find(self, sha):
+        """
+        Returns the offset of the object in the pack or None
+        """
+
+        with open(self.idx_path, "rb") as fp:
+            header = fp.read(8)
+
+            if header[:4] != b"\xfftOc" or struct.unpack(">I", header[4:])[0] != 2:
+                raise UnsupportedRepository("Unsupported pack index version")
+
+            fanout = struct.unpack(">256I", fp.read(1024))
+            count = fanout[255]
+
+            lo = fanout[sha[0] - 1] if sha[0] > 0 else 0
+            hi = fanout[sha[0]]
+
+            # binary search in the sorted table of names
+            while lo < hi:
+                mid = (lo + hi) // 2
+                fp.seek(8 + 1024 + mid * 20)
+                name = fp.read(20)
+
+                if name == sha:
+                    break
+                elif name < sha:
+                    lo = mid + 1
+                else:
+                    hi = mid
+            else:
+                return None
+
+            # skip names and crcs to get to the offsets
+            fp.seek(8 + 1024 + count * 24 + mid * 4)
+            offset = struct.unpack(">I", fp.read(4))[0]
+
+            if offset & 0x80000000:
+                fp.seek(8 + 1024 + count * 28 + (offset & 0x7fffffff) * 8)
+                offset = struct.unpack(">Q", fp.read(8))[0]
+
+            return offset
+
+    def read(self, repository, offset):
+        """
+        Returns the type and the content of the object at offset
+        """
+
+        with open(self.pack_path, "rb") as fp:
+            fp.seek(offset)
+
+            c = fp.read(1)[0]
+            obj_type = (c >> 4) & 7
+
+            while c & 0x80:
+                c = fp.read(1)[0]
+
+            base = None
+
+            if obj_type == OBJ_OFS_DELTA:
+                c = fp.read(1)[0]
+                base_offset = c & 0x7f
+
+                while c & 0x80:
+                    c = fp.read(1)[0]
+                    base_offset = ((base_offset + 1) << 7) | (c & 0x7f)
+
+                base = self.read(repository, offset - base_offset)
+            elif obj_type == OBJ_REF_DELTA:
+                base = repository.read_object(fp.read(20))
+
+                if base is None:
+                    raise UnsupportedRepository("Missing delta base")
+
+            decompressor = zlib.decompressobj()
+            data = bytearray()
+
+            while not decompressor.eof:
+                chunk = fp.read(65536)
+
+                if chunk == b"":
+                    raise UnsupportedRepository("Truncated pack")
+
+                data += decompressor.decompress(chunk)
+
+        if base is None:
+            return obj_type, bytes(data)
+
+        return base[0], _apply_delta(base[1], data)
+
+class Repository():
+    """
+    A git repository whose metadata is read directly from the files in the
+    .git directory.
+    """
+
+    def __init__(self, path):
+        self.git_dir = os.path.join(path, ".git")
+
+        if not os.path.isdir(self.git_dir):
+            raise UnsupportedRepository("Not a plain git repository")
+
+        if os.path.exists(os.path.join(self.git_dir, "reftable")):
+            raise UnsupportedRepository("Reftable not supported")
+
+        # only repositories with extensions can use another hash
+        with open(os.path.join(self.git_dir, "config"), encoding="utf-8") as fp:
+            text = fp.read()
+
+        if "objectformat" in text.lower() and \
+                parse_config(text).get("extensions.objectformat", "sha1").lower() != "sha1":
+            raise UnsupportedRepository("Object format not supported")
+
+    @property
+    def config(self):
+        with open(os.path.join(self.git_dir, "config"), encoding="utf-8") as fp:
+            return parse_config(fp.read())
+
+    @property
+    def head(self):
+        """
+        Returns the name of the ref HEAD points to or None if HEAD is detached
+        """
+
+        with open(os.path.join(self.git_dir, "HEAD")) as fp:
+            head = fp.read().strip()
+
+        if head.startswith("ref: "):
+            return head[len("ref: "):]
+
+        return None
+
+    def _read_ref(self, name):
+        try:
+            with open(os.path.join(self.git_dir, name)) as fp:
+                value = fp.read().strip()
+        except (FileNotFoundError, NotADirectoryError, IsADirectoryError):
+            return self._read_packed_ref(name)
+
+        if value.startswith("ref: "):
+            return self._read_ref(value[len("ref: "):])
+
+        return value
+
+    def _read_packed_ref(self, name):
+        try:
+            with open(os.path.join(self.git_dir, "packed-refs")) as fp:
+                for line in fp:
+                    if line[0] in "#^":
+                        continue
+
+                    sha, _, ref = line.strip().partition(" ")
+
+                    if ref == name:
+                        return sha
+        except FileNotFoundError:
+            pass
+
+        return None
+
+    def resolve(self, name):
+        """
+        Returns the hex sha the ref name points to or None
+        """
+
+        if len(name) == 40 and all(c in "0123456789abcdef" for c in name):
+            return name
+
+        if name.startswith("refs/") or name == "HEAD":
+            candidates = [ name ]
+        else:
+            candidates = [ "refs/" + name, "refs/tags/" + name, "refs/heads/" + name, 
+                           "refs/remotes/" + name, "refs/remotes/" + name + "/HEAD" ]
+
+        for candidate in candidates:
+            sha = self._read_ref(candidate)
+
+            if sha is not None:
+                return sha
+
+        return None
+
+    def _object_dirs(self):
+        objects = os.path.join(self.git_dir, "objects")
+        dirs = [ objects ]
+
+        try:
+            with open(os.path.join(objects, "info", "alternates")) as fp:
+                for line in fp:
+                    line = line.strip()
+
+                    if line and line[0] != "#":
+                        dirs.append(os.path.join(objects, line))
+        except FileNotFoundError:
+            pass
+
+        return dirs
+
+    def read_object(self, sha):
+        """
+        Returns the type and the content of an object (sha is binary) or None
+        if the object doesn't exist
+        """
+
+        hex_sha = binascii.hexlify(sha).decode("ascii")
+
+        for objects in self._object_dirs():
+            try:
+                with open(os.path.join(objects, hex_sha[:2], hex_sha[2:]), "rb") as fp:
+                    data = zlib.decompress(fp.read())
+            except FileNotFoundError:
+                pass
+            else:
+                header, _, content = data.partition(b"\0")
+
+                return _TYPE_NAMES[header.split(b" ")[0]], content
+
+            pack_dir = os.path.join(objects, "pack")
+
+            if not os.path.isdir(pack_dir):
+                continue
+
+            for name in os.listdir(pack_dir):
+                if not name.endswith(".idx"):
+                    continue
+
+                pack = _Pack(os.path.join(pack_dir, name))
+                offset = pack.find(sha)
+
+                if offset is not None:
+                    return pack.read(self, offset)
+
+        return None
+
+    def _read_tree_entry(self, tree, name):
+        pos = 0
+
+        while pos < len(tree):
+            end = tree.index(b"\0", pos)
+            mode, _, entry_name = tree[pos:end].partition(b" ")
+
+            if entry_name == name:
+                return tree[end+1:end+21]
+
+            pos = end + 21
+
+        return None
+
+    def read_blob(self, rev):
+        """
+        Returns the content of a blob referenced as 'ref:path' or None if it 
+        doesn't exist
+        """
+
+        ref, _, path = rev.partition(":")
+
+        sha = self.resolve(ref)
+
+        if sha is None:
+            return None
+
+        obj = self.read_object(binascii.unhexlify(sha))
+
+        # peel annotated tags
+        while obj is not None and obj[0] == OBJ_TAG:
+            obj = self.read_object(binascii.unhexlify(obj[1].split(b"\n", 1)[0].split(b" ")[1]))
+
+        if obj is not None and obj[0] == OBJ_COMMIT:
+            obj = self.read_object(binascii.unhexlify(obj[1].split(b"\n", 1)[0].split(b" ")[1]))
+
+        for name in path.split("/") if path else []:
+            if obj is None or obj[0] != OBJ_TREE:
+                return None
+
+            entry = self._read_tree_entry(obj[1], name.encode("utf-8"))
+
+            if entry is None:
+                return None
+
+            obj = self.read_object(entry)
+
+        if obj is None or obj[0] != OBJ_BLOB:
+            return None
+
+        return obj[1]
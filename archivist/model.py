@@ -19,14 +19,170 @@
 #
 
 import archivist.util
+import archivist.profile
+import archivist.git
 import os
-from urllib.parse import urlparse
 import configparser
 import subprocess
-import uuid
+import threading
+import time
+
+class FolderOperationError(Exception):
+    """
+    Raised when an operation on multiple folders failed on some of them.
+
+    The failures attribute contains a list of (folder, exception) tuples.
+    """
+
+    def __init__(self, failures):
+        Exception.__init__(self, "Operation failed on folders: " + 
+                                    ", ".join(f.name for f, e in failures))
+        self.failures = failures
 
 folder_types = {}
 
+# prefix of the name of the git remotes managed by archivist
+REMOTE_PREFIX = "archivist."
+
+def lock_folders(folders, operation, shared=False, cabinets=None, progress=None):
+    """
+    Returns the locks needed to operate on the folders: a shared lock on
+    their cabinets (and on cabinets) and a lock on each folder.
+
+    The locks are always acquired in the same order to avoid deadlocks.
+    """
+
+    all_cabinets = dict((x.name, x) for x in cabinets or [])
+    all_cabinets.update((x.cabinet.name, x.cabinet) for x in folders)
+
+    locks = [ all_cabinets[name].lock(True, operation) for name in sorted(all_cabinets) ]
+    locks.extend(x.lock(shared, operation) for x in sorted(folders, key=lambda x: x.uuid))
+
+    return archivist.util.LockSet(locks, progress)
+
+TOPOLOGIES = [ "hub", "direct" ]
+
+# unlocked: the files are regular files, the content is also kept in the 
+#           annex (two copies)
+# thin:     like unlocked but the files are hard linked with the annex (one 
+#           copy, a modified file loses the previous version of the content)
+# locked:   the files are read only links to the annex (one copy)
+STORAGE_MODES = [ "unlocked", "thin", "locked" ]
+
+class SyncPlan():
+    """
+    How the folders of a group are synced: the hub syncs (including the 
+    content) with every spoke, then each spoke merges locally what the hub
+    sent to it. The content crosses the link between a spoke and the hub 
+    at most once in each direction.
+    """
+
+    def __init__(self, hub, spokes):
+        self.hub = hub
+        self.spokes = spokes
+
+    @classmethod
+    def create(cls, folder, clones, topology="hub"):
+        """
+        With the hub topology the hub is the folder that is not partial in 
+        the cabinet with the lowest transfer cost (folder if there is a 
+        tie), with the direct topology the hub is always folder.
+        """
+
+        if topology not in TOPOLOGIES:
+            raise Exception("Unsupported topology " + topology)
+
+        folders = [ folder ] + clones
+
+        hub = folder
+
+        if topology == "hub":
+            # a partial folder doesn't have all the content to relay
+            candidates = [ x for x in folders if not x.is_partial ] or folders
+            hub = min(candidates, key=lambda x: x.cabinet.transfer_cost)
+
+        return SyncPlan(hub, [ x for x in folders if x is not hub ])
+
+    def __str__(self):
+        lines = [ "hub    %s (cost %d)" % (self.hub.full_name, self.hub.cabinet.transfer_cost) ]
+
+        for spoke in self.spokes:
+            lines.append("spoke  %s (cost %d)" % (spoke.full_name, spoke.cabinet.transfer_cost))
+
+        return "\n".join(lines) + "\n"
+
+class SyncJournal():
+    """
+    Records the steps of a sync that were completed so that an interrupted
+    sync can resume where it stopped.
+
+    The journal is valid only for a sync with the same clones, it is 
+    discarded otherwise and removed once the sync completes.
+
+    If get_state is not None, it returns the state of the folders being 
+    synced (e.g. the commits of their branches). The state is recorded 
+    with every step and the journal is discarded if the folders changed 
+    since the last recorded step.
+    """
+
+    def __init__(self, path, clones_uuids, get_state=None):
+        self.path = path
+        self.lock = threading.Lock()
+        self.get_state = get_state
+
+        clones_uuids = sorted(clones_uuids)
+
+        self.data = archivist.util.load_json(path, {})
+
+        if self.data.get('clones') != clones_uuids or \
+                (get_state is not None and self.data.get('state') != get_state()):
+            self.data = { 'clones' : clones_uuids, 'done' : [] }
+
+    @property
+    def is_resumed(self):
+        return len(self.data['done']) > 0
+
+    def is_done(self, step, uuid=None):
+        if uuid is not None:
+            step = step + "/" + uuid
+
+        with self.lock:
+            return step in self.data['done']
+
+    def mark(self, step, uuid=None):
+        if uuid is not None:
+            step = step + "/" + uuid
+
+        with self.lock:
+            self.data['done'].append(step)
+            self._save()
+
+    def unmark(self, step, uuid=None):
+        """
+        Makes a step run again, e.g. because a step it depends on was 
+        executed again
+        """
+
+        if uuid is not None:
+            step = step + "/" + uuid
+
+        with self.lock:
+            if step in self.data['done']:
+                self.data['done'].remove(step)
+                self._save()
+
+    def _save(self):
+        if self.get_state is not None:
+            self.data['state'] = self.get_state()
+
+        archivist.util.save_json(self.path, self.data)
+
+    def remove(self):
+        try:
+            os.unlink(self.path)
+        except FileNotFoundError:
+            pass
+
 def RegisterFolderType(clazz):
     folder_types[clazz.type_name] = clazz
 
@@ -34,7 +190,13 @@ class Folder(object):
 
     type_name = "plain"
 
-    creation_args = []
+    creation_args = [ 'storageMode', 'largeFilesSize', 'largeFilesGlobs' ]
+
+    # values used for the creation arguments that are not specified and 
+    # allowed values of the arguments
+    creation_defaults = { 'storageMode' : 'unlocked', 'largeFilesSize' : '', 
+                          'largeFilesGlobs' : '' }
+    creation_choices = { 'storageMode' : STORAGE_MODES }
 
     def __init__(self, cabinet, name, config):
         self.cabinet = cabinet
@@ -45,6 +207,13 @@ class Folder(object):
     def name(self):
         return os.path.relpath(self.storage_path, self.cabinet.access_path)
 
+    @property
+    def full_name(self):
+        """
+        The name of the folder starting with the name of the cabinet
+        """
+        return self.cabinet.name + os.sep + self.name
+
     @property
     def access_path(self):
         return self.storage_path
@@ -63,93 +232,794 @@ class Folder(object):
     def is_mounted(self):
         return True
 
-    def snapshot(self, progress=None):
-        self._do_commit(allowEmpty=True, progress=progress)
+    def lock(self, shared=False, operation=""):
+        return archivist.util.FileLock(os.path.join(self.storage_path, ".git", "archivist.lock"), 
+                                       shared, self.cabinet.archive.lock_timeout, 
+                                       operation + " " + self.full_name)
+
+    def snapshot(self, progress=None, force=False):
+        """
+        Commits the changes in the folder.
+
+        Nothing is done if the working tree didn't change since the last 
+        commit, unless force is True (in which case a commit is always 
+        created).
+        """
+        with lock_folders([self], "snapshot", progress=progress):
+            self._do_commit(allowEmpty=force, progress=progress)
+
+    @property
+    def manifest_path(self):
+        return os.path.join(self.storage_path, ".git", "archivist-manifest")
+
+    def _scan_tree(self):
+        """
+        Returns a dictionary with the size, modification time, inode and 
+        change time of all the files in the working tree
+        """
+
+        files = {}
+        pending = [ "" ]
 
+        while pending:
+            name = pending.pop()
+
+            with os.scandir(os.path.join(self.storage_path, name)) as entries:
+                for entry in entries:
+                    path = os.path.join(name, entry.name)
+
+                    if path == ".git":
+                        continue
+
+                    if entry.is_dir(follow_symlinks=False):
+                        pending.append(path)
+                    else:
+                        st = entry.stat(follow_symlinks=False)
+                        files[path] = [ st.st_size, st.st_mtime_ns, st.st_ino, st.st_ctime_ns ]
+
+        return files
+
+    def _save_manifest(self, files, scan_time):
+        archivist.util.save_json(self.manifest_path, { 'time' : scan_time, 'files' : files })
+
+    def _has_changes(self, files):
+        manifest = archivist.util.load_json(self.manifest_path)
+
+        if manifest is None:
+            return True
+
+        if files != manifest['files']:
+            return True
+
+        # files modified just before the manifest was saved may have been 
+        # modified again without changing the modification time
+        racy_limit = manifest['time'] - 2 * 10**9
+
+        return any(stat[1] >= racy_limit for stat in files.values())
+
+    def has_changes(self):
+        """
+        Returns True if the working tree may contain changes that are not 
+        committed.
+
+        The check compares the size, modification time, inode and change 
+        time of the files with the ones recorded the last time the folder 
+        was committed (like the git index does), it doesn't run git.
+        """
+        return self._has_changes(self._scan_tree())
 
     def _do_commit(self, allowEmpty=False, progress=None):
+        with archivist.profile.phase("commit", folder=self.full_name):
+            self._commit_changes(allowEmpty, progress)
+
+    def _commit_changes(self, allowEmpty, progress):
+
+        # scan before adding so that changes done while adding are detected
+        # the next time
+        scan_time = time.time_ns()
+        files = self._scan_tree()
+
+        if not allowEmpty and not self._has_changes(files):
+            progress and progress.on_progress("Nothing changed, skipping commit\n")
+            return
+
         progress and progress.on_progress("Adding all changes\n")
 
-        archivist.util.exec(['git', 'add', '-v', '--all', '.'], 
-                            wd=self.storage_path, progress=progress)
+        self._add([ '.' ], progress)
+
         progress and progress.on_progress("Committing all changes\n")
         
         cmd = ['git', 'commit', '-q', '-m', 'Snapshot']
 
         if allowEmpty:
-            cmd.append('--allowEmpty')
+            cmd.append('--allow-empty')
         else:
-            changes = subprocess.check_output(['git', 'status', '--porcelain'], cwd=self.storage_path)
+            changes = archivist.util.check_output(['git', 'status', '--porcelain'], wd=self.storage_path)
             if changes.strip() == b'':
                 progress and progress.on_progress("Nothing changed, skipping commit\n")
+                self._save_manifest(files, scan_time)
                 return
         
         archivist.util.exec(cmd, wd=self.storage_path, progress=progress)
 
+        self._save_manifest(files, scan_time)
+
         progress and progress.on_progress("Done\n")
 
 
-    def _do_sync(self, progress=None):
-        archivist.util.exec(['git', 'annex', 'sync', '--content'], 
+    def _refresh_manifest(self, progress=None):
+        """
+        Saves the manifest of the working tree if it has no changes that are
+        not committed (e.g. after merging changes from another folder)
+        """
+
+        scan_time = time.time_ns()
+        files = self._scan_tree()
+
+        changes = archivist.util.check_output(['git', 'status', '--porcelain'], wd=self.storage_path)
+
+        if changes.strip() == b'':
+            self._save_manifest(files, scan_time)
+
+    def _add(self, paths, progress):
+        """
+        Adds the files to the index, the large files (see annex.largefiles)
+        are added to the annex
+        """
+
+        # in v6 repositories git add adds the files unlocked
+        if self.storage_mode == "locked":
+            archivist.util.exec(['git', 'annex', 'add', '--'] + paths, 
+                                wd=self.storage_path, progress=progress)
+
+        archivist.util.exec(['git', 'add', '-v', '--all', '--'] + paths, 
+                            wd=self.storage_path, progress=progress)
+
+    def _git_blobs(self):
+        """
+        Returns the size of the files stored in git (and not in the annex)
+        in HEAD by path
+        """
+
+        output = archivist.util.check_output(['git', 'ls-tree', '-r', '-l', '-z', 'HEAD'], 
+                                             wd=self.storage_path)
+
+        blobs = {}
+
+        for entry in output.decode("utf-8").split("\0"):
+            if not entry:
+                continue
+
+            # <mode> <type> <sha> <size>\t<path>
+            info, path = entry.split("\t", 1)
+            mode, object_type, sha, size = info.split()
+
+            if object_type != "blob" or mode == "120000":
+                continue
+
+            # unlocked annexed files are small pointer files
+            if int(size) < 1024 and (archivist.git.read_blob(self.storage_path, sha) or b"") \
+                    .startswith(b"/annex/objects/"):
+                continue
+
+            blobs[path] = int(size)
+
+        return blobs
+
+    def _large_files_rules(self, paths):
+        """
+        Returns the annex.largefiles expression that applies to each of the
+        paths that have one in .gitattributes
+        """
+
+        if not paths:
+            return {}
+
+        output = archivist.util.check_output(['git', 'check-attr', '-z', 'annex.largefiles', '--'] + paths, 
+                                             wd=self.storage_path)
+
+        fields = output.decode("utf-8").split("\0")
+        rules = {}
+
+        # <path> NUL <attribute> NUL <value> NUL
+        for i in range(0, len(fields) - 2, 3):
+            path, attribute, value = fields[i:i + 3]
+
+            if value not in [ "unspecified", "unset", "set" ]:
+                rules[path] = value
+
+        return rules
+
+    def _is_large_file(self, expression, path, size):
+        # the rules written by _write_large_files_rules() are evaluated 
+        # here, git-annex evaluates the others
+        if expression == "anything":
+            return True
+
+        if expression == "nothing":
+            return False
+
+        if expression.startswith("largerthan="):
+            try:
+                return size > archivist.util.parse_size(expression[len("largerthan="):])
+            except Exception:
+                pass
+
+        try:
+            archivist.util.check_output(['git', 'annex', 'matchexpression', '--largefiles', 
+                                         '--file=' + path, '--size=' + str(size), expression], 
+                                        wd=self.storage_path)
+        except subprocess.CalledProcessError:
+            return False
+
+        return True
+
+    def find_large_blobs(self, threshold=None):
+        """
+        Returns the (path, size) of the files stored in git (and not in the
+        annex) in HEAD that the largefiles rules of the folder put in the 
+        annex or, if threshold is not None, that are larger than threshold 
+        bytes.
+        """
+
+        blobs = self._git_blobs()
+
+        if threshold is not None:
+            return sorted((path, size) for path, size in blobs.items() if size > threshold)
+
+        rules = self._large_files_rules(sorted(blobs))
+
+        return [ (path, blobs[path]) for path in sorted(rules) 
+                    if self._is_large_file(rules[path], path, blobs[path]) ]
+
+    def migrate_large_blobs(self, paths, progress=None):
+        """
+        Moves files stored in git to the annex, the files that don't match 
+        the largefiles rules of the folder are left in git. The history is 
+        not rewritten, the blobs stay in the previous commits.
+        """
+
+        if not paths:
+            return
+
+        with lock_folders([self], "migrate", progress=progress):
+            paths = [ path for path, size in self.find_large_blobs() if path in paths ]
+
+            if not paths:
+                progress and progress.on_progress("No file matches the largefiles rules\n")
+                return
+
+            archivist.util.exec(['git', 'rm', '-q', '--cached', '--'] + paths, 
+                                wd=self.storage_path, progress=progress)
+
+            self._add(paths, progress)
+
+            changed = archivist.util.check_output(['git', 'diff', '--cached', '--name-only', 
+                                                   '-z', 'HEAD', '--'] + paths, 
+                                                  wd=self.storage_path)
+
+            if not changed:
+                progress and progress.on_progress("Nothing changed, skipping commit\n")
+                return
+
+            archivist.util.exec(['git', 'commit', '-q', '-m', 'Moved large files to the annex', 
+                                 '--'] + paths, 
+                                wd=self.storage_path, progress=progress)
+
+    def _do_sync(self, progress=None, clones=None):
+        """
+        Syncs the folder with its remotes, including the content.
+
+        The transfers with the remotes of the clones follow the transfer 
+        settings of the cabinets of the clones.
+
+        If the progress monitor wants structured progress the content is
+        transferred with separate 'git annex get' and 'git annex copy' 
+        commands whose JSON output is used to track each transfer.
+        """
+
+        with archivist.profile.phase("annex sync", folder=self.full_name):
+            self._sync_with_remotes(progress, clones or [])
+
+    def _transfer_settings(self, clones):
+        """
+        Returns the git options that apply the bandwidth limit and the stall
+        detection of the cabinets of the clones to their remotes and the 
+        number of parallel transfers for each remote.
+        """
+
+        options = []
+        jobs = {}
+
+        for clone in clones:
+            name = REMOTE_PREFIX + clone.uuid
+            settings = clone.cabinet.transfer_settings
+
+            for key, option in [ ('bwlimit', 'annex-bwlimit'), 
+                                 ('stallDetection', 'annex-stalldetection') ]:
+                if settings[key]:
+                    options.extend(['-c', 'remote.%s.%s=%s' % (name, option, settings[key])])
+
+            jobs[name] = settings['jobs']
+
+        return options, jobs
+
+    def _jobs_option(self, jobs):
+        # older versions of git-annex don't support -J
+        return [ '-J' + str(jobs) ] if jobs > 1 else []
+
+    def _sync_with_remotes(self, progress, clones):
+        options, jobs = self._transfer_settings(clones)
+
+        # transfers from different remotes share the same jobs
+        max_jobs = max(jobs.values(), default=1)
+
+        if not getattr(progress, "structured", False):
+            archivist.util.exec(['git'] + options + ['annex', 'sync', '--content'] + 
+                                    self._jobs_option(max_jobs), 
+                                wd=self.storage_path, progress=progress)
+            return
+
+        labels = dict((REMOTE_PREFIX + clone.uuid, clone.full_name) for clone in clones)
+
+        tracker = archivist.util.TransferTracker(progress, labels)
+
+        archivist.util.exec(['git'] + options + ['annex', 'sync', '--no-content'], 
                             wd=self.storage_path, progress=progress)
 
-    def sync(self, progress=None):        
+        # like sync --content, --auto is used only for the repositories 
+        # with preferred content, the others get all the content
+        wanted = self._preferred_content()
+
+        archivist.util.exec(['git'] + options + ['annex', 'get', '--json', '--json-progress'] + 
+                                self._auto_option(wanted, self.uuid) + self._jobs_option(max_jobs), 
+                            wd=self.storage_path, progress=tracker)
+
+        for name, remote in self._get_remotes("").items():
+            if remote.get('annex-sync') == 'false' or remote.get('annex-ignore') == 'true':
+                continue
+
+            archivist.util.exec(['git'] + options + ['annex', 'copy', '--to', name, 
+                                 '--json', '--json-progress'] + 
+                                    self._auto_option(wanted, remote.get('annex-uuid')) + 
+                                    self._jobs_option(jobs.get(name, 1)), 
+                                wd=self.storage_path, progress=tracker)
+
+        # let the remotes know about the transferred content
+        archivist.util.exec(['git'] + options + ['annex', 'sync', '--no-content'], 
+                            wd=self.storage_path, progress=progress)
+
+        tracker.report()
+
+    def _preferred_content(self):
+        """
+        Returns the preferred content expressions of the repositories of the
+        group by uuid, read from the git-annex branch
+        """
+
+        log = archivist.git.read_blob(self.storage_path, "git-annex:preferred-content.log")
+
+        wanted = {}
+        timestamps = {}
+
+        for line in (log or b"").decode("utf-8").splitlines():
+            # <uuid> <expression> timestamp=<seconds>s
+            parts = line.split(" ")
+
+            if len(parts) < 3 or not parts[-1].startswith("timestamp=") or \
+                    not parts[-1].endswith("s"):
+                continue
+
+            try:
+                timestamp = float(parts[-1][len("timestamp="):-1])
+            except ValueError:
+                continue
+
+            if timestamp >= timestamps.get(parts[0], 0):
+                timestamps[parts[0]] = timestamp
+                wanted[parts[0]] = " ".join(parts[1:-1])
+
+        return wanted
 
+    def _auto_option(self, wanted, uuid):
+        # --auto alone would only satisfy numcopies for the repositories 
+        # without preferred content while sync --content gives them all
+        # the content
+        return [ '--auto' ] if wanted.get(uuid) else [ '.' ]
+
+    @property
+    def preferred_content(self):
+        """
+        The preferred content expression of the folder (see git-annex 
+        preferred content), None if the folder wants all the content
+        """
+        return self.config.get('folder', 'preferredContent', fallback=None) or None
+
+    @property
+    def is_partial(self):
+        return self.preferred_content not in [ None, "anything" ]
+
+    def _save_config(self):
+        with open(os.path.join(self.storage_path, '.git', 'archivist'), 'w') as configfile:
+           self.config.write(configfile)
+
+    def set_preferred_content(self, expression, progress=None):
+        """
+        Sets the preferred content of the folder, "present" gets new content
+        only on demand (see get()), None gets all the content.
+        """
+
+        with lock_folders([self], "wanted", progress=progress):
+            archivist.util.exec(['git', 'annex', 'wanted', 'here', expression or "anything"], 
+                                wd=self.storage_path, progress=progress)
+
+            if expression:
+                self.config['folder']['preferredContent'] = expression
+            else:
+                self.config.remove_option('folder', 'preferredContent')
+
+            self._save_config()
+
+    def get(self, paths, progress=None):
+        """
+        Gets the content of paths from the accessible clones.
+        """
+
+        clones = [ x for x in self.cabinet.archive.get_group_folders(self.group_uuid, self.clones_uuids)
+                                if x.uuid != self.uuid ]
+
+        with lock_folders([self] + clones, "get", progress=progress):
+            try:
+                self._connect_clones(clones, self.persistent_remotes, progress)
+
+                options, jobs = self._transfer_settings(clones)
+
+                archivist.util.exec(['git'] + options + ['annex', 'get'] + 
+                                        self._jobs_option(max(jobs.values(), default=1)) + 
+                                        [ '--' ] + paths, 
+                                    wd=self.storage_path, progress=progress)
+            finally:
+                if not self.persistent_remotes:
+                    with archivist.util.cancellation(None):
+                        self._disconnect_clones(progress)
+
+    def _merge(self, progress=None):
+        """
+        Merges the changes pushed to the folder by another folder without 
+        contacting the remotes.
+        """
+
+        with archivist.profile.phase("merge", folder=self.full_name):
+            archivist.util.exec(['git', 'annex', 'sync', '--no-content', '--no-pull', '--no-push'], 
+                                wd=self.storage_path, progress=progress)
+
+    def _for_each_clone(self, clones, action, progress=None, jobs=1):
+        """
+        Runs action on all the clones using at most jobs threads.
+
+        The function returns only once the action completed on all the 
+        clones, if it failed on any of them the first error is raised.
+        """
+
+        lock = threading.Lock()
+
+        def run(clone):
+            clone_progress = progress
+
+            if progress is not None and jobs > 1:
+                clone_progress = archivist.util.PrefixedProgress(progress, 
+                            "[" + clone.full_name + "] ", lock)
+
+            action(clone, clone_progress)
+
+        for clone, error in archivist.util.run_parallel(clones, run, jobs):
+            if error is not None:
+                raise error
+
+    @property
+    def persistent_remotes(self):
+        return self.config.getboolean('folder', 'persistentRemotes', fallback=False)
+
+    def _get_remotes(self, prefix=REMOTE_PREFIX):
+        """
+        Returns the configuration of the remotes whose name starts with 
+        prefix (by default the remotes managed by archivist).
+
+        The result is a dictionary that maps the name of each remote to a 
+        dictionary with its configuration (e.g. url, annex-sync).
+        """
+
+        remotes = {}
+
+        for key, value in archivist.git.get_config_all(self.storage_path).items():
+            if not key.startswith("remote." + prefix):
+                continue
+
+            name, option = key[len("remote."):].rsplit(".", 1)
+            remotes.setdefault(name, {})[option] = value
+
+        return remotes
+
+    def _connect_clones(self, clones, persistent, progress=None, journal=None):
+        """
+        Makes sure there is an up to date remote for each of the clones.
+
+        Existing remotes are fetched incrementally, unless the journal says 
+        they were fetched by the interrupted sync we are resuming. If 
+        persistent is True the remotes of clones that are not accessible are
+        kept but excluded from sync, remotes of folders that are not clones
+        anymore are removed.
+        """
+
+        remotes = self._get_remotes()
+
+        for clone in clones :
+            remote = remotes.get(REMOTE_PREFIX + clone.uuid, {})
+
+            if journal is not None and journal.is_done("connect", clone.uuid) and \
+                    remote.get('url') == clone.storage_path and \
+                    remote.get('annex-sync') != 'false':
+                continue
+
+            with archivist.profile.phase("connect", folder=clone.full_name):
+                self._connect_clone(clone, remotes, progress)
+
+            if journal is not None:
+                # the steps using the remote must run again
+                journal.unmark("annex sync")
+                journal.unmark("sync", clone.uuid)
+                journal.mark("connect", clone.uuid)
+
+        if not persistent:
+            return
+
+        connected = [ REMOTE_PREFIX + clone.uuid for clone in clones ]
         clones_uuids = self.clones_uuids
 
-        syncable_folders = self.cabinet.archive.syncable_folders
+        for name, remote in remotes.items():
+            if name in connected:
+                continue
 
-        syncable_clones = [ x for x in syncable_folders if x.group_uuid == self.group_uuid and x.uuid != self.uuid]
+            if name[len(REMOTE_PREFIX):] not in clones_uuids:
+                archivist.util.exec(['git', 'remote', 'remove', name], 
+                                    wd=self.storage_path, progress=progress)
+            elif remote.get('annex-sync') != 'false':
+                archivist.util.exec(['git', 'config', 'remote.' + name + '.annex-sync', 'false'], 
+                                    wd=self.storage_path, progress=progress)
 
-        progress and progress.on_progress("Connecting with all accessible clones\n")
+    def _connect_clone(self, clone, remotes, progress):
+        name = REMOTE_PREFIX + clone.uuid
 
-        for clone in syncable_clones :
-            archivist.util.exec(['git', 'remote', 'add', '-f', 'archivist.' + clone.uuid, clone.storage_path], 
+        if name not in remotes:
+            archivist.util.exec(['git', 'remote', 'add', '-f', name, clone.storage_path], 
                                 wd=self.storage_path, progress=progress)
+            return
+
+        # the clone may be accessible at a different path than the last 
+        # time (e.g. the cabinet was moved)
+        if remotes[name].get('url') != clone.storage_path:
+            archivist.util.exec(['git', 'remote', 'set-url', name, clone.storage_path], 
+                                wd=self.storage_path, progress=progress)
+
+        if remotes[name].get('annex-sync') == 'false':
+            archivist.util.exec(['git', 'config', 'remote.' + name + '.annex-sync', 'true'], 
+                                wd=self.storage_path, progress=progress)
+
+        archivist.util.exec(['git', 'fetch', name], 
+                            wd=self.storage_path, progress=progress)
+
+    def _disconnect_clones(self, progress=None):
+        # all the remotes are removed, including the ones left behind by an 
+        # interrupted sync with clones that are not accessible anymore
+        for name in self._get_remotes():
+            archivist.util.exec(['git', 'remote', 'remove', name], 
+                                wd=self.storage_path, progress=progress)
+
+    def plan_sync(self, topology="hub"):
+        """
+        Returns the SyncPlan to sync the folder with its accessible clones
+        """
+
+        group_folders = self.cabinet.archive.get_group_folders(self.group_uuid, self.clones_uuids)
+
+        return SyncPlan.create(self, [ x for x in group_folders if x.uuid != self.uuid ], topology)
+
+    def sync(self, progress=None, jobs=1, persistent_remotes=None, topology="hub"):
+
+        plan = self.plan_sync(topology)
+
+        if persistent_remotes is None:
+            persistent_remotes = plan.hub.persistent_remotes
+
+        progress and progress.on_progress("Sync plan:\n" + str(plan))
+
+        with archivist.profile.phase("sync", folder=self.full_name, hub=plan.hub.full_name):
+            plan.hub._sync_with_clones(plan.spokes, progress, jobs, persistent_remotes)
+
+    def _sync_with_clones(self, syncable_clones, progress, jobs, persistent_remotes):
+
+        with lock_folders([self] + syncable_clones, "sync", progress=progress):
+            self._sync_with_locked_clones(syncable_clones, progress, jobs, persistent_remotes)
+
+    @property
+    def ledger_path(self):
+        return os.path.join(self.storage_path, ".git", "archivist-ledger")
+
+    @property
+    def sync_state(self):
+        """
+        The commits of HEAD and of the git-annex branch, read without 
+        running git when possible
+        """
+
+        return { 'head' : archivist.git.resolve(self.storage_path, "HEAD"), 
+                 'annex' : archivist.git.resolve(self.storage_path, "refs/heads/git-annex") }
+
+    def _load_ledger(self):
+        return archivist.util.load_json(self.ledger_path, {})
+
+    def _save_ledger(self, clones):
+        """
+        Records the state of the folder and of the clones after a sync
+        """
+
+        ledger = self._load_ledger()
+        state = self.sync_state
+
+        for clone in clones:
+            ledger[clone.uuid] = { 'self' : state, 'clone' : clone.sync_state }
+
+        archivist.util.save_json(self.ledger_path, ledger)
+
+    def _is_up_to_date(self, clones):
+        """
+        Returns True if nothing changed in the folder and in the clones 
+        since they were last synced with each other.
+
+        A change in a single clone makes all the clones out of date, the 
+        changes are propagated to all of them through this folder.
+        """
+
+        ledger = self._load_ledger()
+        state = self.sync_state
+
+        for clone in clones:
+            entry = ledger.get(clone.uuid)
+
+            if entry is None or entry['self'] != state or entry['clone'] != clone.sync_state:
+                return False
+
+        return not any(folder.has_changes() for folder in [self] + clones)
+
+    def _sync_with_locked_clones(self, syncable_clones, progress, jobs, persistent_remotes):
+
+        if self._is_up_to_date(syncable_clones):
+            progress and progress.on_progress("Nothing changed since the last sync\n")
+            return
+
+        try:
+            self._sync_with_connected_clones(syncable_clones, progress, jobs, persistent_remotes)
+        finally:
+            # the temporary remotes are removed also if the sync failed or 
+            # was cancelled
+            if not persistent_remotes:
+                progress and progress.on_progress("Disconnecting from clones\n")
+
+                with archivist.profile.phase("disconnect clones"), \
+                        archivist.util.cancellation(None):
+                    self._disconnect_clones(progress)
+
+        progress and progress.on_progress("Done")
+
+    @property
+    def journal_path(self):
+        return os.path.join(self.storage_path, ".git", "archivist-sync-journal")
+
+    def _run_step(self, journal, step, action, uuid=None):
+        if journal.is_done(step, uuid):
+            return
+
+        action()
+
+        journal.mark(step, uuid)
+
+    def _sync_with_connected_clones(self, syncable_clones, progress, jobs, persistent_remotes):
+
+        folders = [ self ] + syncable_clones
+
+        # an interrupted sync is resumed only if the folders didn't change
+        # after it stopped
+        get_state = lambda: dict((x.uuid, x.sync_state) for x in folders)
+
+        journal = SyncJournal(self.journal_path, [ x.uuid for x in syncable_clones ], get_state)
+
+        if journal.is_resumed:
+            progress and progress.on_progress("Resuming interrupted sync\n")
+
+        progress and progress.on_progress("Connecting with all accessible clones\n")
+
+        with archivist.profile.phase("connect clones"):
+            self._connect_clones(syncable_clones, persistent_remotes, progress, journal)
 
         # in order to sync we need to make sure all changes are commited on all clones
-        for clone in syncable_clones :
-            clone._do_commit(progress)
+        with archivist.profile.phase("commit clones"):
+            self._for_each_clone(syncable_clones, 
+                                    lambda clone, progress: self._run_step(journal, "commit", 
+                                        lambda: clone._do_commit(progress=progress), clone.uuid), 
+                                    progress, jobs)
 
         # save all local changes too
-        self._do_commit(progress)
+        self._run_step(journal, "commit", lambda: self._do_commit(progress=progress))
+
+        committed = dict((x.uuid, x.sync_state['head']) for x in folders)
 
         progress and progress.on_progress("Performing sync\n")
 
-        self._do_sync(progress)
+        self._run_step(journal, "annex sync", lambda: self._do_sync(progress, syncable_clones))
 
-        # we need to sync on the remotes to make changes appear also there
-        for clone in syncable_clones :
-            clone._do_sync(progress)
+        # the clones need to merge the changes we pushed to make them appear
+        # there, the content was already transferred
+        with archivist.profile.phase("merge clones"):
+            self._for_each_clone(syncable_clones, 
+                                    lambda clone, progress: self._run_step(journal, "sync", 
+                                        lambda: clone._merge(progress), clone.uuid), 
+                                    progress, jobs)
 
-        progress and progress.on_progress("Disconnecting from clones\n")
+        # the merges changed the working trees after the commits saved 
+        # their manifests
+        merged = [ x for x in folders if x.sync_state['head'] != committed[x.uuid] ]
 
-        for clone in syncable_clones :
-            archivist.util.exec(['git', 'remote', 'remove', 'archivist.' + clone.uuid], 
-                                wd=self.storage_path, progress=progress)
+        self._for_each_clone(merged, lambda folder, progress: folder._refresh_manifest(progress), 
+                             progress, jobs)
 
-        progress and progress.on_progress("Done")
+        self._save_ledger(syncable_clones)
+
+        journal.remove()
 
 
     def _init_annex(cls, dirname, args, progress):
+        storage_mode = args.setdefault('storageMode', 'unlocked')
+
+        if storage_mode not in STORAGE_MODES:
+            raise Exception("Unsupported storage mode " + storage_mode)
+
         archivist.util.exec(['git', 'annex', 'init', '--version=6'], 
                 wd=dirname, progress=progress)
 
+        # on a crippled file system (no symlinks, e.g. FAT) git-annex keeps
+        # the folder on the adjusted branch, locked files can't work there
+        if storage_mode == "locked" and \
+                archivist.git.get_config(dirname, "annex.crippledfilesystem") == "true":
+            raise Exception("Locked mode is not supported on this file system")
+
+        if storage_mode == "thin":
+            archivist.util.exec(['git', 'config', 'annex.thin', 'true'], 
+                    wd=dirname, progress=progress)
+
+        if args.get('preferredContent'):
+            archivist.util.exec(['git', 'annex', 'wanted', 'here', args['preferredContent']], 
+                    wd=dirname, progress=progress)
+
         # create first commit so that we are sure we can switch to the adjusted branch
         archivist.util.exec(['git', 'commit', '--allow-empty', '-m', 'Created folder', '-q'], 
                 wd=dirname, progress=progress)
 
         # get the current HEAD
-        with open(os.path.join(dirname, ".git", "HEAD")) as fp:
-            branch = fp.read().strip()
+        branch = archivist.git.head(dirname)
 
         # if the repo is not in adjusted unlocked mode switch to it
         # it may be in adjusted unlocked mode if git-annex detected
         # a crippled filesystem
-        if branch != "ref: refs/heads/adjusted/master(unlocked)":
+        if storage_mode != "locked" and branch != "refs/heads/adjusted/master(unlocked)":
             archivist.util.exec(['git', 'annex', 'adjust', '--unlock'], 
                     wd=dirname, progress=progress)
 
+        # a clone of an unlocked folder starts on the adjusted branch of 
+        # the origin, locked folders work on master
+        if storage_mode == "locked" and branch.startswith("refs/heads/adjusted/"):
+            archivist.util.exec(['git', 'checkout', '-q', 'master'], 
+                    wd=dirname, progress=progress)
+
         config = configparser.ConfigParser()
 
         args['type'] = cls.type_name
@@ -158,26 +1028,110 @@ class Folder(object):
         with open(os.path.join(dirname, '.git', 'archivist'), 'w') as configfile:
            config.write(configfile)
 
-    def clone(self, dest_cabinet, dest_name, progress=None):
+    def _is_local_to(self, cabinet):
+        """
+        Returns True if the folder is on the same file system as the cabinet
+        """
+        return os.stat(self.storage_path).st_dev == os.stat(cabinet.access_path).st_dev
+
+    def _get_local_content(self, dirname, storage_mode, preferred_content, progress):
+        """
+        Gets the content of a clone just created on the same file system
+        from this folder, sharing the data if possible.
+
+        git-annex uses copy on write (reflink) copies where the file system 
+        supports them and hard links the content if annex.hardlink is set.
+        The content is not hard linked if this folder or the clone are in 
+        thin mode, the working tree files would be shared too.
+
+        A clone with hard linked content doesn't hold an independent copy of
+        it, so the clone is untrusted and doesn't count towards numcopies.
+
+        Only a clone with preferred_content gets the matching content, the 
+        others get all the content (see _auto_option()).
+        """
+
+        options = []
+
+        if archivist.git.get_config(self.storage_path, "annex.thin") != "true" and \
+                storage_mode != "thin":
+            options = ['-c', 'annex.hardlink=true']
+
+            archivist.util.exec(['git', 'annex', 'untrust', 'here'], 
+                                wd=dirname, progress=progress)
+
+        with archivist.profile.phase("get local content", folder=self.full_name):
+            archivist.util.exec(['git'] + options + ['annex', 'get', '--from', 'origin'] + 
+                                    self._auto_option({ 'here' : preferred_content }, 'here'), 
+                                wd=dirname, progress=progress)
+
+    def clone(self, dest_cabinet, dest_name, progress=None, shared=False, storage_mode=None, 
+              preferred_content=None):
+        """
+        Creates a clone of the folder in dest_cabinet.
+
+        If preferred_content is not None the clone is partial: it gets only
+        the content matching the expression ("present" to get the content 
+        only on demand).
+
+        The clone uses the same storage mode as the folder unless 
+        storage_mode is specified.
+
+        If the destination is on the same file system the git objects are
+        hard linked (or shared with the folder if shared is True, see 
+        'git clone --shared') and the content is shared when possible.
+        """
+
         progress and progress.on_progress("Cloning folder\n")
 
-        dirname = dest_cabinet.reserve_folder_name(dest_name)
+        # the source only needs to be stable while it is cloned, the sync
+        # below takes the locks it needs
+        with lock_folders([self], "clone", shared=True, cabinets=[dest_cabinet], 
+                          progress=progress):
+            local = self._is_local_to(dest_cabinet)
+
+            if shared and not local:
+                raise Exception("Cannot share the objects with a clone on a different file system")
+
+            dirname = dest_cabinet.reserve_folder_name(dest_name)
+
+            cmd = ['git', 'clone']
+
+            if local:
+                cmd.append('--shared' if shared else '--local')
+
+            with archivist.profile.phase("clone", folder=self.full_name, destination=dirname):
+                archivist.util.exec(cmd + [self.storage_path, dirname], progress=progress)
 
-        archivist.util.exec(['git', 'clone', self.storage_path, dirname], 
-                            progress=progress)
+            storage_mode = storage_mode or self.storage_mode
 
-        args = {'groupUuid' : self.group_uuid}
-        type(self)._init_annex(type(self), dirname, args, progress)
+            args = {'groupUuid' : self.group_uuid, 'storageMode' : storage_mode}
 
-        dest_cabinet.get_folder(dest_name).sync(progress)
+            if preferred_content:
+                args['preferredContent'] = preferred_content
+
+            type(self)._init_annex(type(self), dirname, args, progress)
+
+            if local:
+                self._get_local_content(dirname, storage_mode, preferred_content, progress)
+
+            dest_cabinet.update_index()
+
+        clone = dest_cabinet.get_folder(dest_name)
+
+        self.cabinet.archive.register_folder(self)
+        self.cabinet.archive.register_folder(clone)
+
+        clone.sync(progress)
 
         progress and progress.on_progress("Done")
     
     @property
     def clones_uuids(self):
-        remotes = subprocess.check_output(
-                        ["git", "cat-file", "blob", "git-annex:uuid.log"], 
-                         cwd=self.storage_path)
+        remotes = archivist.git.read_blob(self.storage_path, "git-annex:uuid.log")
+
+        if remotes is None:
+            raise Exception("Cannot find the list of clones")
 
         uuids = []
 
@@ -190,9 +1144,18 @@ class Folder(object):
     def group_uuid(self):
         return self.config['folder']['groupUuid']
 
+    @property
+    def storage_mode(self):
+        return self.config.get('folder', 'storageMode', fallback='unlocked')
+
     @property
     def uuid(self):
-        return subprocess.check_output(["git", "config", "annex.uuid"], cwd=self.storage_path).decode("utf-8").strip()
+        uuid = archivist.git.get_config(self.storage_path, "annex.uuid")
+
+        if uuid is None:
+            raise Exception("Folder without annex uuid")
+
+        return uuid
 
     @classmethod
     def load(cls, cabinet, name, config):
@@ -201,15 +1164,54 @@ class Folder(object):
     @classmethod
     def create(cls, cabinet, name, args, progress=None):
 
+        if args.get('storageMode', 'unlocked') not in STORAGE_MODES:
+            raise Exception("Unsupported storage mode " + args['storageMode'])
+
+        if args.get('largeFilesSize'):
+            archivist.util.parse_size(args['largeFilesSize'])
+
+            # the size ends up in an attribute value, it cannot contain spaces
+            args['largeFilesSize'] = "".join(args['largeFilesSize'].split())
+
         dirname = cabinet.reserve_folder_name(name)
 
         archivist.util.exec(['git', 'init', '.'], 
                 wd=dirname, progress=progress)
 
+        # uuid is slow to import and only needed here
+        import uuid
+
         args["groupUuid"] = uuid.uuid4()
 
+        cls._write_large_files_rules(dirname, args, progress)
+
         cls._init_annex(cls, dirname, args, progress)
 
+    @classmethod
+    def _write_large_files_rules(cls, dirname, args, progress):
+        """
+        Writes the annex.largefiles rules in .gitattributes: the files larger
+        than largeFilesSize and the files matching largeFilesGlobs (separated
+        by spaces) go to the annex, the others to git. The rules are 
+        committed with the folder, the clones share them.
+        """
+
+        # attribute values cannot contain spaces ("1.5 GiB" -> "1.5GiB")
+        size = "".join((args.get('largeFilesSize') or '').split())
+        globs = (args.get('largeFilesGlobs') or '').split()
+
+        if not size and not globs:
+            return
+
+        # later lines take precedence, attribute values cannot contain spaces
+        lines = [ "* annex.largefiles=" + ("largerthan=" + size if size else "nothing") ]
+        lines.extend(glob + " annex.largefiles=anything" for glob in globs)
+
+        with open(os.path.join(dirname, ".gitattributes"), "w") as fp:
+            fp.write("\n".join(lines) + "\n")
+
+        archivist.util.exec(['git', 'add', '.gitattributes'], wd=dirname, progress=progress)
+
 
 
 RegisterFolderType(Folder)
@@ -232,21 +1234,25 @@ class EncryptedFolder(Folder):
 
     def mount(self, progress=None):
 
-        if self.is_mounted:
-            raise Exception("Already mounted")
+        # the lock of the folder is inside the folder, the cabinet lock 
+        # serializes mounts and unmounts with the other operations
+        with archivist.util.LockSet([self.cabinet.lock(operation="mount " + self.full_name)], progress):
+            if self.is_mounted:
+                raise Exception("Already mounted")
 
-        if not os.path.isdir(self.access_path):
-            os.makedirs(self.access_path)
+            if not os.path.isdir(self.access_path):
+                os.makedirs(self.access_path)
 
-        archivist.util.exec(['encfs', '--extpass=/usr/libexec/openssh/gnome-ssh-askpass',
-                                 '-i', '10', '-S', self.storage_path, self.access_path],
-                                    progress=progress)
+            archivist.util.exec(['encfs', '--extpass=/usr/libexec/openssh/gnome-ssh-askpass',
+                                     '-i', '10', '-S', self.storage_path, self.access_path],
+                                        progress=progress, new_session=False)
 
     def unmount(self, progress=None):
-        archivist.util.exec(['fusermount', '-u', self.access_path], progress=progress)
+        with archivist.util.LockSet([self.cabinet.lock(operation="unmount " + self.full_name)], progress):
+            archivist.util.exec(['fusermount', '-u', self.access_path], progress=progress)
 
-        if os.listdir(self.access_path) == []:
-            os.rmdir(self.access_path)
+            if os.listdir(self.access_path) == []:
+                os.rmdir(self.access_path)
 
     @property
     def is_mounted(self):
@@ -269,10 +1275,37 @@ class Cabinet(object):
     type_name = "plain"
     creation_args = ['storagePath']
 
-    def __init__(self, archive, name, storage_path):
+    # relative cost of moving content to and from the cabinet, it can be 
+    # changed with transferCost in the cabinet section of the configuration
+    default_transfer_cost = 1
+
+    def __init__(self, archive, name, storage_path, config=None):
         self.archive = archive
         self.name = name
         self.storage_path = storage_path
+        self.config = config or configparser.ConfigParser()
+
+    # transfer settings used if the configuration doesn't have them: the
+    # number of parallel transfers, the bandwidth limit and the stall 
+    # detection (in the format of git-annex, e.g. "10MiB" and "1KiB/1m")
+    transfer_args = [ 'jobs', 'bwlimit', 'stallDetection' ]
+    default_transfer_settings = { 'jobs' : '1', 'bwlimit' : '', 'stallDetection' : '' }
+
+    @property
+    def transfer_cost(self):
+        return self.config.getint("cabinet", "transferCost", fallback=self.default_transfer_cost)
+
+    @property
+    def transfer_settings(self):
+        settings = dict(self.default_transfer_settings)
+
+        if self.config.has_section("transfer"):
+            settings.update((key, self.config["transfer"][key]) for key in self.transfer_args 
+                                                            if key in self.config["transfer"])
+
+        settings['jobs'] = int(settings['jobs'])
+
+        return settings
 
     @property
     def access_path(self):
@@ -292,6 +1325,10 @@ class Cabinet(object):
     def is_mounted(self):
         return True
 
+    def lock(self, shared=False, operation=""):
+        return archivist.util.FileLock(os.path.join(self.archive.path, "locks", self.name + ".lock"), 
+                                       shared, self.archive.lock_timeout, operation)
+
     def reserve_folder_name(self, name):
         """
         Reserves a folder name
@@ -336,45 +1373,197 @@ class Cabinet(object):
         return folder_types[folder_type].load(self, name, config)
 
     @property
-    def folders(self):
+    def index_path(self):
+        return os.path.join(self.archive.index_path, self.name)
+
+    def _load_index(self):
+        return archivist.util.load_json(self.index_path, { 'dirs' : {}, 'folders' : [] })
+
+    def _save_index(self, index):
+        os.makedirs(os.path.dirname(self.index_path), exist_ok=True)
+
+        archivist.util.save_json(self.index_path, index)
+
+    def update_index(self, rescan=False):
+        """
+        Updates the index of the locations of the folders in the cabinet.
+
+        The index stores the modification time and the subdirectories of 
+        every directory that is not a folder. Only the directories that were
+        modified since the last update are listed again, the others are just
+        checked with a stat. If rescan is True the whole cabinet is walked 
+        again.
+
+        Returns the list of the names of the folders in the cabinet.
+        """
 
         if not self.is_mounted:
             raise Exception("Not cabinet mounted")
 
+        index = { 'dirs' : {}, 'folders' : [] } if rescan else self._load_index()
+
+        known_dirs = index['dirs']
+        known_folders = set(index['folders'])
+
+        dirs = {}
         folders = []
 
-        # search for all the folders in the cabinet
-        for dirpath, dirnames, filenames in os.walk(self.access_path):
+        # directories modified less than this ago may be modified again 
+        # without changing their modification time, they are listed again 
+        # the next time
+        racy_limit = time.time_ns() - 2 * 10**9
+
+        pending = [ "." ]
 
-            folder = self.get_folder(os.path.relpath(dirpath, self.access_path))
+        while pending:
+            name = pending.pop()
+            path = os.path.join(self.access_path, name)
 
-            if folder is None:
+            if name in known_folders and os.path.isfile(os.path.join(path, ".git", "archivist")):
+                folders.append(name)
                 continue
 
-            # don't walk into subdirs
-            del dirnames[:]
+            try:
+                st = os.stat(path)
+            except FileNotFoundError:
+                continue
 
-            folders.append(folder)
+            known = known_dirs.get(name)
+
+            if known is not None and known['mtime'] == st.st_mtime_ns:
+                subdirs = known['subdirs']
+            else:
+                # creating a folder modifies the directory (.git is added)
+                if os.path.isfile(os.path.join(path, ".git", "archivist")):
+                    folders.append(name)
+                    continue
+
+                with os.scandir(path) as entries:
+                    subdirs = [ entry.name for entry in entries 
+                                    if entry.is_dir(follow_symlinks=False) ]
+
+            dirs[name] = { 'mtime' : st.st_mtime_ns if st.st_mtime_ns < racy_limit else None, 
+                           'subdirs' : subdirs }
+
+            pending.extend(os.path.normpath(os.path.join(name, subdir)) for subdir in subdirs)
+
+        folders.sort()
+
+        if dirs != known_dirs or folders != index['folders']:
+            self._save_index({ 'dirs' : dirs, 'folders' : folders })
 
         return folders
 
-    def sync(self, progress=None):
+    def get_folders(self, rescan=False):
+
+        folders = []
+
+        for name in self.update_index(rescan):
+            folder = self.get_folder(name)
+
+            if folder is not None:
+                folders.append(folder)
+
+        return folders
+
+    @property
+    def folders(self):
+        return self.get_folders()
+
+    def _run_on_folders(self, verb, groups, action, progress=None, jobs=1):
+        """
+        Runs action on all the folders in groups using at most jobs threads.
+
+        The folders in a group are processed sequentially, different groups
+        are processed concurrently. A failure on a folder doesn't stop the 
+        processing of the others, a summary is sent to the progress monitor
+        at the end.
+
+        Returns a list of (folder, exception) tuples, the exception is None
+        if the action succeeded on the folder.
+        """
+
+        lock = threading.Lock()
+        errors = {}
+
+        def run_group(folders):
+            for folder in folders:
+                folder_progress = progress
+
+                # prefix the output with the folder name so that the output
+                # of concurrent operations can be told apart
+                if progress is not None and jobs > 1:
+                    folder_progress = archivist.util.PrefixedProgress(progress, 
+                                                "[" + folder.name + "] ", lock)
+
+                folder_progress and folder_progress.on_progress(verb + " " + folder.name + "\n")
+
+                try:
+                    # once cancelled the remaining folders are not started
+                    archivist.util.check_cancelled()
+
+                    with archivist.profile.phase(verb, folder=folder.full_name):
+                        action(folder, folder_progress)
+                except Exception as e:
+                    folder_progress and folder_progress.on_error(str(e) + "\n")
+                    errors[folder] = e
+
+        archivist.util.run_parallel(groups, run_group, jobs)
+
+        results = [ (folder, errors.get(folder)) for group in groups for folder in group ]
+
+        if progress is not None:
+            progress.on_progress("Summary:\n")
+
+            for folder, error in results:
+                if error is None:
+                    progress.on_progress("  ok      " + folder.name + "\n")
+                else:
+                    progress.on_error("  failed  " + folder.name + ": " + str(error) + "\n")
+
+        return results
+
+    def sync(self, progress=None, jobs=1, clone_jobs=1, persistent_remotes=None, topology="hub"):
 
         if not self.is_mounted:
             raise Exception("Not cabinet mounted")
 
+        # folders of the same group sync with each other, they cannot be
+        # synched concurrently
+        groups = {}
+
         for folder in self.folders:
-            progress and progress.on_progress("Synching " + folder.name + "\n")
-            folder.sync(progress)
+            groups.setdefault(folder.group_uuid, []).append(folder)
+
+        results = self._run_on_folders("Synching", list(groups.values()), 
+                                        lambda folder, progress: folder.sync(progress, clone_jobs, 
+                                                                    persistent_remotes, topology), 
+                                        progress, jobs)
 
-    def snapshot(self, progress=None):
+        failures = [ (folder, error) for folder, error in results if error is not None ]
+
+        if failures:
+            raise FolderOperationError(failures)
+
+        return results
+
+    def snapshot(self, progress=None, jobs=1, force=False):
 
         if not self.is_mounted:
             raise Exception("Not cabinet mounted")
 
-        for folder in self.folders:
-            progress and progress.on_progress("Snapshotting " + folder.name + "\n")
-            folder.snapshot(progress)
+        groups = [ [folder] for folder in self.folders ]
+
+        results = self._run_on_folders("Snapshotting", groups, 
+                                        lambda folder, progress: folder.snapshot(progress, force), 
+                                        progress, jobs)
+
+        failures = [ (folder, error) for folder, error in results if error is not None ]
+
+        if failures:
+            raise FolderOperationError(failures)
+
+        return results
 
     def create_folder(self, name, folder_type, args, progress=None):
 
@@ -386,6 +1575,10 @@ class Cabinet(object):
 
         folder_types[folder_type].create(self, name, args, progress)
 
+        self.update_index()
+
+        self.archive.register_folder(self.get_folder(name))
+
     @classmethod
     def load(cls, archive, config, name):
 
@@ -394,11 +1587,12 @@ class Cabinet(object):
         if storage_path is None:
             raise Exception("Invalid storage path")
 
-        return Cabinet(archive, name, storage_path)
+        return Cabinet(archive, name, storage_path, config)
 
 
     @classmethod
-    def create(cls, archive, name, args):
+    def create(cls, archive, name, args, transfer=None):
+        transfer = transfer or {}
 
         if os.path.dirname(name) != "":
             raise Exception("Invalid name")
@@ -407,6 +1601,10 @@ class Cabinet(object):
             if arg not in args:
                 raise Exception("Argument %s missing" % arg)
 
+        for arg in transfer:
+            if arg not in cls.transfer_args:
+                raise Exception("Unsupported transfer setting %s" % arg)
+
         config_path = os.path.join(archive.cabinets_path, name)
 
         config = configparser.ConfigParser()
@@ -414,6 +1612,10 @@ class Cabinet(object):
         config["cabinet"] = { 'type' : cls.type_name}
         config["backend"] = args
 
+        config["transfer"] = cls.default_transfer_settings
+        config["transfer"].update((key, str(value)) for key, value in transfer.items() 
+                                                            if value is not None)
+
         with open(config_path, "w") as fp:
             config.write(fp)
 
@@ -424,11 +1626,17 @@ class SshFsCabinet(Cabinet):
     type_name = "sshfs"
     creation_args = ['host', 'path']
 
-    def __init__(self, archive, name, host, path):
+    default_transfer_cost = 10
+
+    # sshfs is latency bound, parallel transfers hide the latency
+    default_transfer_settings = { 'jobs' : '4', 'bwlimit' : '', 'stallDetection' : '' }
+
+    def __init__(self, archive, name, host, path, config=None):
         self.archive = archive
         self.name = name
         self.host = host
         self.path = path
+        self.config = config or configparser.ConfigParser()
 
     @property
     def access_path(self):
@@ -439,19 +1647,24 @@ class SshFsCabinet(Cabinet):
         return True
 
     def mount(self, progress=None):
-        if self.is_mounted:
-            raise Exception("Already mounted")
+        with archivist.util.LockSet([self.lock(operation="mount " + self.name)], progress):
+            if self.is_mounted:
+                raise Exception("Already mounted")
 
-        if not os.path.isdir(self.access_path):
-            os.makedirs(self.access_path)
+            if not os.path.isdir(self.access_path):
+                os.makedirs(self.access_path)
 
-        archivist.util.exec(['sshfs', self.host + ":" + self.path, self.access_path], progress=progress)
+            # ssh may ask the password on the terminal
+            archivist.util.exec(['sshfs', self.host + ":" + self.path, self.access_path], 
+                                    progress=progress, new_session=False)
 
     def unmount(self, progress=None):
-        archivist.util.exec(['fusermount', '-u', self.access_path], progress=progress)
+        # waits for the operations on the folders of the cabinet
+        with archivist.util.LockSet([self.lock(operation="unmount " + self.name)], progress):
+            archivist.util.exec(['fusermount', '-u', self.access_path], progress=progress)
 
-        if os.listdir(self.access_path) == []:
-            os.rmdir(self.access_path)
+            if os.listdir(self.access_path) == []:
+                os.rmdir(self.access_path)
 
     @property
     def is_mounted(self):
@@ -469,7 +1682,7 @@ class SshFsCabinet(Cabinet):
         if path is None:
             raise Exception("Invalid path")
 
-        return SshFsCabinet(archive, name, host, path)
+        return SshFsCabinet(archive, name, host, path, config)
 
 RegisterCabinetType(SshFsCabinet)
 
@@ -477,12 +1690,20 @@ DEFAULT_ARCHIVE_PATH = os.path.expanduser("~/.archivist")
 
 class Archive(object):
 
-    def __init__(self, path=DEFAULT_ARCHIVE_PATH):
+    def __init__(self, path=DEFAULT_ARCHIVE_PATH, lock_timeout=None):
         self.path = path
 
+        # seconds to wait for the locks of cabinets and folders, None waits
+        # forever
+        self.lock_timeout = lock_timeout
+
     def get_cabinet_wd(self, cabinet):
         return os.path.join(self.path, "workdir", cabinet.name)
 
+    @property
+    def index_path(self):
+        return os.path.join(self.path, "index")
+
     @property
     def syncable_folders(self):
 
@@ -496,6 +1717,155 @@ class Archive(object):
 
         return syncable_folders
 
+    @property
+    def groups_path(self):
+        return os.path.join(self.path, "groups")
+
+    def _groups_lock(self):
+        # serializes the updates of the index of the groups, also between 
+        # processes (e.g. the daemon and the CLI)
+        return archivist.util.FileLock(self.groups_path + ".lock", operation="update groups")
+
+    def _load_groups(self):
+        return archivist.util.load_json(self.groups_path, {})
+
+    def _save_groups(self, groups):
+        archivist.util.save_json(self.groups_path, groups)
+
+    def register_folder(self, folder):
+        """
+        Records the location of a folder in the index of the groups
+        """
+
+        with self._groups_lock():
+            groups = self._load_groups()
+
+            group = groups.setdefault(folder.group_uuid, { 'clones' : [] })
+
+            group['clones'] = [ x for x in group['clones'] if x['uuid'] != folder.uuid ]
+            group['clones'].append({ 'cabinet' : folder.cabinet.name, 
+                                     'name' : folder.name, 
+                                     'uuid' : folder.uuid })
+
+            self._save_groups(groups)
+
+    def update_groups_index(self):
+        """
+        Searches all the accessible cabinets and records the location of all
+        the folders in the index of the groups.
+        """
+
+        mounted = [ cabinet for cabinet in self.cabinets if cabinet.is_mounted ]
+        mounted_names = [ cabinet.name for cabinet in mounted ]
+
+        found = {}
+
+        for cabinet in mounted:
+            for folder in cabinet.folders:
+                found.setdefault(folder.group_uuid, []).append(
+                                    { 'cabinet' : cabinet.name, 
+                                      'name' : folder.name, 
+                                      'uuid' : folder.uuid })
+
+        with self._groups_lock():
+            groups = self._load_groups()
+
+            for group_uuid in set(groups) | set(found):
+                group = groups.setdefault(group_uuid, { 'clones' : [] })
+
+                # the clones in cabinets that are not accessible are kept
+                group['clones'] = [ x for x in group['clones'] if x['cabinet'] not in mounted_names ]
+                group['clones'].extend(found.get(group_uuid, []))
+                group['scanned'] = mounted_names
+
+            self._save_groups(groups)
+
+        return groups
+
+    def get_group_folders(self, group_uuid, known_uuids=None):
+        """
+        Returns the accessible folders of a group using the index of the 
+        groups.
+
+        known_uuids are the annex uuids of the folders the group is known to
+        contain. The accessible cabinets are searched again only if one of 
+        them is not in the index and it could be in a cabinet that became 
+        accessible since the last search.
+        """
+
+        known_uuids = known_uuids or []
+        group = self._load_groups().get(group_uuid)
+
+        if group is not None:
+            indexed = [ x['uuid'] for x in group['clones'] ]
+            missing = [ x for x in known_uuids if x not in indexed ]
+
+            if any(x not in group.get('unresolved', []) for x in missing):
+                # a clone we never searched for
+                group = None
+            elif missing:
+                # the clones we didn't find may be in cabinets that became
+                # accessible after the last search
+                mounted = [ cabinet.name for cabinet in self.cabinets if cabinet.is_mounted ]
+
+                if any(name not in group.get('scanned', []) for name in mounted):
+                    group = None
+
+        rescanned = group is None
+
+        if group is None:
+            group = self._rescan_group(group_uuid, known_uuids)
+
+        folders, moved = self._resolve_clones(group_uuid, group)
+
+        # a clone was moved or deleted since the last search
+        if moved and not rescanned:
+            folders, moved = self._resolve_clones(group_uuid, 
+                                                  self._rescan_group(group_uuid, known_uuids))
+
+        return folders
+
+    def _rescan_group(self, group_uuid, known_uuids):
+        group = self.update_groups_index().get(group_uuid, { 'clones' : [] })
+
+        indexed = [ x['uuid'] for x in group['clones'] ]
+        unresolved = [ x for x in known_uuids if x not in indexed ]
+
+        # remember what we didn't find to avoid searching for it again 
+        with self._groups_lock():
+            groups = self._load_groups()
+
+            if group_uuid in groups:
+                groups[group_uuid]['unresolved'] = unresolved
+                self._save_groups(groups)
+
+        return group
+
+    def _resolve_clones(self, group_uuid, group):
+        """
+        Returns the accessible folders of the clones in the index of a group
+        and True if some of the clones are not where the index says
+        """
+
+        folders = []
+        moved = False
+
+        for clone in group['clones']:
+            cabinet = self.get_cabinet(clone['cabinet'])
+
+            if cabinet is None or not cabinet.is_mounted:
+                continue
+
+            folder = cabinet.get_folder(clone['name'])
+
+            if folder is None or folder.group_uuid != group_uuid or folder.uuid != clone['uuid']:
+                moved = True
+                continue
+
+            folders.append(folder)
+
+        return folders, moved
+
     @property
     def cabinets_path(self):
         return os.path.join(self.path, "cabinets")
@@ -538,11 +1908,11 @@ class Archive(object):
 
         return cabinets
 
-    def add_cabinet(self, name, cabinet_type, args):
+    def add_cabinet(self, name, cabinet_type, args, transfer=None):
         if cabinet_type not in cabinet_types:
             raise Exception("Unsupported type of cabinet")
 
-        cabinet_types[cabinet_type].create(self, name, args)
+        cabinet_types[cabinet_type].create(self, name, args, transfer)
          
 
     def init(self):
@@ -552,3 +1922,4 @@ class Archive(object):
         os.makedirs(self.path) 
         os.makedirs(os.path.join(self.path, "workdir"))
         os.makedirs(os.path.join(self.path, "cabinets"))
+        os.makedirs(os.path.join(self.path, "index"))
@@ -0,0 +1,110 @@
+#
+#   Copyright 2016 Lorenzo Keller
+#
+#   This file is part of archivist
+#
+#
+#   archivist is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation, either version 3 of the License, or
+#   (at your option) any later version.
+#
+#   archivist is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with archivist.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+
+import contextlib
+import threading
+import json
+import time
+import os
+
+class Profiler():
+    """
+    Records timed events and saves them as a Chrome trace file (it can be 
+    opened with chrome://tracing or https://ui.perfetto.dev)
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.events = []
+        self.origin = time.monotonic()
+
+    def _timestamp(self, t):
+        # microseconds since the profiler was created
+        return int((t - self.origin) * 1000000)
+
+    def record(self, name, category, start, end, args=None):
+        event = { 'name' : name, 'cat' : category, 'ph' : 'X', 
+                  'ts' : self._timestamp(start), 
+                  'dur' : self._timestamp(end) - self._timestamp(start),
+                  'pid' : os.getpid(), 'tid' : threading.get_ident(), 
+                  'args' : args or {} }
+
+        with self.lock:
+            self.events.append(event)
+
+    def save(self, path):
+        with self.lock:
+            events = list(self.events)
+
+        with open(path, "w") as fp:
+            json.dump({ 'traceEvents' : events, 'displayTimeUnit' : 'ms' }, fp)
+
+# the active profiler, None if profiling is disabled
+profiler = None
+
+def start():
+    global profiler
+    profiler = Profiler()
+
+def stop(path):
+    """
+    Stops profiling and saves the events in path
+    """
+    global profiler
+
+    if profiler is None:
+        return
+
+    profiler.save(path)
+    profiler = None
+
+@contextlib.contextmanager
+def phase(name, **args):
+    """
+    Records the time spent in the with block as a phase
+    """
+
+    if profiler is None:
+        yield
+        return
+
+    start = time.monotonic()
+
+    try:
+        yield
+    finally:
+        if profiler is not None:
+            profiler.record(name, "phase", start, time.monotonic(), args)
+
+def record_command(command, wd, start, end, returncode, output_bytes):
+    """
+    Records the execution of a command
+    """
+
+    if profiler is None:
+        return
+
+    profiler.record(os.path.basename(command[0]) + " " + " ".join(command[1:2]), 
+                    "command", start, end, 
+                    { 'command' : " ".join(command), 
+                      'wd' : wd or os.getcwd(), 
+                      'returncode' : returncode, 
+                      'output_bytes' : output_bytes })
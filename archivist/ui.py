@@ -28,6 +28,7 @@ from gi.repository import Gdk
 from gi.repository import Gio
 from gi.repository import GLib
 from gi.repository import GObject
+from gi.repository import Pango
 
 from archivist.model import *
 
@@ -44,6 +45,7 @@ class Operation(Gtk.Window):
 
         self.action = action
         self.success = False
+        self.token = archivist.util.CancellationToken()
 
         # window properties
         self.set_border_width(20)
@@ -80,6 +82,12 @@ class Operation(Gtk.Window):
         self.spinner = Gtk.Spinner()        
         hbox.pack_end(self.spinner, False, True, 0)
 
+        # label with the progress of the current file transfer
+        self.transfer_label = Gtk.Label()
+        self.transfer_label.set_halign(Gtk.Align.START)
+        self.transfer_label.set_ellipsize(Pango.EllipsizeMode.MIDDLE)
+        vbox.pack_start(self.transfer_label, False, False, 0)
+
         # label with status of execution
         self.result_label = Gtk.Label()
         self.result_label.get_style_context().add_provider(style, Gtk.STYLE_PROVIDER_PRIORITY_APPLICATION)
@@ -116,6 +124,11 @@ class Operation(Gtk.Window):
         self.close_button.connect("clicked", lambda x : self.destroy())
         buttons_box.pack_end(self.close_button, False, False, 0)
 
+        # button to stop the operation
+        self.cancel_button = Gtk.Button(label="Cancel")
+        self.cancel_button.connect("clicked", self._on_cancel)
+        buttons_box.pack_end(self.cancel_button, False, False, 0)
+
 
     def _on_expanded(self, widget, prp):
         if self.expander.get_property("expanded") :
@@ -133,6 +146,11 @@ class Operation(Gtk.Window):
         self.text_buffer.insert(end, message)
         self.text_view.scroll_to_iter(end, 0, True, 1, 0)
 
+    def _on_cancel(self, widget):
+        self.cancel_button.set_sensitive(False)
+        self._append_progress("Cancelling...\n")
+        self.token.cancel()
+
     def _on_start(self):
         self.show_all()
         self.resize(400,150)
@@ -147,12 +165,16 @@ class Operation(Gtk.Window):
         if self.success:
             self.result_label.set_text("Success")
             clazz = "success"
+        elif self.token.is_cancelled:
+            self.result_label.set_text("Cancelled")
+            clazz = "failure"
         else:
             self.result_label.set_text("Error")
             clazz = "failure"
 
         self.result_label.get_style_context().add_class(clazz)
 
+        self.cancel_button.hide()
         self.close_button.show()
         self.result_label.show()
 
@@ -166,16 +188,27 @@ class Operation(Gtk.Window):
         window = self
 
         class Progress(archivist.util.ProgressMonitor):
+
+            structured = True
+
             def on_error(self, message):
                 GLib.idle_add(lambda : window._append_error(message))
 
             def on_progress(self, message):
                 GLib.idle_add(lambda : window._append_progress(message))
 
+            def on_transfer(self, transfer):
+                text = str(transfer)
+                GLib.idle_add(lambda : window.transfer_label.set_text(text))
+
+                if transfer.finished is not None:
+                    self.on_progress(text + "\n")
+
         GLib.idle_add(self._on_start)
 
         try :
-            self.action(Progress())
+            with archivist.util.cancellation(self.token):
+                self.action(Progress())
             self.success = True
         except Exception:
             self.success = False
@@ -195,7 +228,26 @@ class Tray:
         self.statusicon.set_from_stock(Gtk.STOCK_NETWORK)
         self.statusicon.connect("popup-menu", self.on_right_click_icon)
 
-        self.cabinets = Archive().cabinets
+        self.archive = Archive()
+        self.cabinets = self.archive.cabinets
+
+    def _action(self, action, target, fallback):
+        """
+        Returns a function that runs the action in the daemon if it is 
+        running, otherwise in this process
+        """
+
+        def run(progress=None):
+            import archivist.daemon
+
+            client = archivist.daemon.Client(self.archive)
+
+            if client.is_running:
+                client.submit(action, target, priority=0, progress=progress)
+            else:
+                fallback(progress)
+
+        return run
 
     def on_right_click_icon(self, icon, button, time):
         menu = Gtk.Menu()
@@ -231,11 +283,13 @@ class Tray:
 
         if cabinet.is_mounted:
 
-            for folder in cabinet.folders:
+            folders = cabinet.folders
+
+            for folder in folders:
                 folder_menu = self._create_folder_menu(folder)
                 menu.append(folder_menu)
 
-            if len(cabinet.folders) == 0:
+            if len(folders) == 0:
                 menu.append(Gtk.MenuItem(label="No folders"))
 
             menu.append(Gtk.SeparatorMenuItem())
@@ -274,11 +328,13 @@ class Tray:
         op.execute()
 
     def _on_sync_cabinet(self, cabinet):
-        op = Operation("Synching cabinet", "Cabinet sync in progress...", cabinet.sync)
+        op = Operation("Synching cabinet", "Cabinet sync in progress...",
+                       self._action("sync", cabinet.name, cabinet.sync))
         op.execute()
 
     def _on_snapshot_cabinet(self, cabinet):
-        op = Operation("Snapshotting cabinet", "Cabinet snapshot in progress...", cabinet.snapshot)
+        op = Operation("Snapshotting cabinet", "Cabinet snapshot in progress...",
+                       self._action("snapshot", cabinet.name, cabinet.snapshot))
         op.execute()
 
     def _create_folder_menu(self, folder):
@@ -326,11 +382,13 @@ class Tray:
         op.execute()
 
     def _on_sync_folder(self, folder):
-        op = Operation("Synching folder", "Folder sync in progress...", folder.sync)
+        op = Operation("Synching folder", "Folder sync in progress...",
+                       self._action("sync", folder.full_name, folder.sync))
         op.execute()
 
     def _on_snapshot_folder(self, folder):
-        op = Operation("Snapshotting folder", "Folder snapshot in progress...", folder.snapshot)
+        op = Operation("Snapshotting folder", "Folder snapshot in progress...",
+                       self._action("snapshot", folder.full_name, folder.snapshot))
         op.execute()
 
 def main():
@@ -19,22 +19,715 @@
 #
 
 
+import archivist.profile
+import contextvars
+import contextlib
 import subprocess
+import selectors
+import signal
+import socket
+import codecs
+import fcntl
+import errno
+import json
+import time
 import threading
 import os
 import io
-import queue
 
 class ProgressMonitor():
     """
     Monitors the progress of a command
+
+    The output of commands is delivered in chunks of one or more complete 
+    lines, monitors that need to receive each line in a separate call 
+    should set per_line to True.
+
+    Monitors that set structured to True receive the progress of file 
+    transfers as Transfer objects passed to on_transfer instead of the raw 
+    output of the transfer commands.
     """
-    def on_error(message):
+
+    per_line = False
+    structured = False
+
+    def on_error(self, message):
         pass
-    def on_progress(message):
+    def on_progress(self, message):
         pass
+    def on_transfer(self, transfer):
+        pass
+
+class PrefixedProgress(ProgressMonitor):
+    """
+    Forwards messages to another progress monitor adding a prefix to each 
+    line.
+
+    The calls to the wrapped monitor are serialized with a lock, monitors
+    that share the same lock can be safely used from different threads.
+    """
+
+    def __init__(self, progress, prefix, lock):
+        self.progress = progress
+        self.prefix = prefix
+        self.lock = lock
+        self.per_line = getattr(progress, "per_line", False)
+
+    def _prefix(self, message):
+        # lines end only with "\n" like in _LineReader, a "\r" in a line 
+        # (e.g. a progress bar) doesn't get a prefix
+        lines = message.split("\n")
+        last = self.prefix + lines[-1] if lines[-1] else ""
+
+        return "".join(self.prefix + line + "\n" for line in lines[:-1]) + last
+
+    def on_error(self, message):
+        with self.lock:
+            self.progress.on_error(self._prefix(message))
+
+    def on_progress(self, message):
+        with self.lock:
+            self.progress.on_progress(self._prefix(message))
+
+    @property
+    def structured(self):
+        return getattr(self.progress, "structured", False)
+
+    def on_transfer(self, transfer):
+        with self.lock:
+            self.progress.on_transfer(transfer)
+
+_SIZE_UNITS = { "" : 1, "b" : 1, "kb" : 1000, "mb" : 1000 ** 2, "gb" : 1000 ** 3, 
+                "tb" : 1000 ** 4, "kib" : 1024, "mib" : 1024 ** 2, "gib" : 1024 ** 3, 
+                "tib" : 1024 ** 4 }
+
+def parse_size(text):
+    """
+    Parses a size like "100kb" or "1.5 GiB" (the units of git-annex) and 
+    returns the number of bytes
+    """
+
+    text = text.strip().lower()
+    number = text.rstrip("abcdefghijklmnopqrstuvwxyz ")
+    unit = text[len(number):].strip()
+
+    if unit not in _SIZE_UNITS:
+        raise Exception("Invalid size " + text)
+
+    try:
+        return int(float(number) * _SIZE_UNITS[unit])
+    except ValueError:
+        raise Exception("Invalid size " + text)
+
+def format_size(size):
+    for unit in [ "B", "kB", "MB", "GB" ]:
+        if size < 1000:
+            return "%.1f %s" % (size, unit)
+
+        size = size / 1000
+
+    return "%.1f TB" % size
+
+def load_json(path, default=None):
+    """
+    Loads a file written by save_json, returns default if the file is
+    missing or corrupted
+    """
+
+    try:
+        with open(path) as fp:
+            return json.load(fp)
+    except (FileNotFoundError, ValueError):
+        return default
+
+def save_json(path, data):
+    """
+    Writes data to a file atomically, readers see either the old or the
+    new content
+    """
+
+    tmp_path = "%s.%d.%d.tmp" % (path, os.getpid(), threading.get_ident())
+
+    with open(tmp_path, "w") as fp:
+        json.dump(data, fp)
+
+    os.replace(tmp_path, path)
+
+class Transfer():
+    """
+    The progress of the transfer of a file from or to a remote
+    """
+
+    def __init__(self, file, key, direction, remote, total_size=None):
+        self.file = file
+        self.key = key
+        self.direction = direction
+        self.remote = remote
+        self.total_size = total_size
+        self.bytes = 0
+        self.started = time.monotonic()
+        self.finished = None
+        self.success = None
+
+    @property
+    def duration(self):
+        return (self.finished or time.monotonic()) - self.started
+
+    @property
+    def rate(self):
+        """
+        Bytes per second since the transfer started
+        """
+
+        if self.duration <= 0:
+            return 0
+
+        return self.bytes / self.duration
+
+    @property
+    def eta(self):
+        """
+        Seconds until the transfer completes at the current rate or None
+        """
+
+        if self.finished is not None:
+            return 0
+
+        if self.total_size is None or self.rate == 0:
+            return None
+
+        return (self.total_size - self.bytes) / self.rate
+
+    def __str__(self):
+        text = self.file + " " + self.direction + " " + self.remote + ": "
+
+        if self.finished is not None:
+            return text + ("done" if self.success else "failed") + \
+                        " (%s in %.1fs, %s/s)" % (format_size(self.bytes), 
+                                                  self.duration, format_size(self.rate))
+
+        if self.total_size:
+            text = text + "%d%% " % (100 * self.bytes / self.total_size)
+
+        text = text + format_size(self.rate) + "/s"
+
+        if self.eta is not None:
+            text = text + " ETA %ds" % self.eta
+
+        return text
+
+class RemoteTransfers():
+    """
+    Aggregated statistics of the transfers with a remote
+    """
+
+    def __init__(self, remote):
+        self.remote = remote
+        self.bytes = 0
+        self.files = 0
+        self.failures = 0
+        self.started = None
+        self.finished = None
+
+    @property
+    def rate(self):
+        if self.started is None or self.finished <= self.started:
+            return 0
+
+        return self.bytes / (self.finished - self.started)
+
+    def __str__(self):
+        return "%s: %d files, %s, %s/s, %d failed" % (self.remote, self.files, 
+                        format_size(self.bytes), format_size(self.rate), self.failures)
+
+class TransferTracker(ProgressMonitor):
+    """
+    Parses the JSON output of git-annex transfer commands (--json 
+    --json-progress) and reports the progress of each file to the 
+    on_transfer method of a progress monitor.
 
-def exec(command, wd=None, progress=None):
+    Lines that are not JSON are forwarded unchanged. Progress updates of a
+    transfer are sent at most every interval seconds. The names of remotes 
+    are replaced by the values in labels when present.
+    """
+
+    per_line = True
+
+    def __init__(self, progress, labels=None, interval=0.5):
+        self.progress = progress
+        self.labels = labels or {}
+        self.interval = interval
+        self.transfers = {}
+        self.remotes = {}
+        self.last_update = {}
+
+    def _remote(self, note, direction):
+        # notes look like 'from origin...' or 'to origin...'
+        prefix = direction + " "
+
+        if not note or not note.startswith(prefix):
+            return "?"
+
+        name = note[len(prefix):].rstrip(".")
+
+        return self.labels.get(name, name)
+
+    def _get_transfer(self, action):
+        key = action.get("key")
+        transfer = self.transfers.get(key)
+
+        if transfer is None:
+            direction = "to" if action.get("command") in ("copy", "move") else "from"
+
+            transfer = Transfer(action.get("file") or key, key, direction, 
+                                self._remote(action.get("note"), direction))
+            self.transfers[key] = transfer
+
+        return transfer
+
+    def on_progress(self, message):
+        try:
+            obj = json.loads(message)
+        except ValueError:
+            self.progress.on_progress(message)
+            return
+
+        if "byte-progress" in obj:
+            transfer = self._get_transfer(obj.get("action", {}))
+            transfer.bytes = obj["byte-progress"]
+            transfer.total_size = obj.get("total-size", transfer.total_size)
+
+            now = time.monotonic()
+
+            if now - self.last_update.get(transfer.key, 0) >= self.interval:
+                self.last_update[transfer.key] = now
+                self.progress.on_transfer(transfer)
+
+        elif "success" in obj and obj.get("key") is not None:
+            transfer = self._get_transfer(obj)
+            transfer.finished = time.monotonic()
+            transfer.success = obj["success"]
+
+            del self.transfers[transfer.key]
+            self.last_update.pop(transfer.key, None)
+
+            stats = self.remotes.setdefault(transfer.remote, RemoteTransfers(transfer.remote))
+
+            if stats.started is None:
+                stats.started = transfer.started
+
+            stats.finished = transfer.finished
+
+            if transfer.success:
+                if transfer.total_size is not None:
+                    transfer.bytes = transfer.total_size
+
+                stats.bytes = stats.bytes + transfer.bytes
+                stats.files = stats.files + 1
+            else:
+                stats.failures = stats.failures + 1
+
+                for message in obj.get("error-messages", []):
+                    self.progress.on_error(message + "\n")
+
+            self.progress.on_transfer(transfer)
+
+    def on_error(self, message):
+        self.progress.on_error(message)
+
+    def report(self):
+        """
+        Sends a summary of the transfers with each remote to the monitor
+        """
+
+        for stats in self.remotes.values():
+            self.progress.on_progress("Transfers with " + str(stats) + "\n")
+
+class _LineReader():
+    """
+    Incrementally decodes the output of a stream and passes complete lines 
+    to a callback.
+
+    Newlines are translated to '\\n' the same way a text file opened in 
+    universal newlines mode would do.
+
+    Unless per_line is True, lines are coalesced into chunks: a chunk is 
+    delivered once it is older than interval seconds or bigger than 
+    max_size characters.
+    """
+
+    def __init__(self, callback, per_line=True, interval=0.1, max_size=65536):
+        self.callback = callback
+        self.per_line = per_line
+        self.interval = interval
+        self.max_size = max_size
+        self.decoder = io.IncrementalNewlineDecoder(
+                            codecs.getincrementaldecoder("utf-8")(), 
+                            translate=True)
+        self.pending = ""
+        self.chunk = []
+        self.chunk_size = 0
+        self.chunk_time = None
+
+    def feed(self, data, final=False):
+        self.pending += self.decoder.decode(data, final)
+
+        end = self.pending.rfind("\n") + 1
+
+        if final:
+            end = len(self.pending)
+
+        if end > 0:
+            lines, self.pending = self.pending[:end], self.pending[end:]
+
+            if self.per_line:
+                # str.splitlines() would split on other characters too 
+                # (e.g. form feeds and unicode line separators)
+                parts = lines.split("\n")
+
+                for line in parts[:-1]:
+                    self.callback(line + "\n")
+
+                # the last line without new line at the end of the stream
+                if parts[-1]:
+                    self.callback(parts[-1])
+            else:
+                if self.chunk_time is None:
+                    self.chunk_time = time.monotonic()
+
+                self.chunk.append(lines)
+                self.chunk_size = self.chunk_size + len(lines)
+
+        if final or self.chunk_size >= self.max_size:
+            self.flush()
+
+    @property
+    def deadline(self):
+        """
+        The time at which the pending chunk must be delivered or None
+        """
+
+        if self.chunk_time is None:
+            return None
+
+        return self.chunk_time + self.interval
+
+    def flush(self):
+        if not self.chunk:
+            return
+
+        chunk = "".join(self.chunk)
+
+        self.chunk = []
+        self.chunk_size = 0
+        self.chunk_time = None
+
+        self.callback(chunk)
+
+class OperationCancelled(Exception):
+    pass
+
+class CommandTimeout(OperationCancelled):
+    pass
+
+class CancellationToken():
+    """
+    Tells the operations running on behalf of somebody when to stop.
+
+    The token is cancelled by calling cancel() or when timeout seconds have
+    passed since its creation. Commands started while the token is current 
+    (see cancellation()) are killed when it is cancelled, and they are also
+    killed if they individually run longer than command_timeout seconds.
+    """
+
+    def __init__(self, timeout=None, command_timeout=None):
+        self.event = threading.Event()
+        self.deadline = None if timeout is None else time.monotonic() + timeout
+        self.command_timeout = command_timeout
+        self.reason = "Operation cancelled"
+
+    def cancel(self, reason="Operation cancelled"):
+        self.reason = reason
+        self.event.set()
+
+    @property
+    def is_cancelled(self):
+        if self.deadline is not None and time.monotonic() >= self.deadline:
+            self.cancel("Operation timed out")
+
+        return self.event.is_set()
+
+    def check(self):
+        """
+        Raises OperationCancelled if the token was cancelled
+        """
+
+        if self.is_cancelled:
+            raise OperationCancelled(self.reason)
+
+_current_token = contextvars.ContextVar("cancellation_token", default=None)
+
+def current_token():
+    return _current_token.get()
+
+@contextlib.contextmanager
+def cancellation(token):
+    """
+    Makes token the current cancellation token of the calling thread (and 
+    of the threads started by run_parallel) until the block exits. Use 
+    None for cleanup code that must run even if the operation was 
+    cancelled.
+    """
+
+    reset = _current_token.set(token)
+
+    try:
+        yield token
+    finally:
+        _current_token.reset(reset)
+
+def check_cancelled():
+    token = current_token()
+
+    token and token.check()
+
+class Process():
+    """
+    A child process started by a ProcessRunner
+    """
+
+    def __init__(self, command, wd, popen, timeout=None, token=None, new_session=True):
+        self.command = command
+        self.wd = wd
+        self.popen = popen
+        self.new_session = new_session
+        self.output = None
+        self.open_streams = 0
+        self.output_bytes = 0
+        self.started = time.monotonic()
+        self.deadline = None if timeout is None else self.started + timeout
+        self.token = token
+        self.recorded = False
+
+    @property
+    def is_watched(self):
+        return self.deadline is not None or self.token is not None
+
+    def check(self):
+        self.token and self.token.check()
+
+        if self.deadline is not None and time.monotonic() >= self.deadline:
+            raise CommandTimeout("Command timed out: " + " ".join(self.command))
+
+    @property
+    def returncode(self):
+        return self.popen.returncode
+
+class ProcessRunner():
+    """
+    Runs child processes and dispatches their output to progress monitors.
+
+    A single runner can drive the output of many processes at the same time
+    without using threads: the output of all processes is multiplexed with a
+    selector and the progress monitor callbacks are executed in the thread
+    that calls wait().
+
+    Unless the progress monitor asks for each line separately, the output is
+    coalesced in chunks delivered at most every interval seconds or when 
+    they reach max_size characters.
+
+    Unless it needs the terminal (e.g. to ask a password), every process 
+    runs in its own session, if the process is cancelled, times out or 
+    wait() is interrupted its whole process group is terminated (and 
+    killed if it doesn't exit within grace seconds).
+
+    A runner is not thread safe, each thread should use its own runner.
+    """
+
+    # how often cancellation and timeouts are checked
+    check_interval = 0.2
+
+    def __init__(self, interval=0.1, max_size=65536, grace=5):
+        self.selector = selectors.DefaultSelector()
+        self.interval = interval
+        self.max_size = max_size
+        self.grace = grace
+        self.readers = []
+
+    def start(self, command, wd=None, progress=None, timeout=None, token=None,
+                    new_session=True, capture=False):
+        """
+        Starts a command and returns the corresponding Process object.
+
+        The output of the command is delivered to the progress monitor only
+        while wait() is running. The process is killed if it runs for more 
+        than timeout seconds or if token is cancelled, by default the 
+        current cancellation token and its command timeout are used.
+
+        If capture is True the standard output is stored as bytes in the 
+        output attribute of the process instead. Commands that need the 
+        controlling terminal must be started with new_session False.
+        """
+
+        if token is None:
+            token = current_token()
+
+        if timeout is None and token is not None:
+            timeout = token.command_timeout
+
+        token and token.check()
+
+        fdout = None if progress is None and not capture else subprocess.PIPE
+        fderr = None if progress is None else subprocess.PIPE
+
+        popen = subprocess.Popen(command, cwd=wd, stdout=fdout, stderr=fderr, 
+                                 start_new_session=new_session)
+
+        process = Process(command, wd, popen, timeout, token, new_session)
+
+        if capture:
+            process.output = bytearray()
+
+            self.selector.register(popen.stdout, selectors.EVENT_READ, (process, None))
+            process.open_streams = process.open_streams + 1
+
+            if progress is not None:
+                self._register(process, popen.stderr, progress.on_error, 
+                               getattr(progress, "per_line", False))
+        elif progress is not None:
+            per_line = getattr(progress, "per_line", False)
+
+            self._register(process, popen.stdout, progress.on_progress, per_line)
+            self._register(process, popen.stderr, progress.on_error, per_line)
+
+        return process
+
+    def _register(self, process, stream, callback, per_line):
+        reader = _LineReader(callback, per_line, self.interval, self.max_size)
+
+        self.selector.register(stream, selectors.EVENT_READ, (process, reader))
+        self.readers.append(reader)
+        process.open_streams = process.open_streams + 1
+
+    def _poll(self, limit=None):
+        deadlines = [ reader.deadline for reader in self.readers 
+                                        if reader.deadline is not None ]
+
+        timeout = limit
+
+        if deadlines:
+            timeout = max(min(deadlines) - time.monotonic(), 0)
+
+            if limit is not None:
+                timeout = min(timeout, limit)
+
+        for key, events in self.selector.select(timeout):
+            process, reader = key.data
+
+            data = os.read(key.fd, 65536)
+
+            if data:
+                process.output_bytes = process.output_bytes + len(data)
+
+                if reader is None:
+                    process.output += data
+                else:
+                    reader.feed(data)
+            else:
+                # the process closed the stream, flush what is left
+                self._unregister(key)
+
+        now = time.monotonic()
+
+        for reader in self.readers:
+            if reader.deadline is not None and reader.deadline <= now:
+                reader.flush()
+
+    def wait(self, process):
+        """
+        Blocks until the process exits while dispatching the output of all 
+        the processes started by this runner.
+
+        The function raises an exception subprocess.CalledProcessError if the
+        command doesn't exit with 0 return code and OperationCancelled if
+        the process was cancelled or timed out.
+        """
+
+        limit = self.check_interval if process.is_watched else None
+
+        try:
+            while process.open_streams > 0:
+                process.check()
+                self._poll(limit)
+
+            # wait until the process is done (it may run for a while after 
+            # it closes stdout/stderr)
+            while process.popen.poll() is None:
+                process.check()
+
+                try:
+                    process.popen.wait(limit)
+                except subprocess.TimeoutExpired:
+                    pass
+        except BaseException:
+            self._kill(process)
+            raise
+        finally:
+            self._record(process)
+
+        if process.returncode != 0:
+            output = None if process.output is None else bytes(process.output)
+
+            raise subprocess.CalledProcessError(process.returncode, 
+                                                    process.command, output)
+
+    def _record(self, process):
+        if process.popen.returncode is not None and not process.recorded:
+            archivist.profile.record_command(process.command, process.wd, 
+                                             process.started, time.monotonic(), 
+                                             process.returncode, process.output_bytes)
+            process.recorded = True
+
+    def _signal(self, process, signum):
+        try:
+            if process.new_session:
+                os.killpg(process.popen.pid, signum)
+            else:
+                # the process shares our process group
+                process.popen.send_signal(signum)
+        except ProcessLookupError:
+            pass
+
+    def _kill(self, process):
+        # the children of the process (e.g. ssh started by git) are in the
+        # same group and may keep running after the process exits
+        self._signal(process, signal.SIGTERM)
+
+        try:
+            process.popen.wait(self.grace)
+        except subprocess.TimeoutExpired:
+            self._signal(process, signal.SIGKILL)
+            process.popen.wait()
+
+        for key in list(self.selector.get_map().values()):
+            if key.data[0] is process:
+                self._unregister(key)
+
+    def _unregister(self, key):
+        process, reader = key.data
+
+        self.selector.unregister(key.fileobj)
+        key.fileobj.close()
+        process.open_streams = process.open_streams - 1
+
+        if reader is not None:
+            self.readers.remove(reader)
+            reader.feed(b"", final=True)
+
+    def close(self):
+        self.selector.close()
+
+def exec(command, wd=None, progress=None, timeout=None, token=None, new_session=True):
     """
     Execute a command and while returning each line of stdout and stderr to 
     a progress monitor.
@@ -42,71 +735,260 @@ def exec(command, wd=None, progress=None):
     The function blocks until the command exits.
 
     The progress monitor receives every line of stdout and stderr 
-    (with new line character  included).
+    (with new line character  included), consecutive lines are delivered in
+    a single call unless the monitor sets per_line.
 
     The progress monitor calls are executed in the same thread as the the
     exec function is executed.
 
     The function raises an exception subprocess.CalledProcessError if the
-    command doesn't exit with 0 return code.
+    command doesn't exit with 0 return code and OperationCancelled if the 
+    command runs longer than timeout seconds or token is cancelled (see 
+    ProcessRunner.start()). Commands that ask for a password on the 
+    terminal must be started with new_session False.
+    """
+
+    runner = ProcessRunner()
+
+    try:
+        runner.wait(runner.start(command, wd, progress, timeout, token, new_session))
+    finally:
+        runner.close()
+
+def check_output(command, wd=None, timeout=None, token=None):
+    """
+    Runs a command and returns its output like subprocess.check_output, the
+    command is cancelled like the ones started by exec()
     """
 
-    fdout = None if progress is None else subprocess.PIPE
+    runner = ProcessRunner()
+
+    try:
+        process = runner.start(command, wd, None, timeout, token, capture=True)
+        runner.wait(process)
+    finally:
+        runner.close()
+
+    return bytes(process.output)
+
+def run_parallel(items, action, jobs=1):
+    """
+    Calls action on every item using at most jobs threads.
+
+    The function blocks until all the calls are completed, an exception in 
+    one call doesn't stop the others.
+
+    Returns a list of (item, exception) tuples in the same order as items, 
+    the exception is None if the action succeeded for the item.
+    """
+
+    # concurrent.futures is slow to import and not needed by most commands
+    import concurrent.futures
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max(jobs, 1)) as executor:
+        # each call sees the cancellation token of the caller
+        futures = [ executor.submit(contextvars.copy_context().run, action, item) 
+                                                    for item in items ]
+
+        return [ (item, future.exception()) for item, future in zip(items, futures) ]
+
+class LockTimeout(Exception):
+    pass
+
+class FileLock():
+    """
+    A lock shared between processes based on a file
+
+    The lock is taken with flock(), the kernel releases it when the owner 
+    dies. On file systems that don't support flock() (e.g. some FUSE file
+    systems) a file containing the pid of the owner is created instead, it
+    is removed if the owner is not running any more. In this case shared 
+    locks are exclusive.
+
+    If timeout is not None acquire() waits at most timeout seconds and then
+    raises LockTimeout.
+    """
+
+    def __init__(self, path, shared=False, timeout=None, operation=""):
+        self.path = path
+        self.shared = shared
+        self.timeout = timeout
+        self.operation = operation
+        self.fd = None
+        self.owner_path = None
+
+    @property
+    def owner(self):
+        return "%d %s %s" % (os.getpid(), socket.gethostname(), self.operation)
+
+    def _read_owner(self, path):
+        try:
+            with open(path) as fp:
+                return fp.read().strip() or "unknown"
+        except OSError:
+            return "unknown"
 
-    proc = subprocess.Popen(command, bufsize=1, # line buffering
-                                cwd=wd, stdout=fdout, stderr=fdout)
+    def _wait(self, deadline, path, progress):
+        if deadline is not None and time.monotonic() >= deadline:
+            raise LockTimeout("Timeout waiting for %s held by %s" % 
+                                    (self.path, self._read_owner(path)))
 
+        if not self.waiting:
+            progress and progress.on_progress("Waiting for %s held by %s\n" % 
+                                    (self.path, self._read_owner(path)))
+            self.waiting = True
 
-    # this queue contains all the tasks that the threads that read stderr and
-    # stdout would like to run in the execution context of the exec() function
-    tasks = queue.Queue(100)
+        time.sleep(0.1)
 
-    # these are the threads that will read stderr and stdout
-    threads = []
+    def acquire(self, progress=None):
+        deadline = None if self.timeout is None else time.monotonic() + self.timeout
+        self.waiting = False
 
-    # this function starts a thread that will schedule callback to be called
-    # each time a line is present on fd
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
 
-    # DESIGN: it is maybe possible to get rid of these threads
-    # and use select instead but it is not clear how to handle text decoding
-    def start_thread(fd, callback):
+        fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o644)
+        mode = (fcntl.LOCK_SH if self.shared else fcntl.LOCK_EX) | fcntl.LOCK_NB
 
-        # this function calls a callback once for each line that it can read
-        def process():
+        try:
+            while True:
+                try:
+                    fcntl.flock(fd, mode)
+                    break
+                except BlockingIOError:
+                    self._wait(deadline, self.path, progress)
+                except OSError as e:
+                    if e.errno not in [ errno.ENOLCK, errno.EOPNOTSUPP, errno.ENOSYS ]:
+                        raise
+
+                    self._acquire_owner_file(deadline, progress)
+                    os.close(fd)
+                    return
+
+            # the lock file tells who is holding the lock to the others
+            if not self.shared:
+                os.ftruncate(fd, 0)
+                os.write(fd, self.owner.encode("utf-8"))
+        except:
+            os.close(fd)
+            raise
+
+        self.fd = fd
+
+    def _is_stale(self, owner):
+        try:
+            pid, host = owner.split(" ", 2)[:2]
+            pid = int(pid)
+        except ValueError:
+            return False
+
+        # we cannot tell if a process on another host is running
+        if host != socket.gethostname():
+            return False
+
+        try:
+            os.kill(pid, 0)
+        except ProcessLookupError:
+            return True
+        except PermissionError:
+            pass
+
+        return False
+
+    def _acquire_owner_file(self, deadline, progress):
+        path = self.path + ".owner"
+
+        while True:
             try:
-                with io.TextIOWrapper(fd, encoding="utf-8") as stream:
-                    for line in stream:
-                        # schedule a call to the callback
-                        tasks.put( lambda line=line: callback(line))
-            finally:
-                # just before exiting we put an empty task in the list
-                # so that exec() can notice we are done
-                tasks.put(None)
-                
-        # create and start the thread
-        t = threading.Thread(target=process)
-        t.start()
-        threads.append(t)
-
-    if progress is not None:
-        start_thread(proc.stdout, progress.on_progress)
-        start_thread(proc.stderr, progress.on_error)
-
-    # execute all tasks that the threads ask us to notify
-    finished = 0
-    while finished < len(threads):
-        task = tasks.get()
-        if task is None:
-            finished = finished+1
-        else:
-            task()
-
-    # wait for the threads to be completely shutdown
-    for t in threads: t.join()
-
-    # wait until the process is done (it may run for a while after it closes 
-    # stdout/stderr)
-    proc.wait()
-
-    if proc.returncode != 0:
-        raise subprocess.CalledProcessError(proc.returncode, command)
+                fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o644)
+            except FileExistsError:
+                if not self._remove_stale_owner_file(path):
+                    self._wait(deadline, path, progress)
+                continue
+
+            with os.fdopen(fd, "w") as fp:
+                fp.write(self.owner)
+
+            self.owner_path = path
+            return
+
+    def _remove_stale_owner_file(self, path):
+        """
+        Removes the owner file if its owner is not running any more, returns
+        True if the file doesn't exist any more
+        """
+
+        try:
+            with open(path) as fp:
+                inode = os.fstat(fp.fileno()).st_ino
+                owner = fp.read().strip() or "unknown"
+        except FileNotFoundError:
+            return True
+
+        if not self._is_stale(owner):
+            return False
+
+        # other waiters may have found the same stale owner, the file is 
+        # renamed away so that only one of them can remove it and a new owner
+        # file created meanwhile is not removed by mistake
+        stale_path = "%s.%d.%d.stale" % (path, os.getpid(), threading.get_ident())
+
+        try:
+            os.rename(path, stale_path)
+        except FileNotFoundError:
+            return True
+
+        # inodes are reused, the owners are different (a running process)
+        if os.stat(stale_path).st_ino != inode or self._read_owner(stale_path) != owner:
+            # it was the owner file of a new owner, put it back
+            try:
+                os.link(stale_path, path)
+            except FileExistsError:
+                pass
+
+        os.unlink(stale_path)
+        return True
+
+    def release(self):
+        if self.owner_path is not None:
+            os.unlink(self.owner_path)
+            self.owner_path = None
+
+        if self.fd is not None:
+            if not self.shared:
+                os.ftruncate(self.fd, 0)
+
+            # closing the file releases the lock
+            os.close(self.fd)
+            self.fd = None
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, *args):
+        self.release()
+
+class LockSet():
+    """
+    Acquires a list of locks in order and releases them in reverse order
+    """
+
+    def __init__(self, locks, progress=None):
+        self.locks = locks
+        self.progress = progress
+        self.acquired = []
+
+    def __enter__(self):
+        try:
+            for lock in self.locks:
+                lock.acquire(self.progress)
+                self.acquired.append(lock)
+        except:
+            self.__exit__()
+            raise
+
+        return self
+
+    def __exit__(self, *args):
+        while self.acquired:
+            self.acquired.pop().release()
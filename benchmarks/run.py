@@ -0,0 +1,349 @@
+#!/usr/bin/env python3
+#
+#
+#   Copyright 2016 Lorenzo Keller
+#
+#   This file is part of archivist
+#
+#
+#   archivist is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation, either version 3 of the License, or
+#   (at your option) any later version.
+#
+#   archivist is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with archivist.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+
+"""
+Benchmarks of the main archivist operations on a synthetic archive.
+
+The archive is built in a temporary directory with plain directory 
+cabinets standing in for removable and sshfs ones. For each benchmark the
+wall time, the number of subprocesses and the peak RSS are reported as 
+JSON. Every run of a benchmark is executed in a new process so that its 
+peak RSS is not the one of the runs before it.
+
+Run from the root of the repository:
+
+    python3 benchmarks/run.py --cabinets 2 --folders 10 --files 100
+"""
+
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from archivist.model import *
+import archivist.profile
+import archivist.util
+import archivist.git
+import statistics
+import subprocess
+import tempfile
+import argparse
+import resource
+import shutil
+import json
+import time
+
+BIN_ARCHIVIST = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "bin", "archivist")
+
+def write_files(path, files, file_size):
+    for i in range(files):
+        with open(os.path.join(path, "file%d" % i), "wb") as fp:
+            fp.write(os.urandom(file_size))
+
+def make_folder_marker(cabinet, name):
+    # a directory that looks like a folder, used when git-annex is missing
+    os.makedirs(os.path.join(cabinet.access_path, name, ".git"))
+
+    with open(os.path.join(cabinet.access_path, name, ".git", "archivist"), "w") as fp:
+        fp.write("[folder]\ntype = plain\ngroupUuid = %s\n" % name)
+
+def build_archive(root, args, annex):
+    archive = Archive(os.path.join(root, "archive"))
+    archive.init()
+
+    for i in range(args.cabinets):
+        path = os.path.join(root, "cabinet%d" % i)
+        os.makedirs(path)
+        archive.add_cabinet("cabinet%d" % i, "plain", { 'storagePath' : path })
+
+    cabinet = archive.get_cabinet("cabinet0")
+
+    for i in range(args.folders):
+        name = "folder%d" % i
+
+        if annex:
+            cabinet.create_folder(name, "plain", {}, archivist.util.ProgressMonitor())
+        else:
+            make_folder_marker(cabinet, name)
+
+        write_files(os.path.join(cabinet.access_path, name), args.files, args.file_size)
+
+    return archive
+
+def measure(func):
+    """
+    Runs func and returns its wall time and the number of subprocesses it 
+    started
+    """
+
+    archivist.profile.start()
+
+    try:
+        start = time.perf_counter()
+        func()
+        wall_time = time.perf_counter() - start
+
+        # the git helpers are recorded when they exit
+        archivist.git.pool.close()
+
+        commands = [ e for e in archivist.profile.profiler.events if e['cat'] == 'command' ]
+    finally:
+        archivist.profile.profiler = None
+
+    return { 'wall_time' : wall_time, 
+             'subprocesses' : len(commands) }
+
+def run_python(python_args):
+    """
+    Runs the python interpreter with the repository in the path and returns
+    its wall time and peak RSS
+    """
+
+    env = dict(os.environ)
+    env['PYTHONPATH'] = os.path.join(os.path.dirname(BIN_ARCHIVIST), "..")
+
+    start = time.perf_counter()
+
+    popen = subprocess.Popen([ sys.executable ] + python_args, 
+                             env=env, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+
+    _, status, rusage = os.wait4(popen.pid, 0)
+
+    wall_time = time.perf_counter() - start
+
+    # the process was reaped by wait4
+    popen.returncode = os.waitstatus_to_exitcode(status)
+    errors = popen.stderr.read().decode("utf-8")
+    popen.stderr.close()
+
+    if popen.returncode != 0:
+        raise Exception("Command failed: " + errors.strip().split("\n")[-1])
+
+    return { 'wall_time' : wall_time, 
+             'peak_rss_kb' : rusage.ru_maxrss }
+
+def measure_cli(archive, cli_args):
+    """
+    Runs bin/archivist with cli_args and returns its wall time, the number
+    of subprocesses it started and its peak RSS
+    """
+
+    trace_path = os.path.join(archive.path, "trace.json")
+
+    result = run_python([ BIN_ARCHIVIST, "--archive_path", archive.path, 
+                          "--profile", trace_path ] + cli_args)
+
+    with open(trace_path) as fp:
+        events = json.load(fp)['traceEvents']
+
+    result['subprocesses'] = 1 + len([ e for e in events if e['cat'] == 'command' ])
+
+    return result
+
+def benchmark_folders(archive, args):
+    cabinet = archive.get_cabinet("cabinet0")
+
+    return { 'cold' : measure(lambda : cabinet.get_folders(rescan=True)), 
+             'warm' : measure(lambda : cabinet.get_folders()) }
+
+def benchmark_snapshot(archive, args):
+    folders = archive.get_cabinet("cabinet0").folders
+    progress = archivist.util.ProgressMonitor()
+
+    def snapshot():
+        for folder in folders:
+            folder.snapshot(progress)
+
+    results = { 'changed' : measure(snapshot), 
+                'unchanged' : measure(snapshot) }
+
+    return results
+
+def benchmark_clone(archive, args):
+    folders = archive.get_cabinet("cabinet0").folders
+    progress = archivist.util.ProgressMonitor()
+
+    results = {}
+
+    for i in range(1, args.cabinets):
+        cabinet = archive.get_cabinet("cabinet%d" % i)
+
+        def clone():
+            for folder in folders:
+                folder.clone(cabinet, folder.name, progress)
+
+        results[cabinet.name] = measure(clone)
+
+    return results
+
+def benchmark_sync(archive, args):
+    if args.cabinets < 2:
+        raise Exception("The sync benchmark needs at least 2 cabinets")
+
+    folder = archive.get_cabinet("cabinet0").get_folder("folder0")
+    progress = archivist.util.ProgressMonitor()
+
+    # the sync connects, fetches and transfers content only with clones
+    folder.clone(archive.get_cabinet("cabinet1"), folder.name, progress)
+
+    write_files(folder.storage_path, 1, args.file_size)
+
+    return { 'changed' : measure(lambda : folder.sync(progress)), 
+             'unchanged' : measure(lambda : folder.sync(progress)) }
+
+def benchmark_cli(archive, args):
+    return { 'ls-folders' : measure_cli(archive, [ "cabinet", "cabinet0", "ls-folders" ]), 
+             'access-path' : measure_cli(archive, [ "folder", "cabinet0/folder0", "access-path" ]) }
+
+def benchmark_startup(archive, args):
+    # the import of the modules not needed by the CLI (e.g. Gtk) would 
+    # show up here
+    return { 'import' : run_python([ "-c", "import archivist.cli" ]), 
+             'help' : run_python([ BIN_ARCHIVIST, "--help" ]) }
+
+# benchmark name -> (function, needs git-annex, needs an archive)
+BENCHMARKS = { 
+    'startup' : (benchmark_startup, False, False),
+    'folders' : (benchmark_folders, False, True),
+    'snapshot' : (benchmark_snapshot, True, True),
+    'clone' : (benchmark_clone, True, True),
+    'sync' : (benchmark_sync, True, True),
+    'cli' : (benchmark_cli, False, True),
+}
+
+def run_once(name, args, annex):
+    """
+    Runs a benchmark in the current process, the peak RSS are the ones of 
+    the whole process (ru_maxrss never decreases)
+    """
+
+    func, needs_annex, needs_archive = BENCHMARKS[name]
+
+    if not needs_archive:
+        result = func(None, args)
+    else:
+        # every run starts from a fresh archive
+        root = tempfile.mkdtemp(prefix="archivist-bench-")
+
+        try:
+            result = func(build_archive(root, args, annex), args)
+        finally:
+            shutil.rmtree(root)
+
+    result['peak_rss_kb'] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    result['children_peak_rss_kb'] = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+
+    return result
+
+def run_in_child(name, args):
+    """
+    Runs a benchmark in a new python process and returns its results
+    """
+
+    fd, result_path = tempfile.mkstemp(prefix="archivist-bench-", suffix=".json")
+    os.close(fd)
+
+    try:
+        run_python([ os.path.abspath(__file__), "--cabinets", str(args.cabinets), 
+                     "--folders", str(args.folders), "--files", str(args.files), 
+                     "--file-size", str(args.file_size), "--child-result", result_path, 
+                     name ])
+
+        with open(result_path) as fp:
+            result = json.load(fp)
+    finally:
+        os.unlink(result_path)
+
+    if 'error' in result:
+        raise Exception(result['error'])
+
+    return result
+
+def summarize(runs):
+    """
+    Merges the results of repeated runs keeping the median of each value
+    """
+
+    if isinstance(runs[0], dict):
+        return dict((key, summarize([ run[key] for run in runs ])) for key in runs[0])
+
+    return statistics.median(runs)
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark archivist operations")
+
+    parser.add_argument("--cabinets", type=int, default=2, help="number of cabinets")
+    parser.add_argument("--folders", type=int, default=10, help="number of folders")
+    parser.add_argument("--files", type=int, default=100, help="number of files per folder")
+    parser.add_argument("--file-size", type=int, default=4096, help="size of each file in bytes")
+    parser.add_argument("--repeat", type=int, default=1, help="number of repetitions (the median is reported)")
+    parser.add_argument("--output", help="file where the results are saved (default stdout)")
+    parser.add_argument("--child-result", help=argparse.SUPPRESS)
+    parser.add_argument("benchmarks", nargs="*", default=list(BENCHMARKS), 
+                        help="benchmarks to run (%s)" % ", ".join(BENCHMARKS))
+
+    args = parser.parse_args()
+
+    annex = shutil.which("git-annex") is not None
+
+    if args.child_result:
+        # a single run of a single benchmark started by run_in_child()
+        try:
+            result = run_once(args.benchmarks[0], args, annex)
+        except Exception as e:
+            result = { 'error' : str(e) }
+
+        with open(args.child_result, "w") as fp:
+            json.dump(result, fp)
+
+        return
+
+    results = { 'parameters' : { 'cabinets' : args.cabinets, 'folders' : args.folders, 
+                                 'files' : args.files, 'file_size' : args.file_size, 
+                                 'repeat' : args.repeat, 'git_annex' : annex }, 
+                'benchmarks' : {} }
+
+    for name in args.benchmarks:
+        func, needs_annex, needs_archive = BENCHMARKS[name]
+
+        if needs_annex and not annex:
+            results['benchmarks'][name] = { 'skipped' : "git-annex not installed" }
+            continue
+
+        try:
+            runs = [ run_in_child(name, args) for i in range(args.repeat) ]
+
+            results['benchmarks'][name] = summarize(runs)
+        except Exception as e:
+            results['benchmarks'][name] = { 'error' : str(e) }
+
+    output = json.dumps(results, indent=2, sort_keys=True)
+
+    if args.output:
+        with open(args.output, "w") as fp:
+            fp.write(output + "\n")
+    else:
+        print(output)
+
+if __name__ == "__main__":
+    main()
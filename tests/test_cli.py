@@ -0,0 +1,43 @@
+#
+#   Copyright 2016 Lorenzo Keller
+#
+#   This file is part of archivist
+#
+#
+#   archivist is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation, either version 3 of the License, or
+#   (at your option) any later version.
+#
+#   archivist is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with archivist.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+
+
+
+import unittest
+import subprocess
+import sys
+import os
+
+class TestCliStartup(unittest.TestCase):
+
+    def test_lazy_imports(self):
+        # the modules below are slow to import and not needed by most 
+        # commands, they should only be imported when used
+        code = ("import sys, archivist.cli; "
+                "print(' '.join(m for m in ['gi', 'archivist.ui', 'concurrent.futures', 'uuid'] "
+                "if m in sys.modules))")
+
+        env = dict(os.environ)
+        env['PYTHONPATH'] = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+
+        output = subprocess.check_output([ sys.executable, "-c", code ], env=env)
+
+        self.assertEqual(b"", output.strip())
@@ -0,0 +1,225 @@
+#
+#   Copyright 2016 Lorenzo Keller
+#
+#   This file is part of archivist
+#
+#
+#   archivist is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation, either version 3 of the License, or
+#   (at your option) any later version.
+#
+#   archivist is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with archivist.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+
+from archivist.daemon import *
+from archivist.model import *
+
+import archivist.daemon
+import archivist.util
+import unittest
+import tempfile
+import threading
+import shutil
+import time
+import os
+
+class TestScheduler(unittest.TestCase):
+
+    def test_priority_and_duplicates(self):
+        scheduler = Scheduler(None)
+
+        first = scheduler.submit("sync", "a", 10)
+        second = scheduler.submit("snapshot", "b", 1)
+
+        self.assertIs(first, scheduler.submit("sync", "a", 10))
+        self.assertEqual(2, len(scheduler.queue))
+
+        self.assertIs(second, scheduler._next_job())
+        self.assertIs(first, scheduler._next_job())
+        self.assertIsNone(scheduler._next_job())
+
+    def test_conflicting_jobs_wait(self):
+        scheduler = Scheduler(None)
+
+        running = scheduler.submit("snapshot", "a" + os.sep + "x", 1)
+        scheduler.running.append(scheduler._next_job())
+
+        cabinet = scheduler.submit("snapshot", "a", 1)
+        other = scheduler.submit("snapshot", "a" + os.sep + "y", 2)
+
+        # the whole cabinet contains the running folder
+        self.assertIs(other, scheduler._next_job())
+
+        running.group_uuid = "g"
+        other.group_uuid = "g"
+        self.assertTrue(running.conflicts(other))
+
+        self.assertFalse(running.conflicts(Job(0, "snapshot", "b", 1)))
+        self.assertTrue(running.conflicts(Job(0, "sync", "b", 1)))
+
+        self.assertIsNone(scheduler._next_job())
+        self.assertEqual([cabinet], [ x[2] for x in scheduler.queue ])
+
+    def test_group_resolved_on_submit(self):
+        path = tempfile.mkdtemp()
+
+        try:
+            cabinet_path = os.path.join(path, "cabinet")
+            archive = Archive(os.path.join(path, "archive"))
+            archive.init()
+            archive.add_cabinet("a", "plain", { 'storagePath' : cabinet_path })
+
+            for name in [ "x", "y" ]:
+                os.makedirs(os.path.join(cabinet_path, name, ".git"))
+
+                with open(os.path.join(cabinet_path, name, ".git", "archivist"), "w") as fp:
+                    fp.write("[folder]\ntype = plain\ngroupUuid = g\n")
+
+            scheduler = Scheduler(archive)
+
+            first = scheduler.submit("sync", "a" + os.sep + "x")
+            second = scheduler.submit("sync", "a" + os.sep + "y")
+
+            self.assertEqual("g", first.group_uuid)
+            self.assertTrue(first.conflicts(second))
+
+            # the model is loaded once
+            folder = scheduler._load("a" + os.sep + "x")
+            self.assertIs(folder, scheduler._load("a" + os.sep + "x"))
+            self.assertIs(folder.cabinet, scheduler._load("a"))
+
+            # an invalid target fails only when the job runs
+            self.assertIsNone(scheduler.submit("sync", "a" + os.sep + "z").group_uuid)
+        finally:
+            shutil.rmtree(path)
+
+    def test_stop_cancels_jobs(self):
+        scheduler = Scheduler(None, jobs=1)
+        cleaned = threading.Event()
+
+        def run(job):
+            try:
+                while not job.token.is_cancelled:
+                    time.sleep(0.01)
+                job.state = "cancelled"
+            finally:
+                cleaned.set()
+
+        scheduler._run = run
+        scheduler.start()
+
+        running = scheduler.submit("sync", "a")
+
+        while running.started is None:
+            time.sleep(0.01)
+
+        waiting = scheduler.submit("sync", "b")
+
+        scheduler.stop()
+
+        self.assertTrue(cleaned.is_set())
+        self.assertFalse(any(worker.is_alive() for worker in scheduler.workers))
+
+        for job in [ running, waiting ]:
+            self.assertTrue(job.done.is_set())
+            self.assertEqual("cancelled", job.state)
+
+class TestDaemon(unittest.TestCase):
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+
+        self.archive = Archive(os.path.join(self.path, "archive"))
+        self.archive.init()
+
+        with open(get_config_path(self.archive), "w") as fp:
+            fp.write("[daemon]\njobs = 1\n[target missing]\nsnapshotInterval = 3600\n")
+
+        self.daemon = Daemon(self.archive)
+        self.thread = threading.Thread(target=self.daemon.run)
+        self.thread.start()
+
+        self.client = Client(self.archive)
+
+        while not self.client.is_running:
+            time.sleep(0.01)
+
+    def tearDown(self):
+        self.client.stop()
+        self.thread.join()
+        shutil.rmtree(self.path)
+
+    def test_submit_and_status(self):
+        self.assertEqual(1, len(self.daemon.schedules))
+
+        with self.assertRaisesRegex(Exception, "Cabinet not found"):
+            self.client.submit("snapshot", "missing")
+
+        job = self.client.status()[0]
+
+        self.assertEqual("failure", job['state'])
+        self.assertEqual("missing", job['target'])
+
+    def _slow_run(self, job):
+        # a job that runs for longer than the client poll interval
+        for i in range(10):
+            if job.token.is_cancelled:
+                job.state = "cancelled"
+                return
+            time.sleep(0.1)
+
+        job.state = "success"
+
+    def test_wait_with_cancellation_token(self):
+        self.daemon.scheduler._run = self._slow_run
+
+        with archivist.util.cancellation(archivist.util.CancellationToken()):
+            job = self.client.submit("snapshot", "slow")
+
+        self.assertEqual("success", job['state'])
+
+    def test_cancel_waiting_client(self):
+        self.daemon.scheduler._run = self._slow_run
+        token = archivist.util.CancellationToken()
+
+        threading.Timer(0.3, token.cancel).start()
+
+        with archivist.util.cancellation(token):
+            with self.assertRaises(archivist.util.OperationCancelled):
+                self.client.submit("snapshot", "slow")
+
+        self.assertEqual("cancelled", self.client.status()[0]['state'])
+
+    def _chatty_run(self, job):
+        # a job that sends progress more often than the client poll interval
+        progress = archivist.daemon._JobProgress(job, self.daemon.scheduler.lock)
+
+        for i in range(100):
+            if job.token.is_cancelled:
+                job.state = "cancelled"
+                return
+            progress.on_progress("step %d\n" % i)
+            time.sleep(0.02)
+
+        job.state = "success"
+
+    def test_cancel_job_with_progress(self):
+        self.daemon.scheduler._run = self._chatty_run
+        token = archivist.util.CancellationToken()
+
+        threading.Timer(0.3, token.cancel).start()
+        start = time.monotonic()
+
+        with archivist.util.cancellation(token):
+            with self.assertRaises(archivist.util.OperationCancelled):
+                self.client.submit("snapshot", "chatty", progress=archivist.util.ProgressMonitor())
+
+        self.assertLess(time.monotonic() - start, 1.5)
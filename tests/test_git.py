@@ -0,0 +1,136 @@
+#
+#   Copyright 2016 Lorenzo Keller
+#
+#   This file is part of archivist
+#
+#
+#   archivist is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation, either version 3 of the License, or
+#   (at your option) any later version.
+#
+#   archivist is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with archivist.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+
+
+
+import archivist.profile
+import archivist.git
+
+import unittest
+import subprocess
+import tempfile
+import shutil
+import os
+
+class TestGit(unittest.TestCase):
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+
+        def git(*args):
+            subprocess.check_call(['git', '-c', 'user.name=test', 
+                                   '-c', 'user.email=test@example.com'] + list(args), 
+                                  cwd=self.path, stdout=subprocess.DEVNULL)
+
+        self.git = git
+
+        def git_output(*args):
+            return subprocess.check_output(['git'] + list(args), cwd=self.path).decode("utf-8").strip()
+
+        self.git_output = git_output
+
+        git('init', '-q', '.')
+
+        with open(os.path.join(self.path, 'file'), 'w') as fp:
+            fp.write("content\n")
+
+        git('add', 'file')
+        git('commit', '-q', '-m', 'test')
+
+        self.pool = archivist.git.HelperPool()
+
+    def tearDown(self):
+        self.pool.close()
+        shutil.rmtree(self.path)
+
+    def test_read_blob(self):
+        helper = self.pool.cat_file(self.path)
+
+        self.assertEqual(b"content\n", helper.read("HEAD:file"))
+        self.assertIsNone(helper.read("HEAD:missing"))
+        self.assertEqual(b"content\n", helper.read("HEAD:file"))
+
+        self.assertIs(helper, self.pool.cat_file(self.path))
+
+    def test_evict(self):
+        helper = self.pool.cat_file(self.path)
+
+        self.pool.idle_timeout = 0
+        self.pool.evict()
+
+        self.assertFalse(helper.is_alive)
+        self.assertIsNot(helper, self.pool.cat_file(self.path))
+
+    def test_config(self):
+        self.git('config', 'annex.uuid', 'first')
+        self.assertEqual("first", self.pool.config(self.path)["annex.uuid"])
+
+        self.git('config', 'annex.uuid', 'second')
+        self.assertEqual("second", self.pool.config(self.path)["annex.uuid"])
+
+    def test_truncated_pack(self):
+        self.git('gc', '-q')
+
+        pack_dir = os.path.join(self.path, '.git', 'objects', 'pack')
+
+        for name in os.listdir(pack_dir):
+            if name.endswith(".pack"):
+                with open(os.path.join(pack_dir, name), "r+b") as fp:
+                    fp.truncate(os.path.getsize(fp.name) // 2)
+
+        # git doesn't find the objects either
+        self.assertIsNone(archivist.git.read_blob(self.path, "HEAD:file"))
+        self.assertEqual(self.git_output('rev-parse', 'HEAD'), 
+                         archivist.git.resolve(self.path, "HEAD"))
+
+    def test_sha256(self):
+        path = os.path.join(self.path, "sha256")
+
+        self.git('init', '-q', '--object-format=sha256', path)
+
+        with open(os.path.join(path, 'file'), 'w') as fp:
+            fp.write("content\n")
+
+        self.git('-C', path, 'add', 'file')
+        self.git('-C', path, 'commit', '-q', '-m', 'test')
+
+        self.assertEqual(b"content\n", archivist.git.read_blob(path, "HEAD:file"))
+        self.assertEqual(64, len(archivist.git.resolve(path, "HEAD")))
+        self.assertEqual(self.git_output('-C', path, 'symbolic-ref', 'HEAD'), 
+                         archivist.git.head(path))
+
+    def test_profile(self):
+        archivist.profile.start()
+
+        try:
+            self.pool.cat_file(self.path).read("HEAD:file")
+            self.pool.close()
+
+            events = archivist.profile.profiler.events
+        finally:
+            archivist.profile.profiler = None
+
+        self.assertEqual(["git cat-file"], [ event['name'] for event in events ])
+        self.assertEqual(8, events[0]['args']['output_bytes'])
+
+    def test_normalize_key(self):
+        self.assertEqual("remote.Origin.url", archivist.git._normalize_key("Remote.Origin.URL"))
+        self.assertEqual("annex.uuid", archivist.git._normalize_key("annex.UUID"))
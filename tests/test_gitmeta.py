@@ -0,0 +1,111 @@
+#
+#   Copyright 2016 Lorenzo Keller
+#
+#   This file is part of archivist
+#
+#
+#   archivist is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation, either version 3 of the License, or
+#   (at your option) any later version.
+#
+#   archivist is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with archivist.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+
+
+
+import archivist.gitmeta
+
+import unittest
+import subprocess
+import tempfile
+import shutil
+import os
+
+class TestGitMeta(unittest.TestCase):
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+
+        self.git('init', '-q', '.')
+
+        # create a few versions of a file so that packing creates deltas
+        for i in range(5):
+            with open(os.path.join(self.path, 'file'), 'w') as fp:
+                fp.write("".join("line %d\n" % j for j in range(200 + i)))
+
+            os.makedirs(os.path.join(self.path, 'dir'), exist_ok=True)
+
+            with open(os.path.join(self.path, 'dir', 'other'), 'w') as fp:
+                fp.write("version %d\n" % i)
+
+            self.git('add', '.')
+            self.git('commit', '-q', '-m', 'version %d' % i)
+
+        self.git('branch', 'side', 'HEAD~2')
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def git(self, *args):
+        return subprocess.check_output(['git', '-c', 'user.name=test', 
+                                        '-c', 'user.email=test@example.com'] + list(args), 
+                                       cwd=self.path)
+
+    def check_blobs(self):
+        repository = archivist.gitmeta.Repository(self.path)
+
+        for rev in ["HEAD:file", "side:file", "HEAD:dir/other", "side:dir/other"]:
+            self.assertEqual(self.git('cat-file', 'blob', rev), repository.read_blob(rev))
+
+        self.assertIsNone(repository.read_blob("HEAD:missing"))
+        self.assertIsNone(repository.read_blob("missing:file"))
+
+        self.assertEqual(self.git('rev-parse', 'side').decode("ascii").strip(), 
+                         repository.resolve("side"))
+
+    def test_loose(self):
+        self.check_blobs()
+
+    def test_packed(self):
+        self.git('gc', '-q', '--aggressive')
+
+        self.assertEqual([], [ x for x in os.listdir(os.path.join(self.path, '.git', 'objects')) 
+                                        if len(x) == 2 ])
+        self.check_blobs()
+
+    def test_head(self):
+        self.assertEqual(self.git('symbolic-ref', 'HEAD').decode("utf-8").strip(), 
+                         archivist.gitmeta.Repository(self.path).head)
+
+    def test_config(self):
+        self.git('config', 'annex.uuid', 'abc')
+        self.git('config', 'remote.Some Name.url', '/path/with "quotes"')
+        self.git('config', 'core.flag', 'value ; with comment chars')
+
+        config = archivist.gitmeta.Repository(self.path).config
+
+        self.assertEqual("abc", config["annex.uuid"])
+        self.assertEqual('/path/with "quotes"', config["remote.Some Name.url"])
+        self.assertEqual('value ; with comment chars', config["core.flag"])
+
+    def test_config_include(self):
+        self.git('config', 'include.path', 'other')
+
+        with self.assertRaises(archivist.gitmeta.UnsupportedRepository):
+            archivist.gitmeta.Repository(self.path).config
+
+    def test_sha256(self):
+        path = os.path.join(self.path, "sha256")
+
+        subprocess.check_call(['git', 'init', '-q', '--object-format=sha256', path])
+
+        with self.assertRaises(archivist.gitmeta.UnsupportedRepository):
+            archivist.gitmeta.Repository(path)
@@ -0,0 +1,597 @@
+#
+#   Copyright 2016 Lorenzo Keller
+#
+#   This file is part of archivist
+#
+#
+#   archivist is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation, either version 3 of the License, or
+#   (at your option) any later version.
+#
+#   archivist is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with archivist.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+
+
+
+from archivist.model import *
+
+import unittest
+import unittest.mock
+import json
+import tempfile
+import threading
+import subprocess
+import shutil
+import os
+
+class ArchiveTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.cabinet_path = os.path.join(self.path, "cabinet")
+
+        os.makedirs(self.cabinet_path)
+
+        self.archive = Archive(os.path.join(self.path, "archive"))
+        self.archive.init()
+        self.archive.add_cabinet("cabinet", "plain", { 'storagePath' : self.cabinet_path })
+
+        self.cabinet = self.archive.get_cabinet("cabinet")
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def make_folder(self, name, group_uuid=None):
+        os.makedirs(os.path.join(self.cabinet_path, name, ".git"))
+
+        with open(os.path.join(self.cabinet_path, name, ".git", "archivist"), "w") as fp:
+            fp.write("[folder]\ntype = plain\ngroupUuid = %s\n" % (group_uuid or name))
+
+        with open(os.path.join(self.cabinet_path, name, ".git", "config"), "w") as fp:
+            fp.write("[annex]\n\tuuid = uuid-%s\n" % name)
+
+class FolderTestCase(ArchiveTestCase):
+
+    def setUp(self):
+        ArchiveTestCase.setUp(self)
+
+        self.make_folder("a")
+        self.folder = self.cabinet.get_folder("a")
+
+        for args in [ ['init', '-q', '.'], ['config', 'user.name', 'test'], 
+                      ['config', 'user.email', 'test@example.com'] ]:
+            self.git(*args)
+
+        self.write("file", "content")
+
+    def git(self, *args):
+        return subprocess.check_output(['git'] + list(args), cwd=self.folder.storage_path)
+
+    def write(self, name, content):
+        path = os.path.join(self.folder.storage_path, name)
+
+        with open(path, "w") as fp:
+            fp.write(content)
+
+        # old enough not to be considered racy
+        os.utime(path, (0, 0))
+
+    def commits(self):
+        return len(self.git('log', '--oneline').splitlines())
+
+class TestCabinetIndex(ArchiveTestCase):
+
+    def age(self):
+        # make all modification times old enough to be trusted
+        for dirpath, dirnames, filenames in os.walk(self.cabinet_path):
+            os.utime(dirpath, (0, 0))
+
+    def names(self, **kwargs):
+        return [ folder.name for folder in self.cabinet.get_folders(**kwargs) ]
+
+    def test_new_and_removed_folders(self):
+        self.make_folder("a")
+        self.make_folder("sub/b")
+        os.makedirs(os.path.join(self.cabinet_path, "a", "inner"))
+
+        self.assertEqual(["a", "sub/b"], self.names())
+
+        self.make_folder("sub/c")
+        self.assertEqual(["a", "sub/b", "sub/c"], self.names())
+
+        shutil.rmtree(os.path.join(self.cabinet_path, "sub", "b"))
+        self.assertEqual(["a", "sub/c"], self.names())
+
+    def test_unchanged_directories_not_listed(self):
+        self.make_folder("sub/a")
+        self.age()
+
+        self.assertEqual(["sub/a"], self.names())
+
+        listed = []
+        scandir = os.scandir
+
+        def tracking_scandir(path):
+            listed.append(path)
+            return scandir(path)
+
+        os.scandir = tracking_scandir
+
+        try:
+            self.assertEqual(["sub/a"], self.names())
+            self.assertEqual([], listed)
+
+            self.assertEqual(["sub/a"], self.names(rescan=True))
+            self.assertNotEqual([], listed)
+        finally:
+            os.scandir = scandir
+
+class TestGroupsIndex(ArchiveTestCase):
+
+    def test_group_folders(self):
+        self.make_folder("a", "group")
+        self.make_folder("b", "group")
+        self.make_folder("c", "other")
+
+        folders = self.archive.get_group_folders("group", ["uuid-a"])
+        self.assertEqual(["a", "b"], sorted(folder.name for folder in folders))
+
+        # a new clone is found because its uuid is not in the index
+        self.make_folder("d", "group")
+
+        folders = self.archive.get_group_folders("group", ["uuid-a", "uuid-d"])
+        self.assertEqual(["a", "b", "d"], sorted(folder.name for folder in folders))
+
+    def test_renamed_clone_found(self):
+        self.make_folder("a", "group")
+        self.make_folder("b", "group")
+
+        self.assertEqual(["a", "b"], sorted(x.name for x in self.archive.get_group_folders("group")))
+
+        os.rename(os.path.join(self.cabinet_path, "b"), os.path.join(self.cabinet_path, "c"))
+
+        for i in range(2):
+            folders = self.archive.get_group_folders("group", ["uuid-a", "uuid-b"])
+            self.assertEqual(["a", "c"], sorted(folder.name for folder in folders))
+
+    def test_unknown_uuid_searched_once(self):
+        self.make_folder("a", "group")
+
+        searches = []
+        update_groups_index = self.archive.update_groups_index
+
+        def tracking_update():
+            searches.append(True)
+            return update_groups_index()
+
+        self.archive.update_groups_index = tracking_update
+
+        for i in range(3):
+            folders = self.archive.get_group_folders("group", ["uuid-a", "uuid-elsewhere"])
+            self.assertEqual(["a"], [ folder.name for folder in folders ])
+
+        self.assertEqual(1, len(searches))
+
+    def test_register_waits_for_groups_lock(self):
+        self.make_folder("a", "group")
+        folder = self.cabinet.get_folder("a")
+
+        # flock() excludes the other open files too, like other processes
+        with self.archive._groups_lock():
+            thread = threading.Thread(target=self.archive.register_folder, args=(folder,))
+            thread.start()
+            thread.join(0.3)
+
+            self.assertTrue(thread.is_alive())
+            self.assertEqual({}, self.archive._load_groups())
+
+        thread.join()
+
+        self.assertEqual(["uuid-a"], [ x['uuid'] for x in self.archive._load_groups()['group']['clones'] ])
+
+class TestSyncPlan(ArchiveTestCase):
+
+    def test_hub_in_cheapest_cabinet(self):
+        other_path = os.path.join(self.path, "other")
+        os.makedirs(other_path)
+
+        self.archive.add_cabinet("other", "plain", { 'storagePath' : other_path })
+
+        config = configparser.ConfigParser()
+        config.read(os.path.join(self.archive.cabinets_path, "other"))
+        config["cabinet"]["transferCost"] = "0"
+
+        with open(os.path.join(self.archive.cabinets_path, "other"), "w") as fp:
+            config.write(fp)
+
+        self.make_folder("a")
+        self.make_folder("b")
+        os.makedirs(os.path.join(other_path, "c", ".git"))
+        shutil.copy(os.path.join(self.cabinet_path, "a", ".git", "archivist"), 
+                    os.path.join(other_path, "c", ".git", "archivist"))
+
+        a = self.cabinet.get_folder("a")
+        b = self.cabinet.get_folder("b")
+        c = self.archive.get_cabinet("other").get_folder("c")
+
+        self.assertEqual(0, c.cabinet.transfer_cost)
+
+        plan = SyncPlan.create(a, [b, c])
+        self.assertEqual("other" + os.sep + "c", plan.hub.full_name)
+        self.assertEqual([a, b], plan.spokes)
+
+        plan = SyncPlan.create(a, [b, c], "direct")
+        self.assertIs(a, plan.hub)
+
+        # ties are broken in favour of the folder being synced
+        plan = SyncPlan.create(b, [a])
+        self.assertIs(b, plan.hub)
+
+        # partial folders don't have all the content
+        c.config['folder']['preferredContent'] = "present"
+        plan = SyncPlan.create(a, [b, c])
+        self.assertIs(a, plan.hub)
+
+class TestTransferSettings(ArchiveTestCase):
+
+    def test_settings_applied_to_remotes(self):
+        other_path = os.path.join(self.path, "other")
+        os.makedirs(other_path)
+
+        self.archive.add_cabinet("other", "plain", { 'storagePath' : other_path }, 
+                                    { 'jobs' : 8, 'bwlimit' : '10MiB' })
+
+        cabinet = self.archive.get_cabinet("other")
+
+        self.assertEqual({ 'jobs' : 8, 'bwlimit' : '10MiB', 'stallDetection' : '' }, 
+                            cabinet.transfer_settings)
+        self.assertEqual(1, self.cabinet.transfer_settings['jobs'])
+
+        self.make_folder("a")
+        os.makedirs(os.path.join(other_path, "b", ".git"))
+        shutil.copy(os.path.join(self.cabinet_path, "a", ".git", "archivist"), 
+                    os.path.join(other_path, "b", ".git", "archivist"))
+
+        with open(os.path.join(other_path, "b", ".git", "config"), "w") as fp:
+            fp.write("[annex]\n\tuuid = uuid-b\n")
+
+        folder = self.cabinet.get_folder("a")
+        clone = cabinet.get_folder("b")
+
+        options, jobs = folder._transfer_settings([clone])
+
+        self.assertEqual(['-c', 'remote.archivist.uuid-b.annex-bwlimit=10MiB'], options)
+        self.assertEqual({ 'archivist.uuid-b' : 8 }, jobs)
+
+        # both cabinets are in the same temporary directory
+        self.assertTrue(folder._is_local_to(cabinet))
+
+class TestPreferredContent(FolderTestCase):
+
+    def test_preferred_content(self):
+        log = ("uuid-a present timestamp=1476800000.5s\n"
+               "uuid-b largerthan=1mb and include=* timestamp=1476800012s\n"
+               "uuid-a anything timestamp=1476800011s\n"
+               "uuid-b nothing timestamp=bogus\n"
+               "uuid-c\n")
+
+        blob = subprocess.check_output(['git', 'hash-object', '-w', '--stdin'], 
+                                       input=log.encode("utf-8"), 
+                                       cwd=self.folder.storage_path).decode("utf-8").strip()
+        tree = subprocess.check_output(['git', 'mktree'], 
+                                       input=("100644 blob %s\tpreferred-content.log\n" % blob).encode("utf-8"), 
+                                       cwd=self.folder.storage_path).decode("utf-8").strip()
+        commit = self.git('commit-tree', tree, '-m', 'log').decode("utf-8").strip()
+        self.git('update-ref', 'refs/heads/git-annex', commit)
+
+        self.assertEqual({ 'uuid-a' : 'anything', 'uuid-b' : 'largerthan=1mb and include=*' }, 
+                         self.folder._preferred_content())
+
+    def test_auto_option(self):
+        wanted = { 'uuid-a' : 'present' }
+
+        self.assertEqual(['--auto'], self.folder._auto_option(wanted, 'uuid-a'))
+
+        # like sync --content all the content goes to the other repositories
+        self.assertEqual(['.'], self.folder._auto_option(wanted, 'uuid-b'))
+        self.assertEqual(['.'], self.folder._auto_option(wanted, None))
+
+class TestStorageMode(ArchiveTestCase):
+
+    def test_storage_mode(self):
+        self.make_folder("a")
+        self.assertEqual("unlocked", self.cabinet.get_folder("a").storage_mode)
+
+        with open(os.path.join(self.cabinet_path, "a", ".git", "archivist"), "a") as fp:
+            fp.write("storageMode = thin\n")
+
+        self.assertEqual("thin", self.cabinet.get_folder("a").storage_mode)
+
+        with self.assertRaisesRegex(Exception, "Unsupported storage mode"):
+            self.cabinet.create_folder("b", "plain", { 'storageMode' : 'compressed' })
+
+        self.assertFalse(os.path.exists(os.path.join(self.cabinet_path, "b")))
+
+    def test_locked_mode_on_crippled_file_system(self):
+        dirname = os.path.join(self.path, "crippled")
+
+        subprocess.check_output(['git', 'init', '-q', dirname])
+        subprocess.check_output(['git', 'config', 'annex.crippledfilesystem', 'true'], cwd=dirname)
+
+        commands = []
+
+        # git annex init found a file system without symlinks
+        with unittest.mock.patch("archivist.util.exec", lambda command, **kwargs: commands.append(command)):
+            with self.assertRaisesRegex(Exception, "Locked mode is not supported"):
+                Folder._init_annex(Folder, dirname, { 'storageMode' : 'locked' }, None)
+
+        self.assertEqual([['git', 'annex', 'init', '--version=6']], commands)
+
+    @unittest.skipIf(shutil.which("git-annex") is None, "git-annex is not installed")
+    @unittest.mock.patch.dict(os.environ, { 'GIT_AUTHOR_NAME' : 'test', 
+                                            'GIT_AUTHOR_EMAIL' : 'test@example.com', 
+                                            'GIT_COMMITTER_NAME' : 'test', 
+                                            'GIT_COMMITTER_EMAIL' : 'test@example.com' })
+    def test_clone_storage_modes(self):
+        self.cabinet.create_folder("a", "plain", {})
+        folder = self.cabinet.get_folder("a")
+
+        with open(os.path.join(folder.storage_path, "file"), "w") as fp:
+            fp.write("content")
+
+        folder.snapshot()
+
+        folder.clone(self.cabinet, "locked", storage_mode="locked")
+        locked = self.cabinet.get_folder("locked")
+
+        self.assertEqual("refs/heads/master", archivist.git.head(locked.storage_path))
+        self.assertTrue(os.path.islink(os.path.join(locked.storage_path, "file")))
+
+        folder.clone(self.cabinet, "thin", storage_mode="thin")
+        thin = self.cabinet.get_folder("thin")
+
+        self.assertEqual("true", archivist.git.get_config(thin.storage_path, "annex.thin"))
+
+        # the working tree files of the folders are not shared
+        self.assertNotEqual(os.stat(os.path.join(folder.storage_path, "file")).st_ino, 
+                            os.stat(os.path.join(thin.storage_path, "file")).st_ino)
+
+class TestLargeFiles(FolderTestCase):
+
+    def test_large_blobs(self):
+        self.write("big", "x" * 2000)
+        self.write("small.jpg", "x" * 10)
+        self.folder.snapshot()
+
+        self.assertEqual([("big", 2000)], self.folder.find_large_blobs(1000))
+        self.assertEqual([], self.folder.find_large_blobs())
+
+        Folder._write_large_files_rules(self.folder.storage_path, 
+                                        { 'largeFilesSize' : '1kb', 
+                                          'largeFilesGlobs' : '*.jpg' }, None)
+
+        self.assertEqual([("big", 2000), ("small.jpg", 10)], self.folder.find_large_blobs())
+
+    def test_migrate_large_blobs(self):
+        Folder._write_large_files_rules(self.folder.storage_path, 
+                                        { 'largeFilesSize' : '1kb' }, None)
+        self.write("big", "x" * 2000)
+        self.folder.snapshot()
+
+        # the folder isn't an annex, git add keeps the file in git
+        self.folder.migrate_large_blobs(["big", "file"])
+
+        self.assertEqual(1, self.commits())
+        self.assertEqual([("big", 2000)], self.folder.find_large_blobs())
+
+    @unittest.skipIf(shutil.which("git-annex") is None, "git-annex is not installed")
+    def test_migrate_large_blobs_to_annex(self):
+        self.cabinet.create_folder("b", "plain", { 'largeFilesSize' : '1kb' })
+        folder = self.cabinet.get_folder("b")
+        rules_path = os.path.join(folder.storage_path, ".gitattributes")
+
+        with open(rules_path) as fp:
+            rules = fp.read()
+
+        # the file was added to git before the rules were in place
+        with open(rules_path, "w") as fp:
+            fp.write("* annex.largefiles=nothing\n")
+
+        with open(os.path.join(folder.storage_path, "big"), "w") as fp:
+            fp.write("x" * 2000)
+
+        folder.snapshot()
+
+        with open(rules_path, "w") as fp:
+            fp.write(rules)
+
+        folder.snapshot()
+
+        self.assertEqual([("big", 2000)], folder.find_large_blobs())
+
+        folder.migrate_large_blobs(["big"])
+
+        self.assertEqual([], folder.find_large_blobs())
+        self.assertEqual([], folder.find_large_blobs(1000))
+
+    def test_large_files_rules(self):
+        Folder._write_large_files_rules(self.folder.storage_path, 
+                                        { 'largeFilesSize' : '100kb', 
+                                          'largeFilesGlobs' : '*.jpg *.mp4' }, None)
+
+        with open(os.path.join(self.folder.storage_path, ".gitattributes")) as fp:
+            self.assertEqual(["* annex.largefiles=largerthan=100kb", 
+                              "*.jpg annex.largefiles=anything", 
+                              "*.mp4 annex.largefiles=anything"], fp.read().splitlines())
+
+    def test_large_files_size_with_spaces(self):
+        Folder._write_large_files_rules(self.folder.storage_path, 
+                                        { 'largeFilesSize' : '1.5 GiB' }, None)
+
+        self.assertEqual(b"file: annex.largefiles: largerthan=1.5GiB\n", 
+                         self.git('check-attr', 'annex.largefiles', 'file'))
+
+class TestSyncJournal(unittest.TestCase):
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.journal_path = os.path.join(self.path, "journal")
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def test_resume(self):
+        journal = SyncJournal(self.journal_path, ["b", "a"])
+        self.assertFalse(journal.is_resumed)
+
+        journal.mark("commit")
+        journal.mark("sync", "a")
+
+        # the sync was interrupted
+        journal = SyncJournal(self.journal_path, ["a", "b"])
+
+        self.assertTrue(journal.is_resumed)
+        self.assertTrue(journal.is_done("commit"))
+        self.assertTrue(journal.is_done("sync", "a"))
+        self.assertFalse(journal.is_done("sync", "b"))
+
+        # a different set of clones starts from scratch
+        self.assertFalse(SyncJournal(self.journal_path, ["a"]).is_resumed)
+
+        journal.remove()
+        self.assertFalse(os.path.exists(self.journal_path))
+
+    def test_stale_journal(self):
+        state = { 'a' : 'commit-1' }
+
+        journal = SyncJournal(self.journal_path, ["a"], lambda: dict(state))
+        journal.mark("commit")
+
+        self.assertTrue(SyncJournal(self.journal_path, ["a"], lambda: dict(state)).is_resumed)
+
+        # the folders changed after the sync was interrupted
+        state['a'] = 'commit-2'
+
+        self.assertFalse(SyncJournal(self.journal_path, ["a"], lambda: dict(state)).is_resumed)
+
+    def test_unmark(self):
+        journal = SyncJournal(self.journal_path, ["a"])
+        journal.mark("sync", "a")
+        journal.unmark("sync", "a")
+        journal.unmark("annex sync")
+
+        self.assertFalse(journal.is_done("sync", "a"))
+        self.assertFalse(SyncJournal(self.journal_path, ["a"]).is_done("sync", "a"))
+
+class TestSyncLedger(FolderTestCase):
+
+    def test_ledger(self):
+        self.folder.snapshot()
+
+        self.make_folder("b")
+        clone = self.cabinet.get_folder("b")
+
+        for args in [ ['init', '-q', '.'], ['commit', '-q', '--allow-empty', '-m', 'x'] ]:
+            subprocess.check_output(['git', '-c', 'user.name=test', '-c', 'user.email=test@example.com'] + args, 
+                                    cwd=clone.storage_path)
+
+        clone.snapshot()
+
+        self.assertFalse(self.folder._is_up_to_date([clone]))
+
+        self.folder._save_ledger([clone])
+        self.assertTrue(self.folder._is_up_to_date([clone]))
+
+        # a new commit in the clone
+        subprocess.check_output(['git', '-c', 'user.name=test', '-c', 'user.email=test@example.com', 
+                                 'commit', '-q', '--allow-empty', '-m', 'y'], cwd=clone.storage_path)
+        self.assertFalse(self.folder._is_up_to_date([clone]))
+
+        self.folder._save_ledger([clone])
+        self.assertTrue(self.folder._is_up_to_date([clone]))
+
+        # uncommitted changes in the folder
+        self.write("file", "changed content")
+        self.assertFalse(self.folder._is_up_to_date([clone]))
+
+    def test_refresh_manifest_after_merge(self):
+        self.folder.snapshot()
+
+        # a merge changes the working tree and HEAD
+        self.write("file", "merged content")
+        self.git('commit', '-q', '-a', '-m', 'merge')
+        self.assertTrue(self.folder.has_changes())
+
+        self.folder._refresh_manifest()
+        self.assertFalse(self.folder.has_changes())
+
+        # the manifest isn't saved while there are uncommitted changes
+        self.write("file", "uncommitted")
+        self.folder._refresh_manifest()
+        self.assertTrue(self.folder.has_changes())
+
+class TestDirtyTracking(FolderTestCase):
+
+    def test_snapshot_skips_unchanged(self):
+        self.assertTrue(self.folder.has_changes())
+
+        self.folder.snapshot()
+        self.assertEqual(1, self.commits())
+        self.assertFalse(self.folder.has_changes())
+
+        self.folder.snapshot()
+        self.assertEqual(1, self.commits())
+
+        self.write("file", "changed content")
+        self.assertTrue(self.folder.has_changes())
+
+        self.folder.snapshot()
+        self.assertEqual(2, self.commits())
+
+        self.folder.snapshot(force=True)
+        self.assertEqual(3, self.commits())
+
+    def test_replaced_file_detected(self):
+        self.folder.snapshot()
+
+        # same size and modification time, different inode
+        self.write("other", "CONTENT")
+        os.replace(os.path.join(self.folder.storage_path, "other"), 
+                   os.path.join(self.folder.storage_path, "file"))
+
+        self.assertTrue(self.folder.has_changes())
+
+    def test_recent_files_are_racy(self):
+        self.folder.snapshot()
+
+        os.utime(os.path.join(self.folder.storage_path, "file"))
+
+        with open(self.folder.manifest_path) as fp:
+            manifest = json.load(fp)
+
+        manifest['files']['file'][1] = os.stat(os.path.join(self.folder.storage_path, "file")).st_mtime_ns
+
+        with open(self.folder.manifest_path, "w") as fp:
+            json.dump(manifest, fp)
+
+        self.assertTrue(self.folder.has_changes())
+
+class TestFolderLock(FolderTestCase):
+
+    def test_snapshot_waits_for_lock(self):
+        self.archive.lock_timeout = 0.2
+
+        with self.folder.lock(operation="sync"):
+            with self.assertRaisesRegex(archivist.util.LockTimeout, "sync cabinet"):
+                self.folder.snapshot()
+
+        self.folder.snapshot()
+        self.assertEqual(1, self.commits())
@@ -20,13 +20,24 @@
 
 
 
-import sync.util
+import archivist.util
+import archivist.profile
 
 import unittest
 
 import subprocess
+import threading
+import tempfile
+import time
+import socket
+import shutil
+import json
+import os
+
+class TestProgressMonitor(archivist.util.ProgressMonitor):
+
+    per_line = True
 
-class TestProgressMonitor(sync.util.ProgressMonitor):
     def __init__(self, test, expect_out, expect_err):
         self.test = test
         self.expect_err = expect_err
@@ -52,22 +63,358 @@ class TestUtils(unittest.TestCase):
 
         data = ["a", "b", "c"]
 
-        sync.util.exec(["echo", "-e", r"\n".join(data)], 
+        archivist.util.exec(["echo", "-e", r"\n".join(data)], 
                         progress=TestProgressMonitor(self, data, None))
 
     def test_exec_callbacks_stderr(self):
 
         data = ["a", "b", "c"]
 
-        sync.util.exec(["sh", "-c", "echo -e " + r"\\n".join(data) + " >&2"], 
+        archivist.util.exec(["sh", "-c", "printf '" + r"\n".join(data) + r"\n' >&2"], 
                         progress=TestProgressMonitor(self, None, data))
 
     def test_exec_fail(self):
 
         try:
 
-            sync.util.exec(["false"]) 
+            archivist.util.exec(["false"]) 
             self.fail("Return code not zero didn't generate exception")
 
         except subprocess.CalledProcessError:
             pass
+
+    def test_exec_split_utf8(self):
+
+        # the first read returns half of the encoded character
+        data = ["\u00e8\u00e8", "b"]
+
+        archivist.util.exec(["sh", "-c", r"printf '\303'; sleep 0.1; printf '\250\303\250\nb\n'"],
+                        progress=TestProgressMonitor(self, data, None))
+
+    def test_exec_last_line_without_newline(self):
+
+        output = []
+
+        class Monitor(archivist.util.ProgressMonitor):
+            per_line = True
+
+            def on_progress(self, message):
+                output.append(message)
+
+        archivist.util.exec(["printf", "a\\nb"], progress=Monitor())
+
+        self.assertEqual(["a\n", "b"], output)
+
+    def test_exec_split_only_on_newline(self):
+
+        output = []
+
+        class Monitor(archivist.util.ProgressMonitor):
+            per_line = True
+
+            def on_progress(self, message):
+                output.append(message)
+
+        # form feed, vertical tab and unicode line separator
+        archivist.util.exec(["printf", "a\\fb\\vc\\342\\200\\250d\\ne"], progress=Monitor())
+
+        self.assertEqual(["a\fb\vc\u2028d\n", "e"], output)
+
+    def test_exec_coalesced(self):
+
+        output = []
+
+        class Monitor(archivist.util.ProgressMonitor):
+            def on_progress(self, message):
+                output.append(message)
+
+        archivist.util.exec(["sh", "-c", r"printf 'a\nb\n'; sleep 0.3; printf 'c\n'"], 
+                            progress=Monitor())
+
+        self.assertEqual(["a\nb\n", "c\n"], output)
+
+    def test_runner_max_size(self):
+
+        output = []
+
+        class Monitor(archivist.util.ProgressMonitor):
+            def on_progress(self, message):
+                output.append(message)
+
+        runner = archivist.util.ProcessRunner(interval=10, max_size=4)
+        runner.wait(runner.start(["sh", "-c", r"printf 'aa\n'; sleep 0.1; printf 'bb\n'; sleep 0.1; printf 'c\n'"], 
+                                 progress=Monitor()))
+        runner.close()
+
+        self.assertEqual(["aa\nbb\n", "c\n"], output)
+
+    def test_runner_multiple_processes(self):
+
+        runner = archivist.util.ProcessRunner()
+
+        first_data = ["a", "b"]
+        second_data = ["c", "d"]
+
+        first = runner.start(["sh", "-c", r"printf 'a\n'; sleep 0.2; printf 'b\n'"],
+                        progress=TestProgressMonitor(self, first_data, None))
+        second = runner.start(["sh", "-c", r"printf 'c\nd\n'"],
+                        progress=TestProgressMonitor(self, second_data, None))
+
+        runner.wait(second)
+        runner.wait(first)
+        runner.close()
+
+        self.assertEqual([], first_data)
+        self.assertEqual([], second_data)
+
+    def test_run_parallel(self):
+
+        def action(item):
+            if item == 2:
+                raise ValueError("failed")
+
+        results = archivist.util.run_parallel([1, 2, 3], action, jobs=2)
+
+        self.assertEqual([1, 2, 3], [ item for item, error in results ])
+        self.assertIsNone(results[0][1])
+        self.assertIsInstance(results[1][1], ValueError)
+        self.assertIsNone(results[2][1])
+
+    def test_prefixed_progress(self):
+
+        data = ["[x] a", "[x] b"]
+
+        progress = archivist.util.PrefixedProgress(
+                        TestProgressMonitor(self, data, None), "[x] ", threading.Lock())
+
+        progress.on_progress("a\n")
+        progress.on_progress("b\n")
+
+        self.assertEqual([], data)
+
+        # a carriage return doesn't end a line
+        data.append("[x] 10%\r20%\n[x] \n[x] c")
+
+        progress.on_progress("10%\r20%\n\nc\n")
+
+        self.assertEqual([], data)
+
+    def test_transfer_tracker(self):
+
+        transfers = []
+        lines = []
+
+        class Monitor(archivist.util.ProgressMonitor):
+            def on_progress(self, message):
+                lines.append(message)
+
+            def on_transfer(self, transfer):
+                transfers.append((transfer.file, transfer.remote, transfer.bytes, 
+                                  transfer.finished is not None))
+
+        tracker = archivist.util.TransferTracker(Monitor(), { 'archivist.x' : 'cabinet/folder' })
+
+        action = { "command" : "copy", "note" : "to archivist.x...", "key" : "K", "file" : "f" }
+
+        tracker.on_progress(json.dumps({ "byte-progress" : 10, "total-size" : 100, 
+                                         "action" : action }) + "\n")
+        tracker.on_progress(json.dumps(dict(action, success=True)) + "\n")
+        tracker.on_progress("not json\n")
+        tracker.report()
+
+        self.assertEqual([ ("f", "cabinet/folder", 10, False), 
+                           ("f", "cabinet/folder", 100, True) ], transfers)
+        self.assertEqual("not json\n", lines[0])
+        self.assertTrue(lines[1].startswith("Transfers with cabinet/folder: 1 files, 100.0 B"))
+
+    def test_parse_size(self):
+        self.assertEqual(100000, archivist.util.parse_size("100kb"))
+        self.assertEqual(1536, archivist.util.parse_size("1.5 KiB"))
+        self.assertEqual(42, archivist.util.parse_size("42"))
+
+        with self.assertRaisesRegex(Exception, "Invalid size"):
+            archivist.util.parse_size("10 parsecs")
+
+    def test_json_file(self):
+        path = tempfile.mkdtemp()
+
+        try:
+            file_path = os.path.join(path, "data")
+
+            self.assertEqual({}, archivist.util.load_json(file_path, {}))
+
+            archivist.util.save_json(file_path, { 'a' : [1, 2] })
+            self.assertEqual({ 'a' : [1, 2] }, archivist.util.load_json(file_path))
+            self.assertEqual(["data"], os.listdir(path))
+
+            # a truncated file
+            with open(file_path, "w") as fp:
+                fp.write("{ 'a'")
+
+            self.assertIsNone(archivist.util.load_json(file_path))
+        finally:
+            shutil.rmtree(path)
+
+    def test_profile(self):
+
+        archivist.profile.start()
+
+        try:
+            with archivist.profile.phase("outer", folder="x"):
+                archivist.util.exec(["printf", "abc"], progress=archivist.util.ProgressMonitor())
+
+            events = archivist.profile.profiler.events
+        finally:
+            archivist.profile.profiler = None
+
+        self.assertEqual(["printf abc", "outer"], [ event['name'] for event in events ])
+        self.assertEqual(3, events[0]['args']['output_bytes'])
+        self.assertEqual(0, events[0]['args']['returncode'])
+        self.assertEqual("x", events[1]['args']['folder'])
+        self.assertLessEqual(events[1]['ts'], events[0]['ts'])
+
+class TestCancellation(unittest.TestCase):
+
+    def test_command_timeout_kills_group(self):
+        lines = []
+
+        class Monitor(archivist.util.ProgressMonitor):
+            per_line = True
+
+            def on_progress(self, message):
+                lines.append(message)
+
+        start = time.monotonic()
+
+        with self.assertRaises(archivist.util.CommandTimeout):
+            archivist.util.exec(["sh", "-c", "sleep 30 & echo $!; wait"], 
+                                progress=Monitor(), timeout=0.5)
+
+        self.assertLess(time.monotonic() - start, 5)
+
+        # the child of the command was killed too (it may be left as a
+        # zombie until it's reaped)
+        time.sleep(0.1)
+
+        try:
+            with open("/proc/%d/stat" % int(lines[0])) as fp:
+                self.assertEqual("Z", fp.read().rsplit(")", 1)[1].split()[0])
+        except FileNotFoundError:
+            pass
+
+    def test_cancel_from_other_thread(self):
+        token = archivist.util.CancellationToken()
+
+        threading.Timer(0.3, token.cancel).start()
+
+        with archivist.util.cancellation(token):
+            with self.assertRaisesRegex(archivist.util.OperationCancelled, "cancelled"):
+                archivist.util.exec(["sleep", "30"])
+
+            # nothing is started once the token is cancelled
+            with self.assertRaises(archivist.util.OperationCancelled):
+                archivist.util.exec(["true"])
+
+    def test_check_output(self):
+        self.assertEqual(b"a\r\nb\0", archivist.util.check_output(["printf", "a\\r\\nb\\0"]))
+
+        with self.assertRaises(subprocess.CalledProcessError):
+            archivist.util.check_output(["false"])
+
+        start = time.monotonic()
+
+        with self.assertRaises(archivist.util.CommandTimeout):
+            archivist.util.check_output(["sleep", "30"], timeout=0.3)
+
+        self.assertLess(time.monotonic() - start, 5)
+
+    def test_exec_without_new_session(self):
+        token = archivist.util.CancellationToken()
+
+        threading.Timer(0.3, token.cancel).start()
+
+        with archivist.util.cancellation(token):
+            with self.assertRaises(archivist.util.OperationCancelled):
+                archivist.util.exec(["sleep", "30"], new_session=False)
+
+    def test_token_propagates_to_parallel_actions(self):
+        token = archivist.util.CancellationToken(timeout=0)
+
+        with archivist.util.cancellation(token):
+            results = archivist.util.run_parallel([1, 2], 
+                            lambda item: archivist.util.exec(["true"]), 2)
+
+        for item, error in results:
+            self.assertIsInstance(error, archivist.util.OperationCancelled)
+
+        self.assertIsNone(archivist.util.current_token())
+
+class TestFileLock(unittest.TestCase):
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.lock_path = os.path.join(self.path, "locks", "test.lock")
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def test_exclusive(self):
+        with archivist.util.FileLock(self.lock_path, operation="first"):
+            other = archivist.util.FileLock(self.lock_path, shared=True, timeout=0.2)
+
+            with self.assertRaisesRegex(archivist.util.LockTimeout, "first"):
+                other.acquire()
+
+        with other:
+            pass
+
+    def test_shared(self):
+        with archivist.util.FileLock(self.lock_path, shared=True):
+            with archivist.util.FileLock(self.lock_path, shared=True, timeout=0):
+                pass
+
+            with self.assertRaises(archivist.util.LockTimeout):
+                archivist.util.FileLock(self.lock_path, timeout=0).acquire()
+
+    def test_stale_owner_file(self):
+        os.makedirs(os.path.dirname(self.lock_path))
+
+        # a process that is not running any more
+        process = subprocess.Popen(["true"])
+        process.wait()
+
+        lock = archivist.util.FileLock(self.lock_path, timeout=0)
+
+        with open(self.lock_path + ".owner", "w") as fp:
+            fp.write("%d %s sync" % (process.pid, socket.gethostname()))
+
+        lock._acquire_owner_file(None, None)
+        lock.release()
+
+        self.assertFalse(os.path.exists(self.lock_path + ".owner"))
+
+    def test_stale_owner_file_race(self):
+        os.makedirs(os.path.dirname(self.lock_path))
+
+        owner_path = self.lock_path + ".owner"
+
+        with open(owner_path, "w") as fp:
+            fp.write("stale")
+
+        first = archivist.util.FileLock(self.lock_path, operation="first")
+
+        class Waiter(archivist.util.FileLock):
+
+            def _is_stale(self, owner):
+                # the first waiter takes over the lock after we read the 
+                # stale owner and before we remove it
+                os.unlink(owner_path)
+                first._acquire_owner_file(None, None)
+                return True
+
+        Waiter(self.lock_path)._remove_stale_owner_file(owner_path)
+
+        with open(owner_path) as fp:
+            self.assertEqual(first.owner, fp.read())
+
+        first.release()